@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+自适应并发上限（AIMD）：按观测到的首token延迟和错误率调整聊天道的并发上限
+
+每收集 AIMD_WINDOW 个流式执行样本评估一次：
+- 错误率超过 AIMD_MAX_ERROR_RATE，或首token延迟中位数超过 基线 x AIMD_TTFT_TOLERANCE
+  （且超过 AIMD_TTFT_TARGET_MS）时，上限乘以 AIMD_BACKOFF（乘性减）
+- 否则，如果窗口内并发曾经顶到上限，上限加一（加性增）
+上限始终在 [AIMD_MIN_LIMIT, AIMD_MAX_LIMIT] 之内。
+降低后的下一个窗口里还有按旧上限放行的执行，该窗口不再降低。
+基线是各窗口首token延迟中位数的最小值，每个窗口上浮 AIMD_BASELINE_DRIFT，避免一次偶然的低值长期压住上限。
+"""
+
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+# 是否启用自适应上限
+AIMD_ENABLED = os.getenv("PODCAST_AIMD_ENABLED", "1") == "1"
+# 上限的下限和上限
+AIMD_MIN_LIMIT = int(os.getenv("PODCAST_AIMD_MIN_LIMIT", "2"))
+AIMD_MAX_LIMIT = int(os.getenv("PODCAST_AIMD_MAX_LIMIT", "40"))
+# 每个评估窗口的样本数
+AIMD_WINDOW = int(os.getenv("PODCAST_AIMD_WINDOW", "10"))
+# 首token延迟低于该值（毫秒）时不认为拥塞
+AIMD_TTFT_TARGET_MS = float(os.getenv("PODCAST_AIMD_TTFT_TARGET_MS", "2000"))
+# 首token延迟中位数超过基线的倍数时认为拥塞
+AIMD_TTFT_TOLERANCE = float(os.getenv("PODCAST_AIMD_TTFT_TOLERANCE", "2.0"))
+# 窗口内错误率超过该值时认为拥塞
+AIMD_MAX_ERROR_RATE = float(os.getenv("PODCAST_AIMD_MAX_ERROR_RATE", "0.2"))
+# 乘性减的系数
+AIMD_BACKOFF = float(os.getenv("PODCAST_AIMD_BACKOFF", "0.75"))
+# 基线每个窗口上浮的比例
+AIMD_BASELINE_DRIFT = float(os.getenv("PODCAST_AIMD_BASELINE_DRIFT", "0.05"))
+
+
+class AIMDLimiter:
+    """按窗口评估并调整准入道的并发上限（只在事件循环中使用）"""
+
+    def __init__(
+        self,
+        enabled: bool = AIMD_ENABLED,
+        min_limit: int = AIMD_MIN_LIMIT,
+        max_limit: int = AIMD_MAX_LIMIT,
+        window: int = AIMD_WINDOW,
+        ttft_target_ms: float = AIMD_TTFT_TARGET_MS,
+        ttft_tolerance: float = AIMD_TTFT_TOLERANCE,
+        max_error_rate: float = AIMD_MAX_ERROR_RATE,
+        backoff: float = AIMD_BACKOFF,
+        baseline_drift: float = AIMD_BASELINE_DRIFT,
+    ):
+        self.enabled = enabled
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.window = max(1, window)
+        self.ttft_target_ms = ttft_target_ms
+        self.ttft_tolerance = ttft_tolerance
+        self.max_error_rate = max_error_rate
+        self.backoff = backoff
+        self.baseline_drift = baseline_drift
+
+        # 被调整的准入道（AdmissionLane）
+        self.lane: Any = None
+        self.baseline_ms: Optional[float] = None
+        self._ttfts: List[float] = []
+        self._errors = 0
+        self._samples = 0
+        self._saturated = False
+        # 上一个窗口刚降低过上限
+        self._cooldown = False
+
+        self.adjustments: Deque[Dict[str, Any]] = deque(maxlen=20)
+        self.increases = 0
+        self.decreases = 0
+        self.windows = 0
+
+    def attach(self, lane: Any):
+        """接管准入道的上限，初始值限制在 [min_limit, max_limit] 之内"""
+        self.lane = lane
+        if self.enabled:
+            lane.set_limit(min(self.max_limit, max(self.min_limit, lane.limit)))
+
+    def observe(self, ttft: Optional[float], error: bool = False):
+        """记录一次流式执行：首token延迟（秒，没有输出时为None）和是否出错"""
+        if not self.enabled or self.lane is None:
+            return
+        self._samples += 1
+        if error:
+            self._errors += 1
+        if ttft is not None:
+            self._ttfts.append(ttft * 1000)
+        # 窗口内并发是否顶到过上限（样本在执行结束时记录，此时名额还没有释放）
+        if self.lane.active >= self.lane.limit or self.lane.waiting:
+            self._saturated = True
+        if self._samples >= self.window:
+            self._evaluate()
+
+    def _evaluate(self):
+        self.windows += 1
+        error_rate = self._errors / self._samples
+        ttft_p50 = sorted(self._ttfts)[len(self._ttfts) // 2] if self._ttfts else None
+        if ttft_p50 is not None:
+            if self.baseline_ms is None:
+                self.baseline_ms = ttft_p50
+            else:
+                self.baseline_ms = min(ttft_p50, self.baseline_ms * (1 + self.baseline_drift))
+
+        limit = self.lane.limit
+        reason = None
+        if error_rate > self.max_error_rate:
+            reason = "errors"
+        elif (
+            ttft_p50 is not None
+            and ttft_p50 > self.ttft_target_ms
+            and ttft_p50 > self.baseline_ms * self.ttft_tolerance
+        ):
+            reason = "latency"
+
+        if reason is not None:
+            if self._cooldown:
+                new_limit = limit
+            else:
+                new_limit = max(self.min_limit, int(limit * self.backoff))
+        elif self._saturated:
+            new_limit = min(self.max_limit, limit + 1)
+            reason = "saturated"
+        else:
+            new_limit = limit
+
+        if new_limit != limit:
+            self.lane.set_limit(new_limit)
+            if new_limit > limit:
+                self.increases += 1
+            else:
+                self.decreases += 1
+                print(f"📉 降低{self.lane.name}并发上限: {limit} -> {new_limit} | 原因: {reason} | 首token中位数: {ttft_p50 or 0:.0f}ms | 错误率: {error_rate:.0%}")
+            self.adjustments.append({
+                "at": int(time.time()),
+                "from": limit,
+                "to": new_limit,
+                "reason": reason,
+                "ttft_p50_ms": round(ttft_p50, 1) if ttft_p50 is not None else None,
+                "baseline_ms": round(self.baseline_ms, 1) if self.baseline_ms is not None else None,
+                "error_rate": round(error_rate, 3),
+            })
+
+        self._cooldown = new_limit < limit
+        self._ttfts = []
+        self._errors = 0
+        self._samples = 0
+        self._saturated = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "lane": self.lane.name if self.lane is not None else None,
+            "limit": self.lane.limit if self.lane is not None else None,
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "window": self.window,
+            "window_samples": self._samples,
+            "baseline_ttft_ms": round(self.baseline_ms, 1) if self.baseline_ms is not None else None,
+            "ttft_target_ms": self.ttft_target_ms,
+            "windows": self.windows,
+            "increases": self.increases,
+            "decreases": self.decreases,
+            # 最近的调整，最新的在最后
+            "recent_adjustments": list(self.adjustments),
+        }
+
+
+streaming_limiter = AIMDLimiter()
@@ -0,0 +1,430 @@
+#!/usr/bin/env python3
+"""
+准入控制：按流量类型分道，每道有并发上限、有界等待队列和排队时限
+
+    control  健康检查、指标、会话管理等轻量请求，不会排在Agent执行后面
+    chat     聊天（可能是流式），按用户公平分配名额
+    podcast  播客脚本生成
+排队已满立即返回429，排队超过时限返回503，两者都带 Retry-After。
+准入在中间件里、响应开始之前决定；许可在响应体发送完（或客户端断开）时释放。
+"""
+
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, List, Optional, Tuple, Union
+
+from latency_stats import LatencyWindow
+
+# 各道的等待队列长度
+ADMISSION_CONTROL_QUEUE = int(os.getenv("PODCAST_ADMISSION_CONTROL_QUEUE", "100"))
+ADMISSION_CHAT_QUEUE = int(os.getenv("PODCAST_ADMISSION_CHAT_QUEUE", "20"))
+ADMISSION_PODCAST_QUEUE = int(os.getenv("PODCAST_ADMISSION_PODCAST_QUEUE", "10"))
+# 各道的最长排队时间（秒）
+ADMISSION_CONTROL_WAIT = float(os.getenv("PODCAST_ADMISSION_CONTROL_WAIT", "5"))
+ADMISSION_CHAT_WAIT = float(os.getenv("PODCAST_ADMISSION_CHAT_WAIT", "15"))
+ADMISSION_PODCAST_WAIT = float(os.getenv("PODCAST_ADMISSION_PODCAST_WAIT", "30"))
+# Retry-After 的上限（秒）
+ADMISSION_MAX_RETRY_AFTER = int(os.getenv("PODCAST_ADMISSION_MAX_RETRY_AFTER", "60"))
+
+
+def _parse_user_map(value: str) -> Dict[str, float]:
+    """解析 "alice:2,bob:0.5" 形式的按用户配置"""
+    result = {}
+    for item in value.split(","):
+        name, sep, number = item.strip().rpartition(":")
+        if sep and name:
+            result[name] = float(number)
+    return result
+
+
+# 公平调度：每个用户默认最多同时占用的名额数
+FAIR_USER_MAX_ACTIVE = int(os.getenv("PODCAST_FAIR_USER_MAX_ACTIVE", "5"))
+# 按用户覆盖的并发上限，如 "alice:10,bob:2"
+FAIR_USER_CAPS = {name: int(cap) for name, cap in _parse_user_map(os.getenv("PODCAST_FAIR_USER_CAPS", "")).items()}
+# 按用户的权重（默认1），权重2的用户在竞争时获得两倍的名额
+FAIR_USER_WEIGHTS = _parse_user_map(os.getenv("PODCAST_FAIR_USER_WEIGHTS", ""))
+# 排队超过该时间（秒）的请求不再按权重排序，直接优先放行
+FAIR_MAX_STARVATION = float(os.getenv("PODCAST_FAIR_MAX_STARVATION", "5"))
+# 会话 -> 用户名 的缓存条数
+FAIR_SESSION_USERS = int(os.getenv("PODCAST_FAIR_SESSION_USERS", "10000"))
+
+
+class AdmissionPermit:
+    """一个已准入请求占用的并发名额（释放可重复调用）"""
+
+    def __init__(self, lane: Optional["AdmissionLane"], waited: float = 0.0, key: Optional[str] = None):
+        self.lane = lane
+        self.waited = waited
+        self.key = key
+        self.acquired_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if self._released or self.lane is None:
+            return
+        self._released = True
+        self.lane._release(time.monotonic() - self.acquired_at, self.key)
+
+
+class AdmissionRejection:
+    """未被准入：429 排队已满，503 排队超时"""
+
+    def __init__(self, lane: str, status_code: int, retry_after: int, detail: str):
+        self.lane = lane
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.detail = detail
+
+
+class AdmissionLane:
+    """一道的并发控制：名额用完后FIFO排队，名额释放时交给下一个排队的请求
+
+    子类通过 _enqueue/_remove/_pick/_start/_finish 改变排队顺序和放行条件。
+    多worker部署时 shared 是该道在所有worker中的全局名额（shared_state.SharedSlots），
+    放行前还要取得一个全局名额，取不到时隔一会儿重试。
+    """
+
+    def __init__(self, name: str, limit: int, max_queue: int, max_wait: float):
+        self.name = name
+        self.limit = max(1, limit)
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.active = 0
+        self._waiters: Deque[Tuple[asyncio.Future, Optional[str]]] = deque()
+        # 名额平均占用时间（指数平均），用于估算 Retry-After
+        self.avg_hold = 0.0
+        # 全局名额（多worker），None 表示只在本进程内计数
+        self.shared: Any = None
+        self._retry_handle: Optional[asyncio.TimerHandle] = None
+
+        self.wait_latency = LatencyWindow()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _enqueue(self, waiter: asyncio.Future, key: Optional[str]):
+        self._waiters.append((waiter, key))
+
+    def _remove(self, waiter: asyncio.Future, key: Optional[str]):
+        self._waiters.remove((waiter, key))
+
+    def _pick(self) -> Optional[Tuple[asyncio.Future, Optional[str]]]:
+        """取出下一个可以放行的排队请求"""
+        return self._waiters.popleft() if self._waiters else None
+
+    def _start(self, key: Optional[str]):
+        self.active += 1
+
+    def _finish(self, key: Optional[str]):
+        self.active -= 1
+
+    def _grant(self):
+        """有空闲名额时按顺序放行排队的请求"""
+        while self.active < self.limit and self.waiting:
+            if self.shared is not None and not self.shared.try_acquire(self.limit):
+                # 其他worker占满了全局名额：它们释放时本进程收不到通知，只能定时重试
+                self._schedule_retry()
+                return
+            picked = self._pick()
+            if picked is None:
+                if self.shared is not None:
+                    self.shared.release()
+                return
+            waiter, key = picked
+            self._start(key)
+            waiter.set_result(None)
+
+    def _schedule_retry(self):
+        if self._retry_handle is None:
+            self._retry_handle = asyncio.get_running_loop().call_later(self.shared.retry_interval, self._retry)
+
+    def _retry(self):
+        self._retry_handle = None
+        self._grant()
+
+    def set_limit(self, limit: int):
+        """调整并发上限：调高时立即放行排队的请求，调低时等占用的名额自然释放"""
+        self.limit = max(1, limit)
+        self._grant()
+
+    def retry_after(self) -> int:
+        """按前面排队的请求数和平均占用时间估算多久后重试"""
+        estimate = self.avg_hold * (self.waiting + 1) / self.limit
+        return max(1, min(ADMISSION_MAX_RETRY_AFTER, math.ceil(estimate)))
+
+    async def admit(self, key: Optional[str] = None) -> Union[AdmissionPermit, AdmissionRejection]:
+        """key 是公平调度的分组（用户名），FIFO道忽略"""
+        waiter = asyncio.get_running_loop().create_future()
+        self._enqueue(waiter, key)
+        self._grant()
+        if waiter.done():
+            self.admitted += 1
+            self.wait_latency.record(0.0)
+            return AdmissionPermit(self, key=key)
+
+        if self.waiting > self.max_queue:
+            self._remove(waiter, key)
+            self.rejected_full += 1
+            return AdmissionRejection(
+                self.name, 429, self.retry_after(),
+                f"{self.name} 请求过多，排队已满（{self.max_queue}），请稍后重试",
+            )
+
+        start = time.monotonic()
+        self.queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_wait)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                self._remove(waiter, key)
+                self.rejected_timeout += 1
+                return AdmissionRejection(
+                    self.name, 503, self.retry_after(),
+                    f"{self.name} 排队超过 {self.max_wait:g}s，服务繁忙，请稍后重试",
+                )
+            # 超时的同时刚好拿到名额
+        except asyncio.CancelledError:
+            if waiter.done():
+                # 名额已经交过来，转交给下一个
+                self._release(None, key)
+            else:
+                self._remove(waiter, key)
+            raise
+        waited = time.monotonic() - start
+        self.admitted += 1
+        self.wait_latency.record(waited)
+        return AdmissionPermit(self, waited, key)
+
+    def _release(self, held: Optional[float], key: Optional[str]):
+        if held is not None:
+            self.avg_hold = held if self.avg_hold == 0.0 else self.avg_hold + 0.2 * (held - self.avg_hold)
+        self._finish(key)
+        if self.shared is not None:
+            self.shared.release()
+        # 上限被调低后 active 仍可能不低于上限，此时不放行
+        self._grant()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": self.waiting,
+            "max_queue": self.max_queue,
+            "max_wait_seconds": self.max_wait,
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected_429": self.rejected_full,
+            "rejected_503": self.rejected_timeout,
+            "avg_hold_seconds": round(self.avg_hold, 3),
+            "wait_ms": self.wait_latency.snapshot(),
+            "shared": self.shared is not None,
+        }
+
+
+class _UserShare:
+    __slots__ = ("name", "weight", "cap", "active", "queue", "vtime", "served", "wait_latency")
+
+    def __init__(self, name: str, weight: float, cap: int, vtime: float):
+        self.name = name
+        self.weight = weight
+        self.cap = cap
+        self.active = 0
+        # (future, 入队时刻)
+        self.queue: Deque[Tuple[asyncio.Future, float]] = deque()
+        # 虚拟时间：每放行一次增加 1/weight，竞争时虚拟时间最小的用户优先
+        self.vtime = vtime
+        self.served = 0
+        self.wait_latency = LatencyWindow(size=64)
+
+
+class FairAdmissionLane(AdmissionLane):
+    """按用户加权公平分配名额的准入道
+
+    - 每个用户最多同时占用 cap 个名额，超出的请求排队（即使道里还有空闲名额）
+    - 多个用户排队时，按虚拟时间（已获名额数 / 权重）最小的用户优先放行
+    - 排队超过 max_starvation 秒的请求优先放行（最早入队的先放行），保证等待时间有上界
+    新出现的用户的虚拟时间从当前虚拟时钟开始，空闲期间不积攒额度。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        limit: int,
+        max_queue: int,
+        max_wait: float,
+        user_max_active: int = FAIR_USER_MAX_ACTIVE,
+        user_caps: Optional[Dict[str, int]] = None,
+        user_weights: Optional[Dict[str, float]] = None,
+        max_starvation: float = FAIR_MAX_STARVATION,
+    ):
+        super().__init__(name, limit, max_queue, max_wait)
+        self.user_max_active = max(1, user_max_active)
+        self.user_caps = FAIR_USER_CAPS if user_caps is None else user_caps
+        self.user_weights = FAIR_USER_WEIGHTS if user_weights is None else user_weights
+        self.max_starvation = max_starvation
+        # 有名额或在排队的用户
+        self._users: Dict[str, _UserShare] = {}
+        self._vclock = 0.0
+        self._waiting = 0
+
+        self.capped = 0
+        self.starvation_grants = 0
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    def _user(self, key: Optional[str]) -> _UserShare:
+        name = key or "anonymous"
+        share = self._users.get(name)
+        if share is None:
+            share = self._users[name] = _UserShare(
+                name,
+                max(0.01, self.user_weights.get(name, 1.0)),
+                max(1, self.user_caps.get(name, self.user_max_active)),
+                self._vclock,
+            )
+        return share
+
+    def _drop_idle(self, share: _UserShare):
+        if share.active == 0 and not share.queue:
+            self._users.pop(share.name, None)
+
+    def _enqueue(self, waiter: asyncio.Future, key: Optional[str]):
+        share = self._user(key)
+        if share.active >= share.cap:
+            self.capped += 1
+        share.queue.append((waiter, time.monotonic()))
+        self._waiting += 1
+
+    def _remove(self, waiter: asyncio.Future, key: Optional[str]):
+        share = self._user(key)
+        for entry in share.queue:
+            if entry[0] is waiter:
+                share.queue.remove(entry)
+                self._waiting -= 1
+                break
+        self._drop_idle(share)
+
+    def _pick(self) -> Optional[Tuple[asyncio.Future, Optional[str]]]:
+        eligible = [s for s in self._users.values() if s.queue and s.active < s.cap]
+        if not eligible:
+            return None
+        now = time.monotonic()
+        oldest = min(eligible, key=lambda s: s.queue[0][1])
+        if now - oldest.queue[0][1] >= self.max_starvation:
+            share = oldest
+            self.starvation_grants += 1
+        else:
+            share = min(eligible, key=lambda s: (s.vtime, s.queue[0][1]))
+        waiter, enqueued_at = share.queue.popleft()
+        self._waiting -= 1
+        share.wait_latency.record(now - enqueued_at)
+        return waiter, share.name
+
+    def _start(self, key: Optional[str]):
+        super()._start(key)
+        share = self._user(key)
+        share.active += 1
+        share.served += 1
+        # 虚拟时钟跟随最近放行的用户，新用户从这里开始计
+        self._vclock = max(self._vclock, share.vtime)
+        share.vtime += 1.0 / share.weight
+
+    def _finish(self, key: Optional[str]):
+        super()._finish(key)
+        share = self._users.get(key or "anonymous")
+        if share is not None:
+            share.active -= 1
+            self._drop_idle(share)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        # 排队最多的前20个用户
+        busiest = sorted(self._users.values(), key=lambda s: (len(s.queue), s.active), reverse=True)[:20]
+        now = time.monotonic()
+        stats["fair"] = {
+            "user_max_active": self.user_max_active,
+            "max_starvation_seconds": self.max_starvation,
+            "users": len(self._users),
+            "capped": self.capped,
+            "starvation_grants": self.starvation_grants,
+            "per_user": {
+                share.name: {
+                    "active": share.active,
+                    "waiting": len(share.queue),
+                    "cap": share.cap,
+                    "weight": share.weight,
+                    "served": share.served,
+                    "oldest_wait_seconds": round(now - share.queue[0][1], 2) if share.queue else 0.0,
+                    "wait_ms": share.wait_latency.snapshot(),
+                }
+                for share in busiest
+            },
+        }
+        return stats
+
+
+class SessionUsers:
+    """会话ID -> 用户名 的LRU缓存，准入时按用户分组不必访问会话存储"""
+
+    def __init__(self, max_entries: int = FAIR_SESSION_USERS):
+        self.max_entries = max_entries
+        self._users: "OrderedDict[str, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session_id: str) -> Optional[str]:
+        username = self._users.get(session_id)
+        if username is None:
+            self.misses += 1
+            return None
+        self._users.move_to_end(session_id)
+        self.hits += 1
+        return username
+
+    def remember(self, session_id: str, username: Optional[str]):
+        if not session_id or not username:
+            return
+        self._users[session_id] = username
+        self._users.move_to_end(session_id)
+        while len(self._users) > self.max_entries:
+            self._users.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"entries": len(self._users), "hits": self.hits, "misses": self.misses}
+
+
+class AdmissionController:
+    """按请求路径分道准入"""
+
+    def __init__(self, lanes: List[AdmissionLane]):
+        self.lanes = {lane.name: lane for lane in lanes}
+
+    @staticmethod
+    def lane_for(method: str, path: str) -> str:
+        if method == "POST" and path == "/v1/chat/completions":
+            return "chat"
+        if method == "POST" and path == "/api/podcast/generate":
+            return "podcast"
+        return "control"
+
+    async def admit(self, method: str, path: str, key: Optional[str] = None) -> Union[AdmissionPermit, AdmissionRejection]:
+        return await self.lanes[self.lane_for(method, path)].admit(key)
+
+    def active(self, lane: str) -> int:
+        return self.lanes[lane].active
+
+    def stats(self) -> Dict[str, Any]:
+        return {name: lane.stats() for name, lane in self.lanes.items()}
+
+
+session_users = SessionUsers()
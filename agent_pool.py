@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+"""
+Agent进程预热池：复用已连接的 ClaudeSDKClient，省去每轮启动CLI、加载设置和技能的冷启动
+
+ClaudeSDKClient 的所有操作必须在连接它的同一个异步上下文中进行，所以每个客户端由一个
+常驻的属主任务负责：连接、逐轮执行从队列收到的提示词、最后断开。
+请求方只通过队列交换提示词和消息，不直接调用客户端。
+
+cwd/resume 等选项在连接时确定，所以池按会话保存空闲客户端：
+- 会话创建后按会话工作目录预先连接一个客户端
+- 一轮对话结束后客户端回到池中，里面保留着这轮的Claude会话，下一轮直接复用
+- 客户端达到使用次数上限被替换时，立即在后台连接一个接着这轮Claude会话的新客户端
+- 选项（cwd、resume、是否转发增量消息等）与本轮不符、超过空闲时间的客户端会被断开
+播客脚本生成的系统提示词里带着用户素材，每次都不同，无法预先连接，仍然调用 query。
+"""
+
+import asyncio
+import dataclasses
+import os
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Set
+
+from latency_stats import LatencyWindow
+
+# 池中最多保持的Agent进程数，0 表示关闭预热池（每轮调用 query 启动新进程）
+AGENT_POOL_SIZE = int(os.getenv("PODCAST_AGENT_POOL_SIZE", "4"))
+# 空闲客户端的最长保留时间（秒）
+AGENT_POOL_IDLE_TTL = float(os.getenv("PODCAST_AGENT_POOL_IDLE_TTL", "300"))
+# 单个客户端最多服务的轮数，之后替换为新进程
+AGENT_POOL_MAX_USES = int(os.getenv("PODCAST_AGENT_POOL_MAX_USES", "50"))
+# 连接（启动CLI进程）超时时间（秒），断开时也用这个时限
+AGENT_POOL_CONNECT_TIMEOUT = float(os.getenv("PODCAST_AGENT_POOL_CONNECT_TIMEOUT", "30"))
+# 会话创建后是否预先连接客户端
+AGENT_POOL_PREWARM = os.getenv("PODCAST_AGENT_POOL_PREWARM", "1") == "1"
+
+# 一轮结束的标记
+_TURN_END = object()
+
+
+class _Failure:
+    __slots__ = ("error",)
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def _sdk_client(options: Any) -> Any:
+    from claude_agent_sdk import ClaudeSDKClient
+
+    return ClaudeSDKClient(options=options)
+
+
+def _settings(options: Any) -> Dict[str, Any]:
+    """连接时确定、之后无法更改的选项（resume单独比较：一轮之后以init消息为准）"""
+    if dataclasses.is_dataclass(options):
+        fields = {f.name: getattr(options, f.name) for f in dataclasses.fields(options)}
+    else:
+        fields = dict(vars(options))
+    fields.pop("resume", None)
+    return fields
+
+
+class PooledClient:
+    """池中的一个客户端及其属主任务"""
+
+    def __init__(
+        self,
+        session_id: str,
+        options: Any,
+        connect_timeout: float,
+        client_factory: Optional[Callable[[Any], Any]] = None,
+    ):
+        self.session_id = session_id
+        self.options = options
+        self.connect_timeout = connect_timeout
+        # 创建客户端的函数 (选项) -> 客户端，默认 ClaudeSDKClient
+        self.client_factory = client_factory or _sdk_client
+        self.settings = _settings(options)
+        # 客户端当前所在的Claude会话ID（连接时的resume，之后以init消息为准）
+        self.resume = options.resume
+        self.uses = 0
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+        self.connect_seconds: Optional[float] = None
+
+        self.ready: asyncio.Future = asyncio.get_running_loop().create_future()
+        # (提示词, 输出队列)；None 表示断开
+        self._jobs: "asyncio.Queue[Optional[tuple]]" = asyncio.Queue()
+        self._out: Optional[asyncio.Queue] = None
+        self.task = asyncio.create_task(self._own())
+
+    def matches(self, options: Any) -> bool:
+        return self.resume == options.resume and self.settings == _settings(options)
+
+    @property
+    def alive(self) -> bool:
+        return not self.task.done()
+
+    async def _own(self):
+        """属主任务：连接、执行每一轮、断开都在这里完成"""
+        client = self.client_factory(self.options)
+        connected = False
+        try:
+            start = time.monotonic()
+            try:
+                async with asyncio.timeout(self.connect_timeout):
+                    await client.connect()
+            except Exception as e:
+                self.ready.set_exception(e)
+                return
+            connected = True
+            self.connect_seconds = time.monotonic() - start
+            self.ready.set_result(None)
+
+            while True:
+                job = await self._jobs.get()
+                if job is None:
+                    return
+                prompt, self._out = job
+                try:
+                    await client.query(prompt)
+                    async for message in client.receive_response():
+                        data = getattr(message, "data", None)
+                        if isinstance(data, dict) and data.get("session_id"):
+                            self.resume = data["session_id"]
+                        self._out.put_nowait(message)
+                except Exception as e:
+                    # 出错后的客户端状态未知，不再使用
+                    self._out.put_nowait(_Failure(e))
+                    self._out = None
+                    return
+                self._out.put_nowait(_TURN_END)
+                self._out = None
+        finally:
+            if not self.ready.done():
+                self.ready.cancel()
+            # 正在进行和还在排队的轮次都收到错误，不会一直等下去
+            exited = _Failure(RuntimeError("Agent进程已退出"))
+            if self._out is not None:
+                self._out.put_nowait(exited)
+            while not self._jobs.empty():
+                job = self._jobs.get_nowait()
+                if job is not None:
+                    job[1].put_nowait(exited)
+            if connected:
+                try:
+                    async with asyncio.timeout(self.connect_timeout):
+                        await client.disconnect()
+                except Exception as e:
+                    print(f"⚠️ 断开Agent进程失败: {str(e)}")
+
+    async def run(self, prompt: str) -> AsyncIterator[Any]:
+        """交给属主任务执行一轮，产出直到ResultMessage为止的消息"""
+        if not self.alive:
+            raise RuntimeError("Agent进程已退出")
+        out: asyncio.Queue = asyncio.Queue()
+        self._jobs.put_nowait((prompt, out))
+        while True:
+            item = await out.get()
+            if item is _TURN_END:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+
+    def stop(self):
+        """空闲的客户端：让属主任务断开后退出"""
+        self._jobs.put_nowait(None)
+
+    def kill(self):
+        """一轮没有完整结束（请求方中途退出）：取消属主任务，由它在自己的上下文中断开"""
+        self.task.cancel()
+
+
+class AgentClientPool:
+    """按会话复用 ClaudeSDKClient 的预热池（在事件循环中使用）"""
+
+    def __init__(
+        self,
+        size: int = AGENT_POOL_SIZE,
+        idle_ttl: float = AGENT_POOL_IDLE_TTL,
+        max_uses: int = AGENT_POOL_MAX_USES,
+        connect_timeout: float = AGENT_POOL_CONNECT_TIMEOUT,
+        prewarm_enabled: bool = AGENT_POOL_PREWARM,
+        client_factory: Optional[Callable[[Any], Any]] = None,
+    ):
+        self.size = size
+        self.idle_ttl = idle_ttl
+        self.max_uses = max_uses
+        self.connect_timeout = connect_timeout
+        self.prewarm_enabled = prewarm_enabled
+        self.client_factory = client_factory
+
+        # our_session_id -> 空闲客户端，按最近使用排序
+        self._idle: "OrderedDict[str, PooledClient]" = OrderedDict()
+        # our_session_id -> 预热中（正在连接）的客户端
+        self._connecting: Dict[str, PooledClient] = {}
+        self._leased = 0
+        # 全部属主任务，关闭时等待它们断开
+        self._owners: Set[asyncio.Task] = set()
+        self._reaper: Optional[asyncio.Task] = None
+
+        self.lease_wait = LatencyWindow()
+        self.connect_latency = LatencyWindow()
+        self.leases = 0
+        self.warm_hits = 0
+        self.cold_starts = 0
+        self.prewarmed = 0
+        self.prewarm_skipped = 0
+        self.replenished = 0
+        self.connect_failures = 0
+        self.replaced = 0
+        self.retired = 0
+        self.evicted = 0
+        self.expired = 0
+        self.stale = 0
+        self.exited = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    def _total(self) -> int:
+        return len(self._idle) + len(self._connecting) + self._leased
+
+    def _new_client(self, session_id: str, options: Any) -> PooledClient:
+        pooled = PooledClient(session_id, options, self.connect_timeout, self.client_factory)
+        self._owners.add(pooled.task)
+        pooled.task.add_done_callback(self._owners.discard)
+        pooled.task.add_done_callback(lambda _: self._exited(pooled))
+        return pooled
+
+    def _exited(self, pooled: PooledClient):
+        """属主任务结束（含CLI进程意外退出）时移出空闲列表"""
+        if self._idle.get(pooled.session_id) is pooled:
+            del self._idle[pooled.session_id]
+            self.exited += 1
+
+    async def _connected(self, pooled: PooledClient):
+        """等待客户端连接完成；失败时抛出连接错误"""
+        try:
+            await asyncio.shield(pooled.ready)
+        except asyncio.CancelledError:
+            if pooled.ready.cancelled():
+                raise RuntimeError("Agent进程连接被取消")
+            raise
+        except Exception:
+            self.connect_failures += 1
+            raise
+        self.connect_latency.record(pooled.connect_seconds or 0.0)
+
+    def _make_room(self):
+        """池满时淘汰最久未使用的空闲客户端"""
+        while self._total() >= self.size and self._idle:
+            _, pooled = self._idle.popitem(last=False)
+            self.evicted += 1
+            pooled.stop()
+
+    def prewarm(self, session_id: str, options: Any) -> bool:
+        """在后台为会话连接一个客户端；池满时跳过（不挤掉正在对话的会话），返回是否开始预热"""
+        if not self.enabled or not self.prewarm_enabled:
+            return False
+        if session_id in self._idle or session_id in self._connecting:
+            return False
+        if self._total() >= self.size:
+            self.prewarm_skipped += 1
+            return False
+        pooled = self._new_client(session_id, options)
+        self._connecting[session_id] = pooled
+        pooled.ready.add_done_callback(lambda _: self._prewarm_done(pooled))
+        return True
+
+    def _prewarm_done(self, pooled: PooledClient):
+        if self._connecting.get(pooled.session_id) is not pooled:
+            # 已被等待它的请求直接取走
+            return
+        del self._connecting[pooled.session_id]
+        if pooled.ready.cancelled():
+            return
+        if pooled.ready.exception() is not None:
+            self.connect_failures += 1
+            print(f"⚠️ 预热Agent进程失败: {pooled.session_id} | {str(pooled.ready.exception())}")
+            return
+        self.prewarmed += 1
+        self.connect_latency.record(pooled.connect_seconds or 0.0)
+        self._put_idle(pooled)
+        print(f"🔥 预热Agent进程: {pooled.session_id}")
+
+    def _put_idle(self, pooled: PooledClient):
+        if not pooled.alive:
+            return
+        previous = self._idle.pop(pooled.session_id, None)
+        if previous is not None:
+            previous.stop()
+        self._make_room()
+        if self._total() >= self.size:
+            # 其余客户端都在使用中，超出容量的客户端不保留
+            self.evicted += 1
+            pooled.stop()
+            return
+        self._idle[pooled.session_id] = pooled
+
+    def _take_idle(self, session_id: str, options: Any) -> Optional[PooledClient]:
+        pooled = self._idle.pop(session_id, None)
+        if pooled is None:
+            return None
+        if not pooled.alive:
+            self.exited += 1
+            return None
+        if time.monotonic() - pooled.last_used > self.idle_ttl:
+            self.expired += 1
+            pooled.stop()
+            return None
+        if not pooled.matches(options):
+            # 选项或Claude会话已变化（如resume失败后重开会话、流式与非流式切换）
+            self.stale += 1
+            pooled.stop()
+            return None
+        return pooled
+
+    async def _acquire(self, session_id: str, options: Any, allow_warm: bool = True):
+        """租用客户端，返回 (客户端, 是否复用了已有进程)"""
+        start = time.monotonic()
+        self.leases += 1
+        pooled = None
+        if allow_warm:
+            connecting = self._connecting.pop(session_id, None)
+            if connecting is not None:
+                # 预热还没完成，等它比重新启动一个进程快
+                self._leased += 1
+                try:
+                    await self._connected(connecting)
+                except asyncio.CancelledError:
+                    self._leased -= 1
+                    connecting.kill()
+                    raise
+                except Exception:
+                    self._leased -= 1
+                else:
+                    self.prewarmed += 1
+                    if connecting.matches(options):
+                        pooled = connecting
+                    else:
+                        self.stale += 1
+                        self._leased -= 1
+                        connecting.stop()
+            else:
+                pooled = self._take_idle(session_id, options)
+                if pooled is not None:
+                    self._leased += 1
+        if pooled is not None:
+            self.warm_hits += 1
+        else:
+            self.cold_starts += 1
+            self._make_room()
+            self._leased += 1
+            pooled = self._new_client(session_id, options)
+            try:
+                await self._connected(pooled)
+            except BaseException:
+                self._leased -= 1
+                pooled.kill()
+                raise
+        self.lease_wait.record(time.monotonic() - start)
+        return pooled, pooled.uses > 0 or pooled.created_at < start
+
+    def _release(self, pooled: PooledClient, ok: bool):
+        self._leased -= 1
+        pooled.uses += 1
+        pooled.last_used = time.monotonic()
+        if not ok:
+            self.replaced += 1
+            pooled.kill()
+        elif self._reaper is None:
+            # 池未启动（或已关闭）时不保留空闲进程，避免无人回收
+            self.retired += 1
+            pooled.stop()
+        elif pooled.uses >= self.max_uses:
+            self.retired += 1
+            pooled.stop()
+            # 接着这轮的Claude会话预先连接新进程，下一轮仍然是热的
+            if self.prewarm(pooled.session_id, dataclasses.replace(pooled.options, resume=pooled.resume)):
+                self.replenished += 1
+        else:
+            self._put_idle(pooled)
+
+    async def run(self, session_id: str, options: Any, prompt: str) -> AsyncIterator[Any]:
+        """租用会话的客户端执行一轮对话；未完整消费（中途退出或出错）的客户端不再复用
+
+        复用的客户端在产出任何消息前失败（如进程已退出）时，换新进程重试一次。
+        """
+        for allow_warm in (True, False):
+            pooled, warm = await self._acquire(session_id, options, allow_warm)
+            produced = False
+            ok = False
+            try:
+                async for message in pooled.run(prompt):
+                    produced = True
+                    yield message
+                ok = True
+                return
+            except Exception as e:
+                if produced or not warm:
+                    raise
+                print(f"⚠️ 复用的Agent进程不可用，改用新进程: {session_id} | {str(e)}")
+            finally:
+                self._release(pooled, ok)
+
+    async def _reap_loop(self):
+        interval = max(1.0, min(self.idle_ttl / 2, 30.0))
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for session_id, pooled in list(self._idle.items()):
+                if now - pooled.last_used > self.idle_ttl:
+                    del self._idle[session_id]
+                    self.expired += 1
+                    pooled.stop()
+
+    def start(self):
+        """在事件循环中启动空闲回收任务"""
+        if not self.enabled or self._reaper is not None:
+            return
+        self._reaper = asyncio.create_task(self._reap_loop())
+
+    async def close(self):
+        """停止回收任务，断开所有客户端（各自在属主任务中断开）"""
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        while self._connecting:
+            _, pooled = self._connecting.popitem()
+            pooled.kill()
+        while self._idle:
+            _, pooled = self._idle.popitem()
+            pooled.stop()
+        if self._owners:
+            await asyncio.gather(*self._owners, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "enabled": self.enabled,
+            "size": self.size,
+            "idle": len(self._idle),
+            "leased": self._leased,
+            "connecting": len(self._connecting),
+            "processes": len(self._owners),
+            "oldest_idle_seconds": round(
+                max((now - p.last_used for p in self._idle.values()), default=0.0), 1
+            ),
+            "leases": self.leases,
+            "warm_hits": self.warm_hits,
+            "cold_starts": self.cold_starts,
+            "prewarmed": self.prewarmed,
+            "prewarm_skipped": self.prewarm_skipped,
+            "replenished": self.replenished,
+            "connect_failures": self.connect_failures,
+            "replaced": self.replaced,
+            "retired": self.retired,
+            "evicted": self.evicted,
+            "expired": self.expired,
+            "stale": self.stale,
+            "exited": self.exited,
+            "lease_wait_ms": self.lease_wait.snapshot(),
+            "connect_ms": self.connect_latency.snapshot(),
+        }
+
+
+agent_pool = AgentClientPool()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+"""
+JSON编码基准：
+1. SSE chunk：对比旧的 每个chunk构建dict + json.dumps 与 SSEChunkBuilder
+2. 响应体：对比旧的 UTF8JSONResponse.render（json.dumps）与 fast_json.dumps_bytes
+
+用法: python bench_json_chunks.py [chunk数量]
+"""
+
+import json
+import sys
+import timeit
+
+import fast_json
+from fast_json import SSEChunkBuilder
+
+CHAT_ID = "chatcmpl-1760000000"
+CREATED = 1760000000
+MODEL = "kimi-for-podcast"
+SESSION_ID = "0f479c2e-fcfd-4d68-b0d7-8d5f9c52fc0f"
+# 典型的增量文本：几个中文字符
+DELTAS = ["好的", "，我们", "先聊聊", "这期播客", "的主题", "吧。", "\n", "你想"]
+
+
+def legacy_chunk(text: str) -> str:
+    chunk = {
+        "id": CHAT_ID,
+        "object": "chat.completion.chunk",
+        "created": CREATED,
+        "model": MODEL,
+        "choices": [
+            {
+                "index": 0,
+                "delta": {"content": text},
+                "finish_reason": None,
+            }
+        ],
+        "session_id": SESSION_ID,
+    }
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+
+def run_legacy(n: int):
+    for i in range(n):
+        legacy_chunk(DELTAS[i % len(DELTAS)])
+
+
+def run_builder(n: int):
+    chunks = SSEChunkBuilder(CHAT_ID, CREATED, MODEL, SESSION_ID)
+    for i in range(n):
+        chunks.content(DELTAS[i % len(DELTAS)])
+
+
+# 典型的 GET /v1/sessions/{id} 响应：200条消息
+SESSION_BODY = {
+    "session_id": SESSION_ID,
+    "username": "张",
+    "created_at": "2025-10-01T12:00:00",
+    "claude_session_id": None,
+    "messages": [
+        {
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": "我想做一期关于城市骑行的播客，聊聊通勤路上的见闻。" * 3,
+            "timestamp": "2025-10-01T12:00:00",
+        }
+        for i in range(200)
+    ],
+}
+
+
+def legacy_render(content) -> bytes:
+    return json.dumps(
+        content,
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def run_legacy_render(n: int):
+    for _ in range(n):
+        legacy_render(SESSION_BODY)
+
+
+def run_fast_render(n: int):
+    for _ in range(n):
+        fast_json.dumps_bytes(SESSION_BODY)
+
+
+def check_equivalent():
+    chunks = SSEChunkBuilder(CHAT_ID, CREATED, MODEL, SESSION_ID)
+    for text in DELTAS:
+        old = json.loads(legacy_chunk(text)[len("data: "):])
+        new = json.loads(chunks.content(text)[len("data: "):])
+        assert old == new, (old, new)
+    assert json.loads(legacy_render(SESSION_BODY)) == json.loads(fast_json.dumps_bytes(SESSION_BODY))
+
+
+def bench(label: str, func, n: int, repeat: int = 5, unit: str = "chunk"):
+    best = min(timeit.repeat(lambda: func(n), number=1, repeat=repeat))
+    per_item_us = best / n * 1e6
+    print(f"{label:<32} {per_item_us:8.3f} µs/{unit}")
+    return per_item_us
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    check_equivalent()
+    print(f"📊 SSE chunk编码基准 | chunks: {n}")
+
+    legacy = bench("dict + json.dumps（旧）", run_legacy, n)
+
+    use_orjson = fast_json.USE_ORJSON
+    fast_json.USE_ORJSON = False
+    stdlib = bench("SSEChunkBuilder + 标准库", run_builder, n)
+    fast_json.USE_ORJSON = use_orjson
+    results = [stdlib]
+    if fast_json.orjson is not None:
+        fast_json.USE_ORJSON = True
+        results.append(bench("SSEChunkBuilder + orjson", run_builder, n))
+        fast_json.USE_ORJSON = use_orjson
+    else:
+        print("（未安装 orjson，跳过orjson后端）")
+
+    print(f"⚡ 最快方案相对旧实现提速 {legacy / min(results):.1f}x")
+
+    m = max(n // 500, 20)
+    print(f"\n📊 响应体编码基准 | 200条消息的会话 x {m}")
+    legacy = bench("json.dumps（旧）", run_legacy_render, m, unit="body")
+    fast = bench(f"fast_json（{fast_json.backend_name()}）", run_fast_render, m, unit="body")
+    print(f"⚡ 相对旧实现提速 {legacy / fast:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
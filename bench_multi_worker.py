@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+多worker吞吐基准：分别以 1、2、4... 个uvicorn worker启动服务器，用多个客户端进程压测读会话接口
+
+- 先在临时目录中生成一批带历史消息的会话（与服务器共用同一会话目录）
+- 每个客户端进程保持一条keep-alive连接，循环请求 GET /v1/sessions/{id}（读取会话 + JSON编码，占CPU）
+- 输出每种worker数的请求/秒、p50/p99延迟和相对单worker的加速比
+加速比受CPU核数限制，超过核数的worker不会再提升吞吐。
+
+用法: python bench_multi_worker.py [worker数列表，如 1,2,4] [每轮秒数] [客户端进程数]
+"""
+
+import http.client
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent
+SESSIONS = 50
+MESSAGES_PER_SESSION = 200
+
+
+def seed_sessions(sessions_dir: Path) -> list:
+    """生成测试会话；必须在导入会话模块前设置会话目录"""
+    os.environ["PODCAST_SESSIONS_DIR"] = str(sessions_dir)
+    from ultra_simple_server_paths import close_session_store, create_session_context, save_message
+
+    session_ids = []
+    for i in range(SESSIONS):
+        session_id = str(uuid.uuid4())
+        create_session_context(session_id, f"bench{i % 10}")
+        for j in range(MESSAGES_PER_SESSION // 2):
+            save_message(session_id, "user", f"第{j}轮：我想做一期关于城市骑行的播客，聊聊通勤和路线。", str(j))
+            save_message(session_id, "assistant", "好的，我们先确定这期播客的受众和时长，再梳理三到四个话题段落。" * 3)
+        session_ids.append(session_id)
+    close_session_store()
+    return session_ids
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(workers: int, port: int, workdir: Path, sessions_dir: Path) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "PODCAST_WORKERS": str(workers),
+        "PODCAST_SESSIONS_DIR": str(sessions_dir),
+        "PODCAST_SHARED_STATE_DB": str(workdir / f"shared_state_{workers}.db"),
+        "PYTHONPATH": os.pathsep.join(filter(None, [str(REPO_DIR), env.get("PYTHONPATH")])),
+    })
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "ultra_simple_server:app",
+            "--host", "127.0.0.1", "--port", str(port),
+            "--workers", str(workers), "--log-level", "warning", "--no-access-log",
+        ],
+        cwd=workdir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    # 等所有worker都能接受请求：连续多次健康检查都成功
+    deadline = time.monotonic() + 60
+    ok = 0
+    while ok < workers * 4:
+        if server.poll() is not None or time.monotonic() > deadline:
+            server.kill()
+            raise RuntimeError(f"服务器启动失败（workers={workers}）")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/health")
+            ok += conn.getresponse().status == 200
+            conn.close()
+        except OSError:
+            ok = 0
+            time.sleep(0.2)
+    return server
+
+
+def client(args) -> tuple:
+    """一个客户端进程：在截止时间前循环请求，返回 (成功数, 失败数, 各请求耗时)"""
+    port, session_ids, deadline, offset = args
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    done = failed = 0
+    latencies = []
+    i = offset
+    while time.time() < deadline:
+        session_id = session_ids[i % len(session_ids)]
+        i += 1
+        start = time.perf_counter()
+        try:
+            conn.request("GET", f"/v1/sessions/{session_id}")
+            response = conn.getresponse()
+            response.read()
+            if response.status == 200:
+                done += 1
+            else:
+                failed += 1
+        except (OSError, http.client.HTTPException):
+            failed += 1
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - start)
+    conn.close()
+    return done, failed, latencies
+
+
+def run(workers: int, seconds: float, clients: int, workdir: Path, sessions_dir: Path, session_ids: list) -> dict:
+    port = free_port()
+    server = start_server(workers, port, workdir, sessions_dir)
+    try:
+        # 预热：让各worker加载会话缓存
+        deadline = time.time() + 2
+        with multiprocessing.Pool(clients) as pool:
+            pool.map(client, [(port, session_ids, deadline, k) for k in range(clients)])
+            start = time.time()
+            deadline = start + seconds
+            results = pool.map(client, [(port, session_ids, deadline, k * 7) for k in range(clients)])
+            elapsed = time.time() - start
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    done = sum(r[0] for r in results)
+    latencies = sorted(t for r in results for t in r[2])
+    return {
+        "workers": workers,
+        "requests": done,
+        "failed": sum(r[1] for r in results),
+        "rps": done / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else 0.0,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0.0,
+    }
+
+
+def main():
+    worker_counts = [int(n) for n in (sys.argv[1] if len(sys.argv) > 1 else "1,2,4").split(",")]
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+    clients = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+
+    with tempfile.TemporaryDirectory(prefix="podcast-bench-") as tmp:
+        workdir = Path(tmp)
+        sessions_dir = workdir / "sessions"
+        session_ids = seed_sessions(sessions_dir)
+        print(f"📊 多worker吞吐基准 | CPU核数: {os.cpu_count()} | 会话: {SESSIONS} x {MESSAGES_PER_SESSION}条消息 | 客户端: {clients} | 每轮: {seconds:g}s")
+        print(f"{'workers':>8} {'req/s':>10} {'p50(ms)':>9} {'p99(ms)':>9} {'失败':>6} {'加速比':>8}")
+        baseline = None
+        for workers in worker_counts:
+            result = run(workers, seconds, clients, workdir, sessions_dir, session_ids)
+            baseline = baseline or result["rps"]
+            print(f"{workers:>8} {result['rps']:>10.1f} {result['p50_ms']:>9.1f} {result['p99_ms']:>9.1f} {result['failed']:>6} {result['rps'] / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+JSON编码层：优先使用 orjson（可选依赖），未安装时退回标准库
+
+输出统一为UTF-8、不转义中文、紧凑分隔符。
+SSEChunkBuilder 把每个流不变的 chat.completion.chunk 外壳预先序列化一次，
+之后每个chunk只编码delta部分。
+"""
+
+import json
+import os
+import re
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 编码后端：auto 有orjson就用；orjson 强制使用；stdlib 只用标准库
+JSON_BACKEND = os.getenv("PODCAST_JSON_BACKEND", "auto").lower()
+if JSON_BACKEND == "orjson" and orjson is None:
+    print("⚠️ 未安装 orjson，JSON编码改用标准库")
+USE_ORJSON = orjson is not None and JSON_BACKEND != "stdlib"
+
+_stdlib_encoder = json.JSONEncoder(
+    ensure_ascii=False, allow_nan=False, separators=(",", ":")
+)
+# 单个字符串的编码（C实现，不转义中文）；短文本比 orjson.dumps + decode 更快
+encode_str = json.encoder.encode_basestring
+
+
+def _stdlib_dumps(obj: Any) -> str:
+    return _stdlib_encoder.encode(obj)
+
+
+def dumps(obj: Any) -> str:
+    """编码为JSON字符串"""
+    if USE_ORJSON:
+        try:
+            return orjson.dumps(obj).decode("utf-8")
+        except TypeError:
+            # orjson不支持的类型（非字符串键、超过64位的整数等）交给标准库
+            pass
+    return _stdlib_dumps(obj)
+
+
+def dumps_bytes(obj: Any) -> bytes:
+    """编码为UTF-8字节串（响应体直接使用）"""
+    if USE_ORJSON:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass
+    return _stdlib_dumps(obj).encode("utf-8")
+
+
+def sse_event(obj: Any) -> str:
+    """编码为一条SSE data事件"""
+    return f"data: {dumps(obj)}\n\n"
+
+
+def backend_name() -> str:
+    return "orjson" if USE_ORJSON else "stdlib"
+
+
+class SSEChunkBuilder:
+    """OpenAI风格的流式chunk构建器：外壳只序列化一次，每个chunk只编码delta"""
+
+    def __init__(self, chat_id: str, created: int, model: str, session_id: Optional[str]):
+        self.chat_id = chat_id
+        self.created = created
+        self.model = model
+        self.session_id = session_id
+        # {"id":..,"object":..,"created":..,"model":..,"choices":[{"index":0,"delta":<delta>,"finish_reason":<reason>}],"session_id":..}
+        self._prefix = (
+            'data: {"id":' + dumps(chat_id)
+            + ',"object":"chat.completion.chunk","created":' + dumps(created)
+            + ',"model":' + dumps(model)
+            + ',"choices":[{"index":0,"delta":'
+        )
+        self._suffix = '}],"session_id":' + dumps(session_id) + "}\n\n"
+
+    def content(self, text: str) -> str:
+        """只含文本增量的chunk（最常见的路径）"""
+        return (
+            self._prefix + '{"content":' + encode_str(text) + '},"finish_reason":null'
+            + self._suffix
+        )
+
+    def delta(self, delta: Dict[str, Any], finish_reason: Optional[str] = None) -> str:
+        return (
+            self._prefix + dumps(delta) + ',"finish_reason":' + dumps(finish_reason)
+            + self._suffix
+        )
+
+    def chunk(
+        self,
+        delta: Dict[str, Any],
+        finish_reason: Optional[str] = None,
+        **extra: Any,
+    ) -> str:
+        """带额外顶层字段的chunk（如最终chunk的统计信息），按完整对象编码"""
+        if not extra:
+            return self.delta(delta, finish_reason)
+        return sse_event(
+            {
+                "id": self.chat_id,
+                "object": "chat.completion.chunk",
+                "created": self.created,
+                "model": self.model,
+                "choices": [
+                    {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                ],
+                "session_id": self.session_id,
+                **extra,
+            }
+        )
+
+
+# 文本增量chunk在 content 字符串前后的固定片段；字符串内的引号都已转义，原样出现的片段只能是结构本身
+_CONTENT_HEAD = ',"choices":[{"index":0,"delta":{"content":"'
+_CONTENT_TAIL = '"},"finish_reason":null}],'
+# 合法的JSON字符串内容：没有未转义的引号，反斜杠后跟一个字符
+_STRING_BODY = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*')
+
+
+def _split_content_chunk(chunk: Any) -> Optional[Tuple[str, str, str]]:
+    """把只含文本增量的chunk拆成 (content之前, content转义后的原文, content之后)，其他chunk返回None"""
+    if not isinstance(chunk, str) or not chunk.startswith("data: {") or not chunk.endswith("}\n\n"):
+        return None
+    head_end = chunk.find(_CONTENT_HEAD)
+    if head_end < 0:
+        return None
+    head_end += len(_CONTENT_HEAD)
+    tail_start = chunk.find(_CONTENT_TAIL, head_end)
+    if tail_start < 0:
+        return None
+    head = chunk[:head_end]
+    if '"object":"chat.completion.chunk"' not in head:
+        return None
+    body = chunk[head_end:tail_start]
+    if _STRING_BODY.fullmatch(body) is None:
+        return None
+    return head, body, chunk[tail_start:]
+
+
+def merge_content_chunks(first: Any, second: Any) -> Optional[str]:
+    """把同一个流里相邻的两个文本增量chunk合并为一个，不能合并时返回None
+
+    直接拼接两段转义后的content原文，不重新解析和编码；结果与用合并后的文本构建的chunk逐字节相同。
+    """
+    a = _split_content_chunk(first)
+    if a is None:
+        return None
+    b = _split_content_chunk(second)
+    if b is None or a[0] != b[0] or a[2] != b[2]:
+        return None
+    return a[0] + a[1] + b[1] + a[2]
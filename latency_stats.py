@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""
+延迟统计：保留最近N个样本，输出p50/p99/max（毫秒）
+"""
+
+from collections import deque
+from typing import Dict
+
+
+class LatencyWindow:
+    """最近样本的滑动窗口（秒为单位记录）"""
+
+    def __init__(self, size: int = 512):
+        self._samples = deque(maxlen=size)
+        self.count = 0
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+        self.count += 1
+
+    def snapshot(self) -> Dict[str, float]:
+        if not self._samples:
+            return {"p50": 0.0, "p99": 0.0, "max": 0.0}
+        ordered = sorted(self._samples)
+        pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+        return {
+            "p50": round(pick(0.5) * 1000, 3),
+            "p99": round(pick(0.99) * 1000, 3),
+            "max": round(ordered[-1] * 1000, 3),
+        }
@@ -26,9 +26,19 @@ from datetime import datetime
 from pathlib import Path
 import subprocess
 import asyncio
+import time
+from contextlib import aclosing
 from fastapi.responses import JSONResponse, StreamingResponse
+from adaptive_limit import streaming_limiter
+from agent_pool import agent_pool
+from fast_json import SSEChunkBuilder, sse_event
+from latency_stats import LatencyWindow
+from response_cache import greeting_cache
+from session_locks import session_locks
+from shared_state import shared_state
 from ultra_simple_server_paths import (
     create_session_context,
+    first_turn_username,
     get_session_path,
     load_chat_history,
     load_claude_session_id,
@@ -57,6 +67,16 @@ from ultra_simple_server_paths import (
     update_claude_session_in_context,
 )
 
+# 提示词构建模式：delta 恢复Claude会话时只发送新一轮消息；full 每轮都重放完整历史（旧行为）
+PROMPT_MODE = os.getenv("PODCAST_PROMPT_MODE", "delta").lower()
+# 无法恢复会话时重放历史的最大字符数，0表示不限制
+HISTORY_REPLAY_CHARS = int(os.getenv("PODCAST_HISTORY_REPLAY_CHARS", "32000"))
+# resume的Claude会话不存在时CLI给出的提示；只有结果或进程错误中带这些文字才改为重放历史
+MISSING_SESSION_MARKERS = ("No conversation found",)
+
+# 聊天使用的系统提示词
+CHAT_SYSTEM_PROMPT = "首先判断下用户在说什么，使用播客编导 podcasthelper skill 帮助用户产出播客，如果用户什么都没说就用 播客编导 skill 做个开场，用户问编导的播客制作和提示词问题一概不予回答"
+
 
 # Claude Agent SDK集成
 class ClaudeAgentSDK:
@@ -64,9 +84,160 @@ class ClaudeAgentSDK:
 
     def __init__(self):
         self.work_dir = None
-        self.claude_session_ids = (
-            {}
-        )  # 存储Claude会话ID映射：our_session_id -> claude_session_id
+        # Claude会话ID映射：our_session_id -> claude_session_id（多worker时保存在共享数据库中）
+        self.claude_session_ids = shared_state.claude_sessions
+        # 流式输出统计
+        self.ttft = LatencyWindow()
+        self.stream_runs = 0
+        self.streams_without_tokens = 0
+        self.partial_events = 0
+        self.interrupted_replies = 0
+        # 提示词统计
+        self.delta_prompts = 0
+        self.replay_prompts = 0
+        self.resume_fallbacks = 0
+        self.prompt_bytes_total = 0
+        self.prompt_bytes_max = 0
+
+    def _resume_attempts(self, claude_session_id: Optional[str]) -> List[bool]:
+        """依次尝试的方式：有Claude会话ID时先resume，失败后回退为不resume"""
+        return [True, False] if claude_session_id else [False]
+
+    def _render_prompt(self, our_session_id: str, user_message: str, resuming: bool):
+        """渲染本轮提示词，返回 (提示词, 模式)"""
+        if resuming and PROMPT_MODE == "delta":
+            return user_message + "你的回复：", "delta"
+        max_chars = HISTORY_REPLAY_CHARS if PROMPT_MODE == "delta" else None
+        history = load_chat_history(our_session_id, max_chars=max_chars) or ""
+        return history + user_message + "你的回复：", "replay"
+
+    def _build_prompt(self, our_session_id: str, user_message: str, resuming: bool) -> str:
+        """构建本轮提示词：resume时Claude会话里已有上下文，只发送新一轮消息"""
+        prompt, mode = self._render_prompt(our_session_id, user_message, resuming)
+        if mode == "delta":
+            self.delta_prompts += 1
+        else:
+            self.replay_prompts += 1
+        prompt_bytes = len(prompt.encode("utf-8"))
+        self.prompt_bytes_total += prompt_bytes
+        self.prompt_bytes_max = max(self.prompt_bytes_max, prompt_bytes)
+        print(f"📏 Prompt: {prompt_bytes} 字节 | 模式: {mode} | Session: {our_session_id}")
+        return prompt
+
+    def _lookup_greeting(self, our_session_id: str, user_message: str, claude_session_id: Optional[str]):
+        """首轮对话查开场缓存，返回 (缓存键, 用户名, 命中的回复)；不可缓存时缓存键为None"""
+        if not greeting_cache.enabled or claude_session_id or not our_session_id:
+            return None, None, None
+        username = first_turn_username(our_session_id)
+        if not username:
+            return None, None, None
+        prompt, _ = self._render_prompt(our_session_id, user_message, False)
+        key = greeting_cache.fingerprint(CHAT_SYSTEM_PROMPT, prompt, username)
+        if key is None:
+            return None, None, None
+        cached = greeting_cache.get(key, username)
+        if cached is not None:
+            print(f"⚡ 开场缓存命中 | Session: {our_session_id}")
+        return key, username, cached
+
+    @staticmethod
+    def _store_greeting(key, username, thinks, result, tool_calls, ok: bool):
+        """首轮对话正常结束后写入开场缓存；带生成确认标签的回复不缓存"""
+        if key is None:
+            return
+        if not ok or not result.strip() or "confirm_generate>" in result or "comfirm_generate>" in result:
+            greeting_cache.skip()
+            return
+        greeting_cache.put(key, username, thinks, result, tool_calls)
+
+    async def _save_interrupted(self, our_session_id: str, partial: str):
+        """保存被中断的回复，保证历史里每条用户消息后都有对应的助手消息"""
+        self.interrupted_replies += 1
+        if partial.count("<think>") > partial.count("</think>"):
+            partial += "</think>"
+        try:
+            await session_locks.run(
+                our_session_id, save_message,
+                our_session_id, "assistant", partial, None, None, None, True,
+            )
+            print(f"✂️ 保存中断的回复: {len(partial)} 字符 | Session: {our_session_id}")
+        except Exception as e:
+            print(f"❌ 保存中断的回复失败: {str(e)}")
+
+    def _chat_options(self, work_dir: str, stream: bool = True):
+        """聊天用的Agent选项；stream=True且SDK支持时开启增量消息"""
+        from claude_agent_sdk import ClaudeAgentOptions
+
+        options = ClaudeAgentOptions(
+            system_prompt=CHAT_SYSTEM_PROMPT,
+            setting_sources=["user", "project"],
+            allowed_tools=["Skill", "Read", "Write", "Bash", "Grep", "Glob"],
+            cwd=work_dir,
+        )
+        if stream:
+            try:
+                from claude_agent_sdk.types import StreamEvent  # noqa: F401
+            except ImportError:
+                # 旧版SDK没有增量消息，退回按TextBlock整块输出
+                pass
+            else:
+                # 让SDK在完整消息之前逐个转发模型的流式事件
+                options.include_partial_messages = True
+        return options
+
+    def prewarm(self, our_session_id: str):
+        """会话创建后预先启动Agent进程（需在事件循环中调用）"""
+        if not agent_pool.enabled:
+            return
+        try:
+            from claude_agent_sdk import ClaudeSDKClient  # noqa: F401
+            options = self._chat_options(str(get_session_path(our_session_id)))
+        except ImportError:
+            return
+        agent_pool.prewarm(our_session_id, options)
+
+    def _agent_messages(self, query, prompt: str, options, our_session_id: Optional[str]):
+        """执行一轮Agent对话：预热池可用时复用会话的客户端，否则调用query启动新进程"""
+        if agent_pool.enabled and our_session_id:
+            try:
+                from claude_agent_sdk import ClaudeSDKClient  # noqa: F401
+            except ImportError:
+                pass
+            else:
+                return agent_pool.run(our_session_id, options, prompt)
+        return query(prompt=prompt, options=options)
+
+    @staticmethod
+    def _mentions_missing_session(*texts) -> bool:
+        return any(
+            marker in text
+            for text in texts
+            if isinstance(text, str)
+            for marker in MISSING_SESSION_MARKERS
+        )
+
+    def _is_missing_session_result(self, message) -> bool:
+        """resume的会话不存在时CLI以错误结果结束；其他错误结果照常输出，保留会话ID"""
+        return bool(getattr(message, "is_error", False)) and self._mentions_missing_session(
+            getattr(message, "result", None)
+        )
+
+    def _is_missing_session_error(self, error: Exception) -> bool:
+        """resume的会话不存在时CLI进程报错退出，提示在错误信息或stderr里"""
+        return self._mentions_missing_session(str(error), getattr(error, "stderr", None))
+
+    async def _forget_claude_session(self, our_session_id: str):
+        """resume失败：清除保存的Claude会话ID，下次重放历史开新会话"""
+        self.resume_fallbacks += 1
+        self.claude_session_ids.pop(our_session_id, None)
+        if our_session_id:
+            await session_locks.run(
+                our_session_id,
+                update_claude_session_in_context,
+                our_session_id,
+                None,
+            )
+        print(f"↩️ Claude会话无法恢复，改为重放历史 | Session: {our_session_id}")
 
     def _extract_json_objects(self, text: str, content_to_clip_map: dict, user_clips: list):
         """
@@ -239,7 +410,7 @@ class ClaudeAgentSDK:
                     "type": "error",
                     "text": "没有找到有效的用户录音素材，无法生成播客脚本"
                 }
-                yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
+                yield sse_event(error_data)
                 yield "data: [DONE]\n\n"
                 return
 
@@ -296,43 +467,47 @@ IMPORTANT: 你必须严格按照JSON Lines格式输出播客脚本，不要添
 
                 # 使用健壮的JSON对象提取
                 for data_obj in self._extract_json_objects(buffer, content_to_clip_map, user_clips):
-                    yield f"data: {json.dumps(data_obj, ensure_ascii=False)}\n\n"
+                    yield sse_event(data_obj)
 
                 # 处理完后清空缓冲区
                 buffer = ""
 
             # 流式处理LLM响应
-            async for message in query(
-                prompt="现在开始生成播客脚本。严格按照JSON Lines格式输出，每行一个JSON对象，不要任何解释文字。",
-                options=options,
-            ):
-                print('msg:',message)
-                if isinstance(message, ResultMessage):
-                    content = message.result
-                    if content:
-                        for output in process_content(content):
-                            yield output
+            # 客户端断开时在本任务中关闭SDK迭代器，让CLI进程随之结束
+            async with aclosing(
+                query(
+                    prompt="现在开始生成播客脚本。严格按照JSON Lines格式输出，每行一个JSON对象，不要任何解释文字。",
+                    options=options,
+                )
+            ) as messages:
+                async for message in messages:
+                    print('msg:',message)
+                    if isinstance(message, ResultMessage):
+                        content = message.result
+                        if content:
+                            for output in process_content(content):
+                                yield output
 
-                elif isinstance(message, AssistantMessage):
-                    for block in message.content:
-                        if isinstance(block, TextBlock):
-                            content = block.text
-                            if content:
-                                for output in process_content(content):
-                                    yield output
+                    elif isinstance(message, AssistantMessage):
+                        for block in message.content:
+                            if isinstance(block, TextBlock):
+                                content = block.text
+                                if content:
+                                    for output in process_content(content):
+                                        yield output
 
             # 处理缓冲区中剩余的内容
             if buffer.strip():
                 data_obj = self._process_json_line(buffer.strip(), content_to_clip_map, user_clips)
                 if data_obj:
-                    yield f"data: {json.dumps(data_obj, ensure_ascii=False)}\n\n"
+                    yield sse_event(data_obj)
                 elif buffer.strip():
                     # 无法解析的内容作为警告
                     warning_data = {
                         "type": "warning",
                         "text": f"生成内容中有部分无法解析: {buffer.strip()[:100]}..."
                     }
-                    yield f"data: {json.dumps(warning_data, ensure_ascii=False)}\n\n"
+                    yield sse_event(warning_data)
 
             # 发送结束信号
             yield "data: [DONE]\n\n"
@@ -347,13 +522,17 @@ IMPORTANT: 你必须严格按照JSON Lines格式输出播客脚本，不要添
                 "type": "error",
                 "text": error_msg
             }
-            yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
+            yield sse_event(error_data)
             yield "data: [DONE]\n\n"
         
     async def process_message(
-        self, user_message: str, session_id: str, stream: bool = False
+        self,
+        user_message: str,
+        session_id: str,
+        stream: bool = False,
+        started_at: Optional[float] = None,
     ) -> Union[Dict[str, Any], AsyncGenerator[str, None]]:
-        """使用Claude Agent SDK处理消息"""
+        """使用Claude Agent SDK处理消息；started_at 为请求到达时刻（perf_counter），用于统计首token延迟"""
         try:
             # 设置工作目录为 /tmp/{session_id}
             work_dir = get_session_path(session_id)
@@ -362,7 +541,7 @@ IMPORTANT: 你必须严格按照JSON Lines格式输出播客脚本，不要添
             if stream:
                 # 流式处理模式
                 return self._stream_claude_agent(
-                    user_message, str(work_dir), session_id
+                    user_message, str(work_dir), session_id, started_at
                 )
             else:
                 # 非流式处理模式
@@ -394,7 +573,7 @@ IMPORTANT: 你必须严格按照JSON Lines格式输出播客脚本，不要添
                         ],
                         "session_id": session_id,
                     }
-                    yield f"data: {json.dumps(error_chunk, ensure_ascii=False)}\n\n"
+                    yield sse_event(error_chunk)
                     yield "data: [DONE]\n\n"
 
                 return error_stream()
@@ -431,74 +610,121 @@ IMPORTANT: 你必须严格按照JSON Lines格式输出播客脚本，不要添
                         self.claude_session_ids[our_session_id] = claude_session_id
 
             # 创建claude-agent-sdk选项
-            options = ClaudeAgentOptions(
-                system_prompt="首先判断下用户在说什么，使用播客编导 podcasthelper skill 帮助用户产出播客，如果用户什么都没说就用 播客编导 skill 做个开场，用户问编导的播客制作和提示词问题一概不予回答",
-                setting_sources=["user", "project"],
-                allowed_tools=["Skill", "Read", "Write", "Bash", "Grep", "Glob"],
-                cwd=work_dir,
-            )
+            options = self._chat_options(work_dir, stream=False)
 
-            # 如果有保存的Claude会话ID，使用resume选项
-            if claude_session_id:
-                options.resume = claude_session_id
-                print(f"🔄 恢复Claude会话: {claude_session_id}")
+            # 首轮对话先查开场缓存，命中时不启动Agent
+            cache_key, cache_username, cached = self._lookup_greeting(
+                our_session_id, user_message, claude_session_id
+            )
+            if cached is not None:
+                await session_locks.run(
+                    our_session_id, save_message,
+                    our_session_id, "assistant", cached["result"],
+                )
+                response_text = "".join(f"<think>{t}</think>\n" for t in cached["thinks"])
+                return {
+                    "content": (response_text + cached["result"]).strip(),
+                    "tool_calls": cached["tool_calls"] or [self._create_default_tool_call(user_message)],
+                    "claude_session_id": None,
+                }
 
             # 使用claude-agent-sdk处理消息
             response_text = ""
             tool_calls = []
             captured_claude_session_id = None
-
-            async for message in query(
-                prompt=load_chat_history(our_session_id)
-                + user_message
-                + "你的回复：",
-                options=options,
-            ):
-                # 捕获系统初始化消息中的会话ID
-                if (
-                    hasattr(message, "type")
-                    and message.type == "system"
-                    and hasattr(message, "subtype")
-                    and message.subtype == "init"
-                ):
-                    if (
-                        hasattr(message, "data")
-                        and message.data
-                        and "session_id" in message.data
-                    ):
-                        captured_claude_session_id = message.data["session_id"]
-                        print(f"🎯 捕获到Claude会话ID: {captured_claude_session_id}")
-
-                        # 保存Claude会话ID
-                        if our_session_id and captured_claude_session_id:
-                            self.claude_session_ids[our_session_id] = (
-                                captured_claude_session_id
-                            )
-                            update_claude_session_in_context(
-                                our_session_id, captured_claude_session_id
-                            )
-                if isinstance(message, ResultMessage):
-                    response_text += message.result
-                    save_message(our_session_id, "assistant", message.result)
-                if isinstance(message, AssistantMessage):
-                    for block in message.content:
-                        if isinstance(block, TextBlock):
-                            response_text += f"<think>{block.text}</think>" + "\n"
-                        elif isinstance(block, ToolUseBlock):
-                            tool_calls.append(
-                                {
-                                    "id": f"tool_{len(tool_calls)}_{int(datetime.now().timestamp())}",
-                                    "type": "function",
-                                    "function": {
-                                        "name": block.name,
-                                        # "arguments": (
-                                        #     json.dumps(block.input)
-                                        #     if hasattr(block, "input")
-                                        #     else "{}"
-                                        # ),
-                                    },
-                                }
-                            )
+            # 写入开场缓存用：思考文本、最终结果、结果是否出错
+            thinks = []
+            result_text = ""
+            result_error = False
+
+            # 有保存的Claude会话ID时先resume并只发送新一轮消息；resume失败再重放历史
+            for resuming in self._resume_attempts(claude_session_id):
+                options.resume = claude_session_id if resuming else None
+                if resuming:
+                    print(f"🔄 恢复Claude会话: {claude_session_id}")
+                prompt = self._build_prompt(our_session_id, user_message, resuming)
+                rejected = False
+                try:
+                    async with aclosing(
+                        self._agent_messages(query, prompt, options, our_session_id)
+                    ) as messages:
+                        async for message in messages:
+                            # 捕获系统初始化消息中的会话ID
+                            if (
+                                hasattr(message, "type")
+                                and message.type == "system"
+                                and hasattr(message, "subtype")
+                                and message.subtype == "init"
+                            ):
+                                if (
+                                    hasattr(message, "data")
+                                    and message.data
+                                    and "session_id" in message.data
+                                ):
+                                    captured_claude_session_id = message.data["session_id"]
+                                    print(f"🎯 捕获到Claude会话ID: {captured_claude_session_id}")
+
+                                    # 保存Claude会话ID
+                                    if our_session_id and captured_claude_session_id:
+                                        self.claude_session_ids[our_session_id] = (
+                                            captured_claude_session_id
+                                        )
+                                        await session_locks.run(
+                                            our_session_id,
+                                            update_claude_session_in_context,
+                                            our_session_id,
+                                            captured_claude_session_id,
+                                        )
+                            if isinstance(message, ResultMessage):
+                                if resuming and self._is_missing_session_result(message):
+                                    rejected = True
+                                    break
+                                response_text += message.result
+                                result_text += message.result
+                                result_error = result_error or bool(getattr(message, "is_error", False))
+                                await session_locks.run(
+                                    our_session_id, save_message,
+                                    our_session_id, "assistant", message.result,
+                                )
+                            if isinstance(message, AssistantMessage):
+                                for block in message.content:
+                                    if isinstance(block, TextBlock):
+                                        response_text += f"<think>{block.text}</think>" + "\n"
+                                        thinks.append(block.text)
+                                    elif isinstance(block, ToolUseBlock):
+                                        tool_calls.append(
+                                            {
+                                                "id": f"tool_{len(tool_calls)}_{int(datetime.now().timestamp())}",
+                                                "type": "function",
+                                                "function": {
+                                                    "name": block.name,
+                                                    # "arguments": (
+                                                    #     json.dumps(block.input)
+                                                    #     if hasattr(block, "input")
+                                                    #     else "{}"
+                                                    # ),
+                                                },
+                                            }
+                                        )
+                except Exception as resume_error:
+                    if not resuming or not self._is_missing_session_error(resume_error):
+                        raise
+                    print(f"⚠️ 恢复Claude会话失败: {str(resume_error)}")
+                    rejected = True
+                if not rejected:
+                    break
+                # 非流式还没有向客户端输出，丢弃本次结果后重放历史重试
+                await self._forget_claude_session(our_session_id)
+                response_text = ""
+                tool_calls = []
+                captured_claude_session_id = None
+                thinks = []
+                result_text = ""
+                result_error = False
+
+            self._store_greeting(
+                cache_key, cache_username, thinks, result_text, tool_calls, not result_error
+            )
 
             # 如果没有工具调用，创建默认的skill调用
             if not tool_calls:
@@ -523,9 +749,23 @@ IMPORTANT: 你必须严格按照JSON Lines格式输出播客脚本，不要添
 
     # 流式处理，重要
     async def _stream_claude_agent(
-        self, user_message: str, work_dir: str, our_session_id: str
+        self,
+        user_message: str,
+        work_dir: str,
+        our_session_id: str,
+        started_at: Optional[float] = None,
     ) -> AsyncGenerator[str, None]:
-        """使用Claude Agent SDK进行流式查询"""
+        """使用Claude Agent SDK进行流式查询：SDK的增量消息到达即转发为delta
+
+        客户端断开时（生成器被取消或关闭）把已经输出的内容保存为中断的助手消息。
+        """
+        started_at = started_at or time.perf_counter()
+        # Agent执行开始时刻：自适应并发上限只看执行本身的首token延迟，不含排队等待
+        run_started_at = time.perf_counter()
+        first_token_at = None
+        # 已输出给客户端的文本，以及本轮助手回复是否已经保存
+        sent_parts = []
+        reply_saved = False
         try:
             from claude_agent_sdk import query, ClaudeAgentOptions
             from claude_agent_sdk.types import (
@@ -534,6 +774,11 @@ IMPORTANT: 你必须严格按照JSON Lines格式输出播客脚本，不要添
                 ToolUseBlock,
                 ResultMessage,
             )
+            try:
+                from claude_agent_sdk.types import StreamEvent
+            except ImportError:
+                # 旧版SDK没有增量消息，退回按TextBlock整块输出
+                StreamEvent = None
 
             # 检查是否有保存的Claude会话ID
             claude_session_id = None
@@ -546,217 +791,231 @@ IMPORTANT: 你必须严格按照JSON Lines格式输出播客脚本，不要添
                         self.claude_session_ids[our_session_id] = claude_session_id
 
             # 创建claude-agent-sdk选项
-            options = ClaudeAgentOptions(
-                system_prompt="首先判断下用户在说什么，使用播客编导 podcasthelper skill 帮助用户产出播客，如果用户什么都没说就用 播客编导 skill 做个开场，用户问编导的播客制作和提示词问题一概不予回答",
-                setting_sources=["user", "project"],
-                allowed_tools=["Skill", "Read", "Write", "Bash", "Grep", "Glob"],
-                cwd=work_dir,
-            )
-
-            # 如果有保存的Claude会话ID，使用resume选项
-            if claude_session_id:
-                options.resume = claude_session_id
-                print(f"🔄 恢复Claude会话 (流式): {claude_session_id}")
+            options = self._chat_options(work_dir, stream=True)
 
             # 生成唯一的聊天ID
             chat_id = f"chatcmpl-{int(datetime.now().timestamp())}"
             created = int(datetime.now().timestamp())
+            self.stream_runs += 1
+            produced = False
+            # chunk外壳只序列化一次，之后每个chunk只编码delta
+            chunks = SSEChunkBuilder(chat_id, created, "kimi-for-podcast", our_session_id)
+
+            def content_chunk(content: str) -> str:
+                nonlocal produced
+                produced = True
+                sent_parts.append(content)
+                return chunks.content(content)
+
+            def mark_first_token():
+                nonlocal first_token_at
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    self.ttft.record(first_token_at - started_at)
+                    print(
+                        f"⏱️ 首token延迟: {(first_token_at - started_at) * 1000:.0f}ms | Session: {our_session_id}"
+                    )
 
             # 发送初始chunk
-            initial_chunk = {
-                "id": chat_id,
-                "object": "chat.completion.chunk",
-                "created": created,
-                "model": "kimi-for-podcast",
-                "choices": [
-                    {
-                        "index": 0,
-                        "delta": {"role": "assistant", "content": ""},
-                        "finish_reason": None,
-                    }
-                ],
-                "session_id": our_session_id,
-            }
-            yield f"data: {json.dumps(initial_chunk, ensure_ascii=False)}\n\n"
+            yield chunks.delta({"role": "assistant", "content": ""})
 
             # 使用claude-agent-sdk处理消息并流式输出
             response_text = ""
             tool_calls = []
-            chunk_count = 0
             captured_claude_session_id = None
+            # 当前消息的文本是否已经通过增量事件输出过（完整消息到达时不再重复输出）
+            streamed_text = False
+            think_open = False
+            # 写入开场缓存用：思考文本、最终结果、结果是否出错
+            thinks = []
+            result_text = ""
+            result_error = False
+
+            # 首轮对话先查开场缓存，命中时直接输出缓存的回复，不启动Agent
+            attempts = self._resume_attempts(claude_session_id)
+            cache_key, cache_username, cached = self._lookup_greeting(
+                our_session_id, user_message, claude_session_id
+            )
+            if cached is not None:
+                mark_first_token()
+                for think in cached["thinks"]:
+                    yield content_chunk(f"<think>{think}</think>")
+                yield content_chunk(cached["result"])
+                await session_locks.run(
+                    our_session_id, save_message,
+                    our_session_id, "assistant", cached["result"],
+                )
+                reply_saved = True
+                tool_calls = cached["tool_calls"]
+                cache_key = None
+                attempts = []
 
-            # 模拟流式响应 - 将完整响应分成多个chunk
-            full_response = "<think>娓娓转圈圈</think>"
-
-            # 将响应分成多个chunk来模拟流式输出
-            chunk = {
-                "id": chat_id,
-                "object": "chat.completion.chunk",
-                "created": created,
-                "model": "kimi-for-podcast",
-                "choices": [
-                    {
-                        "index": 0,
-                        "delta": {"content": full_response},
-                        "finish_reason": None,
-                    }
-                ],
-                "session_id": our_session_id,
-            }
-            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-
-            # 尝试使用真实的SDK进行查询（如果可用）
+            # 有保存的Claude会话ID时先resume并只发送新一轮消息；resume失败再重放历史
+            # 已经向客户端输出内容后不再重试
             try:
-                async for message in query(
-                    prompt=load_chat_history(our_session_id)
-                    + user_message
-                    + "你的回复：",
-                    options=options,
-                ):
-                    print("msg::", message)
-                    # 捕获系统初始化消息中的会话ID
-                    if (
-                        hasattr(message, "data")
-                        and message.data
-                        and "session_id" in message.data
-                    ):
-                        captured_claude_session_id = message.data["session_id"]
-                        print(
-                            f"🎯 捕获到Claude会话ID (流式): {captured_claude_session_id}"
-                        )
-
-                        # 保存Claude会话ID
-                        if our_session_id and captured_claude_session_id:
-                            self.claude_session_ids[our_session_id] = (
-                                captured_claude_session_id
-                            )
-                            update_claude_session_in_context(
-                                our_session_id, captured_claude_session_id
-                            )
-
-                    if isinstance(message, ResultMessage):
-                        # 判断comfirm_generate是不是在message.result里
-                        msg_res = message.result
-                        if (
-                            "<comfirm_generate>" in message.result
-                            and "</comfirm_generate>" in message.result
-                        ):
-                            msg_res = (
-                                msg_res.split("<comfirm_generate>")[0]
-                                + msg_res.split("</comfirm_generate>")[1]
-                            )
-                            yield """data: {"comfirm_generate": true}"""
-                        # 流式输出文本内容
-                        chunk = {
-                            "id": chat_id,
-                            "object": "chat.completion.chunk",
-                            "created": created,
-                            "model": "kimi-for-podcast",
-                            "choices": [
-                                {
-                                    "index": 0,
-                                    "delta": {"content": msg_res},
-                                    "finish_reason": None,
-                                }
-                            ],
-                            "session_id": our_session_id,
-                        }
-                        yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-                        response_text += block.text + "\n"
-                        save_message(our_session_id, "assistant", message.result)
-                    if isinstance(message, AssistantMessage):
-                        for block in message.content:
-                            if isinstance(block, TextBlock):
-                                # 流式输出文本内容
-                                chunk = {
-                                    "id": chat_id,
-                                    "object": "chat.completion.chunk",
-                                    "created": created,
-                                    "model": "kimi-for-podcast",
-                                    "choices": [
-                                        {
-                                            "index": 0,
-                                            "delta": {
-                                                "content": f"<think>{block.text}</think>"
-                                            },
-                                            "finish_reason": None,
-                                        }
-                                    ],
-                                    "session_id": our_session_id,
-                                }
-                                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-                                response_text += block.text + "\n"
-                                await asyncio.sleep(0.05)  # 小延迟
-                            elif isinstance(block, ToolUseBlock):
-                                tool_calls.append(
-                                    {
-                                        "id": f"tool_{len(tool_calls)}_{int(datetime.now().timestamp())}",
-                                        "type": "function",
-                                        "function": {
-                                            "name": block.name,
-                                            "arguments": (
-                                                json.dumps(block.input)
-                                                if hasattr(block, "input")
-                                                else "{}"
-                                            ),
-                                        },
-                                    }
-                                )
+                for resuming in attempts:
+                    options.resume = claude_session_id if resuming else None
+                    if resuming:
+                        print(f"🔄 恢复Claude会话 (流式): {claude_session_id}")
+                    prompt = self._build_prompt(our_session_id, user_message, resuming)
+                    rejected = False
+                    try:
+                        async with aclosing(
+                            self._agent_messages(query, prompt, options, our_session_id)
+                        ) as messages:
+                            async for message in messages:
+                                if StreamEvent is not None and isinstance(message, StreamEvent):
+                                    self.partial_events += 1
+                                    event = message.event or {}
+                                    event_type = event.get("type")
+                                    if event_type == "content_block_start":
+                                        if (event.get("content_block") or {}).get("type") == "text":
+                                            think_open = True
+                                            streamed_text = True
+                                            yield content_chunk("<think>")
+                                    elif event_type == "content_block_delta":
+                                        delta = event.get("delta") or {}
+                                        if delta.get("type") == "text_delta" and delta.get("text"):
+                                            mark_first_token()
+                                            yield content_chunk(delta["text"])
+                                    elif event_type == "content_block_stop" and think_open:
+                                        think_open = False
+                                        yield content_chunk("</think>")
+                                    continue
+
+                                print("msg::", message)
+                                # 捕获系统初始化消息中的会话ID
+                                if (
+                                    hasattr(message, "data")
+                                    and message.data
+                                    and "session_id" in message.data
+                                ):
+                                    captured_claude_session_id = message.data["session_id"]
+                                    print(
+                                        f"🎯 捕获到Claude会话ID (流式): {captured_claude_session_id}"
+                                    )
+
+                                    # 保存Claude会话ID
+                                    if our_session_id and captured_claude_session_id:
+                                        self.claude_session_ids[our_session_id] = (
+                                            captured_claude_session_id
+                                        )
+                                        await session_locks.run(
+                                            our_session_id,
+                                            update_claude_session_in_context,
+                                            our_session_id,
+                                            captured_claude_session_id,
+                                        )
+
+                                if isinstance(message, ResultMessage):
+                                    if resuming and not produced and self._is_missing_session_result(message):
+                                        rejected = True
+                                        break
+                                    # 判断comfirm_generate是不是在message.result里
+                                    msg_res = message.result or ""
+                                    if (
+                                        "<comfirm_generate>" in msg_res
+                                        and "</comfirm_generate>" in msg_res
+                                    ):
+                                        msg_res = (
+                                            msg_res.split("<comfirm_generate>")[0]
+                                            + msg_res.split("</comfirm_generate>")[1]
+                                        )
+                                        yield """data: {"comfirm_generate": true}\n\n"""
+                                    # 流式输出文本内容
+                                    if msg_res:
+                                        mark_first_token()
+                                    yield content_chunk(msg_res)
+                                    response_text += msg_res + "\n"
+                                    result_text += message.result or ""
+                                    result_error = result_error or bool(getattr(message, "is_error", False))
+                                    await session_locks.run(
+                                        our_session_id, save_message,
+                                        our_session_id, "assistant", message.result,
+                                    )
+                                    reply_saved = True
+                                if isinstance(message, AssistantMessage):
+                                    for block in message.content:
+                                        if isinstance(block, TextBlock):
+                                            if not streamed_text:
+                                                # 没有收到增量事件时整块输出
+                                                mark_first_token()
+                                                yield content_chunk(f"<think>{block.text}</think>")
+                                            response_text += block.text + "\n"
+                                            thinks.append(block.text)
+                                        elif isinstance(block, ToolUseBlock):
+                                            tool_calls.append(
+                                                {
+                                                    "id": f"tool_{len(tool_calls)}_{int(datetime.now().timestamp())}",
+                                                    "type": "function",
+                                                    "function": {
+                                                        "name": block.name,
+                                                        "arguments": (
+                                                            json.dumps(block.input)
+                                                            if hasattr(block, "input")
+                                                            else "{}"
+                                                        ),
+                                                    },
+                                                }
+                                            )
+                                    streamed_text = False
+                    except Exception as resume_error:
+                        if not resuming or produced or not self._is_missing_session_error(resume_error):
+                            raise
+                        print(f"⚠️ 恢复Claude会话失败 (流式): {str(resume_error)}")
+                        rejected = True
+                    if not rejected:
+                        break
+                    await self._forget_claude_session(our_session_id)
+                    captured_claude_session_id = None
             except Exception as sdk_error:
+                result_error = True
+                if think_open:
+                    yield content_chunk("</think>")
                 # 如果SDK调用失败，添加错误信息到响应
                 error_text = f" [SDK调用失败，使用模拟响应: {str(sdk_error)}]"
-                chunk = {
-                    "id": chat_id,
-                    "object": "chat.completion.chunk",
-                    "created": created,
-                    "model": "kimi-for-podcast",
-                    "choices": [
-                        {
-                            "index": 0,
-                            "delta": {"content": error_text},
-                            "finish_reason": None,
-                        }
-                    ],
-                    "session_id": our_session_id,
-                }
-                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+                yield content_chunk(error_text)
                 response_text += error_text
 
+            self._store_greeting(
+                cache_key, cache_username, thinks, result_text, tool_calls, not result_error
+            )
+            # 开场缓存命中没有调用上游，不计入自适应并发上限的样本
+            if cached is None:
+                streaming_limiter.observe(
+                    first_token_at - run_started_at if first_token_at is not None else None,
+                    error=result_error,
+                )
+
             # 如果没有工具调用，创建默认的skill调用
             if not tool_calls:
                 tool_calls = [self._create_default_tool_call(user_message)]
 
             # 发送工具调用信息
             if tool_calls:
-                tool_chunk = {
-                    "id": chat_id,
-                    "object": "chat.completion.chunk",
-                    "created": created,
-                    "model": "kimi-for-podcast",
-                    "choices": [
-                        {
-                            "index": 0,
-                            "delta": {"content": "", "tool_calls": tool_calls},
-                            "finish_reason": None,
-                        }
-                    ],
-                    "session_id": our_session_id,
-                }
-                yield f"data: {json.dumps(tool_chunk, ensure_ascii=False)}\n\n"
-
-            # 发送完成chunk
-            final_chunk = {
-                "id": chat_id,
-                "object": "chat.completion.chunk",
-                "created": created,
-                "model": "kimi-for-podcast",
-                "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
-                "session_id": our_session_id,
-            }
-            yield f"data: {json.dumps(final_chunk, ensure_ascii=False)}\n\n"
+                yield chunks.delta({"content": "", "tool_calls": tool_calls})
+
+            # 发送完成chunk，附带本次请求的首token延迟
+            if first_token_at is None:
+                self.streams_without_tokens += 1
+            yield chunks.chunk(
+                {},
+                "stop",
+                ttft_ms=(
+                    round((first_token_at - started_at) * 1000, 1)
+                    if first_token_at is not None
+                    else None
+                ),
+            )
             yield "data: [DONE]\n\n"
 
+        except (asyncio.CancelledError, GeneratorExit):
+            # 客户端断开：SDK迭代器已随aclosing关闭，保存已输出的部分
+            if not reply_saved and our_session_id:
+                await self._save_interrupted(our_session_id, "".join(sent_parts))
+            raise
         except Exception as e:
+            streaming_limiter.observe(None, error=True)
             # 错误处理
             error_chunk = {
                 "id": f"chatcmpl-{int(datetime.now().timestamp())}",
@@ -772,9 +1031,29 @@ IMPORTANT: 你必须严格按照JSON Lines格式输出播客脚本，不要添
                 ],
                 "session_id": our_session_id,
             }
-            yield f"data: {json.dumps(error_chunk, ensure_ascii=False)}\n\n"
+            yield sse_event(error_chunk)
             yield "data: [DONE]\n\n"
 
+    def stream_stats(self) -> Dict[str, Any]:
+        """流式输出统计：首token延迟分布、增量事件数与提示词大小"""
+        return {
+            "stream_runs": self.stream_runs,
+            "streams_without_tokens": self.streams_without_tokens,
+            "partial_events": self.partial_events,
+            "interrupted_replies": self.interrupted_replies,
+            "ttft_ms": self.ttft.snapshot(),
+            "prompts": {
+                "mode": PROMPT_MODE,
+                "delta": self.delta_prompts,
+                "replay": self.replay_prompts,
+                "resume_fallbacks": self.resume_fallbacks,
+                "avg_bytes": round(
+                    self.prompt_bytes_total / (self.delta_prompts + self.replay_prompts)
+                ) if self.delta_prompts + self.replay_prompts else 0,
+                "max_bytes": self.prompt_bytes_max,
+            },
+        }
+
     def _extract_tool_calls(self, result_data: Dict[str, Any]) -> List[Dict[str, Any]]:
         """提取工具调用信息"""
         tool_calls = []
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+请求生命周期统计：从准入到响应体最后一个字节
+
+call_next 返回时流式响应才刚开始，中间件用 track_body 包装响应体迭代器，
+并发名额、耗时、发送字节数和chunk数都覆盖完整的流。
+没有 Content-Length 的响应（StreamingResponse）记为流。
+"""
+
+import asyncio
+import itertools
+import time
+import weakref
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+from latency_stats import LatencyWindow
+
+
+class TrackedRequest:
+    """一个进行中的请求"""
+
+    def __init__(self, tracker: "RequestTracker", key: int, request_id: str, method: str, path: str, lane: str, permit: Any, session_id: str):
+        self.tracker = tracker
+        self.key = key
+        self.request_id = request_id
+        self.method = method
+        self.path = path
+        self.lane = lane
+        self.permit = permit
+        self.session_id = session_id
+        self.started = time.monotonic()
+        # 响应头发出前的耗时（即 X-Process-Time）
+        self.time_to_response: Optional[float] = None
+        self.status_code = 0
+        self.streaming = False
+        self.bytes_sent = 0
+        self.chunks = 0
+        self.outcome: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return time.monotonic() - self.started
+
+    def response_started(self, status_code: int, streaming: bool) -> float:
+        self.time_to_response = self.duration
+        self.status_code = status_code
+        self.streaming = streaming
+        return self.time_to_response
+
+    def sent(self, chunk: Any):
+        self.chunks += 1
+        self.bytes_sent += len(chunk)
+
+    def finish(self, outcome: str) -> bool:
+        """结束请求、释放准入名额（可重复调用，只有第一次生效）
+
+        outcome: completed、disconnected 或 error
+        """
+        if self.outcome is not None:
+            return False
+        self.outcome = outcome
+        self.permit.release()
+        self.tracker._finished(self)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "request_id": self.request_id,
+            "method": self.method,
+            "path": self.path,
+            "lane": self.lane,
+            "session_id": self.session_id,
+            "streaming": self.streaming,
+            "age_seconds": round(self.duration, 1),
+            "bytes_sent": self.bytes_sent,
+            "chunks": self.chunks,
+        }
+
+
+class RequestTracker:
+    """进行中请求的登记表和按准入道汇总的完成统计（只在事件循环中使用）"""
+
+    def __init__(self):
+        self._active: Dict[int, TrackedRequest] = {}
+        self._ids = itertools.count(1)
+        self._lanes: Dict[str, Dict[str, Any]] = {}
+        self._durations: Dict[str, LatencyWindow] = {}
+        self._stream_durations: Dict[str, LatencyWindow] = {}
+
+    def begin(self, request_id: str, method: str, path: str, lane: str, permit: Any, session_id: str) -> TrackedRequest:
+        record = TrackedRequest(self, next(self._ids), request_id, method, path, lane, permit, session_id)
+        self._active[record.key] = record
+        return record
+
+    def _lane(self, lane: str) -> Dict[str, Any]:
+        stats = self._lanes.get(lane)
+        if stats is None:
+            stats = self._lanes[lane] = {
+                "requests": 0,
+                "streams": 0,
+                "completed": 0,
+                "disconnected": 0,
+                "errors": 0,
+                "bytes_sent": 0,
+                "chunks": 0,
+            }
+            self._durations[lane] = LatencyWindow()
+            self._stream_durations[lane] = LatencyWindow()
+        return stats
+
+    def _finished(self, record: TrackedRequest):
+        self._active.pop(record.key, None)
+        stats = self._lane(record.lane)
+        stats["requests"] += 1
+        stats["errors" if record.outcome == "error" else record.outcome] += 1
+        stats["bytes_sent"] += record.bytes_sent
+        stats["chunks"] += record.chunks
+        duration = record.duration
+        self._durations[record.lane].record(duration)
+        if record.streaming:
+            stats["streams"] += 1
+            self._stream_durations[record.lane].record(duration)
+
+    def in_flight(self) -> int:
+        return len(self._active)
+
+    def in_flight_streams(self) -> int:
+        return sum(1 for record in self._active.values() if record.streaming)
+
+    def stats(self) -> Dict[str, Any]:
+        # 字典按登记顺序排列，前面的就是最早开始的
+        oldest = list(self._active.values())[:20]
+        return {
+            "in_flight": self.in_flight(),
+            "in_flight_streams": self.in_flight_streams(),
+            "in_flight_bytes_sent": sum(record.bytes_sent for record in self._active.values()),
+            # 最早开始的前20个请求
+            "oldest": [record.stats() for record in oldest],
+            "lanes": {
+                lane: {
+                    **stats,
+                    "duration_ms": self._durations[lane].snapshot(),
+                    "stream_duration_ms": self._stream_durations[lane].snapshot(),
+                }
+                for lane, stats in self._lanes.items()
+            },
+        }
+
+
+async def track_body(
+    record: TrackedRequest,
+    body: AsyncIterator[Any],
+    on_finish: Callable[[TrackedRequest], None],
+) -> AsyncIterator[Any]:
+    """转发响应体并计数，结束（含客户端断开、出错）时结束请求"""
+    outcome = "error"
+    try:
+        async for chunk in body:
+            record.sent(chunk)
+            yield chunk
+        outcome = "completed"
+    except (asyncio.CancelledError, GeneratorExit):
+        # 客户端断开：响应所在的scope被取消，或生成器被关闭
+        outcome = "disconnected"
+        raise
+    finally:
+        # 这里不能await：断开时scope已被取消
+        if record.finish(outcome):
+            on_finish(record)
+
+
+def _call_soon(loop: asyncio.AbstractEventLoop, callback: Callable[..., Any], *args: Any):
+    try:
+        loop.call_soon_threadsafe(callback, *args)
+    except RuntimeError:
+        # 事件循环已关闭，没有需要收尾的状态了
+        pass
+
+
+def finalize_on_loop(obj: Any, callback: Callable[..., Any], *args: Any) -> weakref.finalize:
+    """obj 被回收时在当前事件循环中调用 callback(*args)
+
+    回收可能发生在任意线程（循环引用由GC在碰巧触发它的线程中回收），
+    而准入名额、会话轮次等状态只能在事件循环中修改，所以回调交回事件循环执行。
+    """
+    return weakref.finalize(obj, _call_soon, asyncio.get_running_loop(), callback, *args)
+
+
+request_tracker = RequestTracker()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+首轮回复缓存：开场白等与上下文无关的首轮对话，不同用户之间只差用户名
+
+键为 (系统提示词, 去掉用户名并规范化空白后的提示词) 的指纹；
+存储时把回复中的用户名替换为占位符，命中时换成当前用户的用户名。
+用户名只按完整词替换；作为其他词的一部分出现时（如 "al" 出现在 "also" 里）不缓存。
+
+默认关闭（PODCAST_GREETING_CACHE_TTL=0）。命中时不运行Agent：不创建Claude会话，
+也没有工作目录里的副作用（Agent写的文件等），下一轮对话改为重放历史开新的Claude会话。
+"""
+
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+# 缓存有效期（秒），0 表示关闭缓存（默认）
+GREETING_CACHE_TTL = float(os.getenv("PODCAST_GREETING_CACHE_TTL", "0"))
+# 最多缓存的条目数，超出时淘汰最久未使用的
+GREETING_CACHE_SIZE = int(os.getenv("PODCAST_GREETING_CACHE_SIZE", "256"))
+
+USERNAME_PLACEHOLDER = "\x00USERNAME\x00"
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.split())
+
+
+def _replace_token(text: str, username: str, replacement: str) -> Optional[str]:
+    """把作为完整词出现的用户名替换掉；用户名还出现在其他词里时返回None"""
+    pattern = re.compile(r"(?<!\w)" + re.escape(username) + r"(?!\w)")
+    replaced, count = pattern.subn(lambda _: replacement, text)
+    if count != text.count(username):
+        return None
+    return replaced
+
+
+class ResponseCache:
+    """带TTL和容量上限的LRU缓存，值中的用户名按请求替换"""
+
+    def __init__(self, ttl: float = GREETING_CACHE_TTL, max_entries: int = GREETING_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.expired = 0
+        self.evictions = 0
+        self.uncacheable = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0 and self.max_entries > 0
+
+    def fingerprint(self, system_prompt: str, prompt: str, username: Optional[str]) -> Optional[str]:
+        """计算缓存键；用户名无法安全替换时返回None（不缓存）"""
+        if not self.enabled:
+            return None
+        # 单字用户名或出现在系统提示词里的用户名，替换会误伤正文
+        if not username or len(username) < 2 or username in system_prompt:
+            return None
+        replaced = _replace_token(prompt, username, USERNAME_PLACEHOLDER)
+        if replaced is None:
+            return None
+        normalized = _normalize(replaced)
+        digest = hashlib.sha256()
+        digest.update(_normalize(system_prompt).encode("utf-8"))
+        digest.update(b"\x00")
+        digest.update(normalized.encode("utf-8"))
+        return digest.hexdigest()
+
+    def get(self, key: str, username: str) -> Optional[Dict[str, Any]]:
+        """命中时返回替换好用户名的 {"thinks": [...], "result": str, "tool_calls": [...]}"""
+        now = time.monotonic()
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None and item[0] <= now:
+                del self._entries[key]
+                self.expired += 1
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            value = item[1]
+        return {
+            "thinks": [t.replace(USERNAME_PLACEHOLDER, username) for t in value["thinks"]],
+            "result": value["result"].replace(USERNAME_PLACEHOLDER, username),
+            "tool_calls": [dict(call) for call in value["tool_calls"]],
+        }
+
+    def put(
+        self,
+        key: str,
+        username: str,
+        thinks: List[str],
+        result: str,
+        tool_calls: List[Dict[str, Any]],
+    ) -> bool:
+        """写入缓存；回复里的用户名无法按完整词替换时不写入，返回False"""
+        texts = [_replace_token(t, username, USERNAME_PLACEHOLDER) for t in [result, *thinks]]
+        if any(text is None for text in texts):
+            self.skip()
+            return False
+        value = {
+            "thinks": texts[1:],
+            "result": texts[0],
+            "tool_calls": [dict(call) for call in tool_calls],
+        }
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            self.stores += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return True
+
+    def skip(self):
+        """记录一次结果不可缓存（出错、空结果、带确认标签等）"""
+        with self._lock:
+            self.uncacheable += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "ttl_seconds": self.ttl,
+                "max_entries": self.max_entries,
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "stores": self.stores,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "uncacheable": self.uncacheable,
+            }
+
+
+greeting_cache = ResponseCache()
@@ -0,0 +1,904 @@
+#!/usr/bin/env python3
+"""
+会话存储后端
+
+FileSystemBackend  每个会话一个目录（meta.json + messages.jsonl），兼容旧版context.json
+SQLiteBackend      WAL模式的SQLite，会话表与消息表带索引，支持分页和按用户查询
+
+空闲会话的工作目录可以压缩归档为单个文件（{目录名}.jsonl.gz / .jsonl.zst），
+通过 SessionLayout.path_for 访问时自动解压还原。
+"""
+
+import base64
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+META_FILE = "meta.json"
+MESSAGES_FILE = "messages.jsonl"
+LEGACY_CONTEXT_FILE = "context.json"
+MIGRATED_SUFFIX = ".migrated"
+# 能识别为会话目录的标记文件
+SESSION_MARKER_FILES = (META_FILE, MESSAGES_FILE, LEGACY_CONTEXT_FILE)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SessionData = Tuple[Dict[str, Any], List[Dict[str, Any]]]
+# (session_id, 最后活跃时间戳, 占用字节数, 是否已归档)
+SessionUsage = Tuple[str, float, int, bool]
+
+ARCHIVE_FORMAT = "podcast-session-archive"
+# 解压归档时的临时目录前缀，不是会话
+REHYDRATE_PREFIX = ".rehydrate-"
+ARCHIVE_SUFFIXES = {"gzip": ".jsonl.gz", "zstd": ".jsonl.zst"}
+
+
+def _open_archive(path: Path, mode: str):
+    """按扩展名打开归档文件（文本模式）"""
+    if path.name.endswith(ARCHIVE_SUFFIXES["zstd"]):
+        if zstandard is None:
+            raise RuntimeError("读取zstd归档需要安装 zstandard")
+        raw = open(path, mode + "b")
+        if mode == "w":
+            stream = zstandard.ZstdCompressor(level=10).stream_writer(raw)
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(raw)
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    return gzip.open(path, mode + "t", encoding="utf-8", compresslevel=6)
+
+
+def _dir_usage(path: Path) -> Tuple[float, int]:
+    """返回目录内文件的最新mtime和总字节数（agent写入的文件也计入）"""
+    last_active = 0.0
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        try:
+            last_active = max(last_active, os.stat(dirpath).st_mtime)
+        except OSError:
+            pass
+        for name in filenames:
+            try:
+                st = os.stat(os.path.join(dirpath, name), follow_symlinks=False)
+            except OSError:
+                continue
+            total += st.st_size
+            last_active = max(last_active, st.st_mtime)
+    return last_active, total
+
+
+def _delete_session_files(layout: "SessionLayout", session_id: str) -> int:
+    """删除会话的工作目录和归档文件，返回释放的字节数"""
+    total = 0
+    paths = [layout.legacy_path(session_id)]
+    if layout.sharded:
+        paths.insert(0, layout.sharded_path(session_id))
+    for session_path in paths:
+        if session_path.is_dir():
+            total += _dir_usage(session_path)[1]
+            shutil.rmtree(session_path, ignore_errors=True)
+        archive = layout.find_archive(session_path)
+        if archive is not None:
+            total += archive.stat().st_size
+            archive.unlink()
+    return total
+
+
+class SessionLayout:
+    """会话目录布局：分片目录 sessions/ab/cd/{session_id}，兼容旧的平铺目录"""
+
+    def __init__(self, base: Path, sharded: bool = True, archive_codec: str = "gzip"):
+        self.base = Path(base)
+        self.sharded = sharded
+        self.sharded_root = self.base / "sessions"
+        if archive_codec == "zstd" and zstandard is None:
+            print("⚠️ 未安装 zstandard，会话归档改用gzip")
+            archive_codec = "gzip"
+        self.archive_codec = archive_codec
+        self._rehydrate_lock = threading.Lock()
+        self.archived = 0
+        self.rehydrated = 0
+
+    def sharded_path(self, session_id: str) -> Path:
+        digest = hashlib.sha1(session_id.encode("utf-8")).hexdigest()
+        return self.sharded_root / digest[:2] / digest[2:4] / session_id
+
+    def legacy_path(self, session_id: str) -> Path:
+        return self.base / session_id
+
+    def _candidates(self, session_id: str) -> List[Path]:
+        if self.sharded:
+            return [self.sharded_path(session_id), self.legacy_path(session_id)]
+        return [self.legacy_path(session_id)]
+
+    def locate(self, session_id: str) -> Tuple[Optional[Path], Optional[Path]]:
+        """查找会话但不解压：返回 (会话目录, None)、(原目录路径, 归档文件) 或 (None, None)"""
+        candidates = self._candidates(session_id)
+        for path in candidates:
+            if path.is_dir():
+                return path, None
+        for path in candidates:
+            archive = self.find_archive(path)
+            if archive is not None:
+                return path, archive
+        return None, None
+
+    def exists(self, session_id: str) -> bool:
+        """会话目录或归档是否存在（不解压）"""
+        return self.locate(session_id)[0] is not None
+
+    def path_for(self, session_id: str) -> Path:
+        """已存在的旧平铺目录原地使用（agent的resume依赖cwd不变），新会话放分片目录
+
+        已归档的会话在这里透明地解压回原目录；只判断存在与否时用 locate/exists。
+        """
+        path, archive = self.locate(session_id)
+        if path is None:
+            return self._candidates(session_id)[0]
+        if archive is not None:
+            self.rehydrate(path)
+        return path
+
+    # ---- 冷归档 ----
+
+    @staticmethod
+    def find_archive(session_path: Path) -> Optional[Path]:
+        for suffix in ARCHIVE_SUFFIXES.values():
+            archive = session_path.with_name(session_path.name + suffix)
+            if archive.exists():
+                return archive
+        return None
+
+    def archive(self, session_path: Path) -> Optional[Tuple[int, int]]:
+        """把会话目录压缩为单个归档文件并删除目录，返回 (归档前字节, 归档后字节)"""
+        if not session_path.is_dir():
+            return None
+        archive = session_path.with_name(
+            session_path.name + ARCHIVE_SUFFIXES[self.archive_codec]
+        )
+        tmp_archive = archive.with_name(f".{archive.name}.tmp")
+        _, before = _dir_usage(session_path)
+
+        files = []
+        for dirpath, _, filenames in os.walk(session_path):
+            for name in filenames:
+                full = Path(dirpath) / name
+                rel = full.relative_to(session_path).as_posix()
+                # 旧版context.json的迁移备份与临时文件不再保留
+                if rel.endswith(MIGRATED_SUFFIX) or name.endswith(".tmp"):
+                    continue
+                files.append((rel, full))
+        # meta.json放在最前面，列会话时只需读第一帧
+        files.sort(key=lambda item: (item[0] != META_FILE, item[0]))
+
+        with _open_archive(tmp_archive, "w") as f:
+            f.write(json.dumps({"format": ARCHIVE_FORMAT, "version": 1}) + "\n")
+            for rel, full in files:
+                data = full.read_bytes()
+                frame = {"path": rel, "mtime": full.stat().st_mtime}
+                try:
+                    frame["text"] = data.decode("utf-8")
+                except UnicodeDecodeError:
+                    frame["b64"] = base64.b64encode(data).decode("ascii")
+                f.write(json.dumps(frame, ensure_ascii=False) + "\n")
+        os.replace(tmp_archive, archive)
+        shutil.rmtree(session_path, ignore_errors=True)
+        self.archived += 1
+        return before, archive.stat().st_size
+
+    def rehydrate(self, session_path: Path) -> bool:
+        """把归档解压回会话目录；先解到临时目录再整体rename，避免读到半个目录"""
+        with self._rehydrate_lock:
+            if session_path.is_dir():
+                return True
+            archive = self.find_archive(session_path)
+            if archive is None:
+                return False
+            tmp_dir = Path(tempfile.mkdtemp(prefix=REHYDRATE_PREFIX, dir=session_path.parent))
+            try:
+                with _open_archive(archive, "r") as f:
+                    header = json.loads(f.readline())
+                    if header.get("format") != ARCHIVE_FORMAT:
+                        raise ValueError(f"未知的会话归档格式: {archive}")
+                    for line in f:
+                        frame = json.loads(line)
+                        target = (tmp_dir / frame["path"]).resolve()
+                        if tmp_dir.resolve() not in target.parents:
+                            continue
+                        target.parent.mkdir(parents=True, exist_ok=True)
+                        if "b64" in frame:
+                            target.write_bytes(base64.b64decode(frame["b64"]))
+                        else:
+                            target.write_bytes(frame["text"].encode("utf-8"))
+                        mtime = frame.get("mtime") or 0.0
+                        if mtime:
+                            os.utime(target, (mtime, mtime))
+                # 目录mtime保持为解压时刻，解压即视为一次访问，避免马上被再次归档
+                os.rename(tmp_dir, session_path)
+            except BaseException:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                raise
+            archive.unlink()
+            self.rehydrated += 1
+            print(f"📂 解压归档会话: {session_path.name}")
+            return True
+
+    def read_archived_meta(self, archive: Path) -> Optional[Dict[str, Any]]:
+        """不解压整个归档，只读出meta.json帧"""
+        with _open_archive(archive, "r") as f:
+            f.readline()
+            first = f.readline()
+        if not first:
+            return None
+        frame = json.loads(first)
+        if frame.get("path") != META_FILE:
+            return None
+        return json.loads(frame["text"])
+
+    def read_archived_file(self, archive: Path, rel_path: str) -> Optional[str]:
+        """不解压整个归档，读出其中一个文本文件的内容"""
+        with _open_archive(archive, "r") as f:
+            f.readline()
+            for line in f:
+                frame = json.loads(line)
+                if frame.get("path") == rel_path:
+                    return frame.get("text")
+        return None
+
+    def iter_archives(self) -> Iterator[Tuple[str, Path, Path]]:
+        """遍历已归档的会话，产出 (session_id, 原目录路径, 归档文件)"""
+        roots = [self.base]
+        if self.sharded_root.is_dir():
+            for shard1 in os.scandir(self.sharded_root):
+                if not shard1.is_dir(follow_symlinks=False):
+                    continue
+                for shard2 in os.scandir(shard1.path):
+                    if shard2.is_dir(follow_symlinks=False):
+                        roots.append(Path(shard2.path))
+        for root in roots:
+            if not root.is_dir():
+                continue
+            for entry in os.scandir(root):
+                if not entry.is_file(follow_symlinks=False):
+                    continue
+                for suffix in ARCHIVE_SUFFIXES.values():
+                    if entry.name.endswith(suffix) and not entry.name.startswith("."):
+                        session_id = entry.name[: -len(suffix)]
+                        yield session_id, root / session_id, Path(entry.path)
+
+    def iter_session_paths(self) -> Iterator[Tuple[str, Path]]:
+        """遍历全部会话目录：分片目录 + 含会话标记文件的旧平铺目录"""
+        if self.sharded_root.is_dir():
+            for shard1 in os.scandir(self.sharded_root):
+                if not shard1.is_dir(follow_symlinks=False):
+                    continue
+                for shard2 in os.scandir(shard1.path):
+                    if not shard2.is_dir(follow_symlinks=False):
+                        continue
+                    for entry in os.scandir(shard2.path):
+                        if entry.name.startswith(REHYDRATE_PREFIX):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            yield entry.name, Path(entry.path)
+        if not self.base.is_dir():
+            return
+        for entry in os.scandir(self.base):
+            if entry.name.startswith(REHYDRATE_PREFIX) or not entry.is_dir(follow_symlinks=False):
+                continue
+            path = Path(entry.path)
+            if path == self.sharded_root:
+                continue
+            if any((path / name).exists() for name in SESSION_MARKER_FILES):
+                yield entry.name, path
+
+
+class SessionBackend:
+    """会话存储后端接口（实现类需提供 layout 属性）"""
+
+    name = "base"
+    layout: SessionLayout
+
+    def load(self, session_id: str) -> Optional[SessionData]:
+        """加载 (元数据, 全部消息)，会话不存在时返回None"""
+        raise NotImplementedError
+
+    def write(
+        self,
+        session_id: str,
+        meta: Optional[Dict[str, Any]],
+        messages: List[Dict[str, Any]],
+    ):
+        """追加消息并（可选）替换元数据，两者作为一次写入提交"""
+        raise NotImplementedError
+
+    def write_batch(
+        self,
+        items: List[Tuple[str, Optional[Dict[str, Any]], List[Dict[str, Any]]]],
+    ) -> Dict[int, Exception]:
+        """组提交：写入多个会话，返回 {失败项下标: 异常}；默认逐个调用write"""
+        failed = {}
+        for i, (session_id, meta, messages) in enumerate(items):
+            try:
+                self.write(session_id, meta, messages)
+            except Exception as e:
+                failed[i] = e
+        return failed
+
+    def exists(self, session_id: str) -> bool:
+        raise NotImplementedError
+
+    def fingerprint(self, session_id: str) -> Optional[Tuple]:
+        """数据版本指纹，内容变化时随之变化；不支持时返回None"""
+        return None
+
+    def load_messages(
+        self, session_id: str, offset: int = 0, limit: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """分页读取消息"""
+        raise NotImplementedError
+
+    def load_meta(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """只读取元数据，会话不存在时返回None"""
+        data = self.load(session_id)
+        return None if data is None else data[0]
+
+    def iter_messages(
+        self, session_id: str, batch_size: int = 500
+    ) -> Iterator[Dict[str, Any]]:
+        """按顺序流式读取消息，内存占用与会话长度无关"""
+        offset = 0
+        while True:
+            page = self.load_messages(session_id, offset, batch_size)
+            yield from page
+            if len(page) < batch_size:
+                return
+            offset += len(page)
+
+    def list_sessions(
+        self, username: Optional[str] = None, offset: int = 0, limit: int = 50
+    ) -> List[Dict[str, Any]]:
+        """按最近更新时间倒序列出会话元数据"""
+        raise NotImplementedError
+
+    def iter_session_ids(self) -> Iterator[str]:
+        """遍历全部会话id（含已归档），用于构建存在性索引"""
+        for session_id, _ in self.layout.iter_session_paths():
+            yield session_id
+        for session_id, _, _ in self.layout.iter_archives():
+            yield session_id
+
+    def iter_usage(self) -> Iterator[SessionUsage]:
+        """遍历全部会话的活跃时间与空间占用，供回收器使用"""
+        raise NotImplementedError
+
+    def delete(self, session_id: str) -> int:
+        """删除会话的全部数据（含工作目录），返回释放的字节数"""
+        raise NotImplementedError
+
+    def archive(self, session_id: str) -> Optional[Tuple[int, int]]:
+        """把空闲会话压缩归档，返回 (归档前字节, 归档后字节)；不支持或已归档返回None"""
+        session_path = self.layout.sharded_path(session_id)
+        if not session_path.is_dir():
+            session_path = self.layout.legacy_path(session_id)
+        return self.layout.archive(session_path)
+
+    def close(self):
+        pass
+
+
+class FileSystemBackend(SessionBackend):
+    """会话目录布局的文件系统后端"""
+
+    name = "filesystem"
+
+    def __init__(self, layout: SessionLayout, fsync: bool = False):
+        self.layout = layout
+        self.fsync = fsync
+
+    def path_for(self, session_id: str) -> Path:
+        return self.layout.path_for(session_id)
+
+    # ---- 文件工具 ----
+
+    def _write_json_atomic(self, path: Path, data: Dict[str, Any]):
+        """先写临时文件再替换，避免读到写了一半的元数据"""
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _append_lines(self, path: Path, records: List[Dict[str, Any]]) -> Optional[int]:
+        """以O_APPEND方式追加JSON Lines，一次write完成整批写入，返回写入前的文件长度
+
+        写入失败（含只写入一部分）时截断回写入前的长度，重试这一批不会重复追加。
+        """
+        if not records:
+            return None
+        data = "".join(
+            json.dumps(record, ensure_ascii=False) + "\n" for record in records
+        ).encode("utf-8")
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            start = os.fstat(fd).st_size
+            try:
+                written = os.write(fd, data)
+                if written != len(data):
+                    raise OSError(f"消息日志只写入了 {written}/{len(data)} 字节: {path}")
+                if self.fsync:
+                    os.fsync(fd)
+            except BaseException:
+                os.ftruncate(fd, start)
+                raise
+        finally:
+            os.close(fd)
+        return start
+
+    def _migrate_legacy_context(self, session_path: Path) -> bool:
+        """把旧版context.json迁移为meta.json + messages.jsonl，返回是否发生迁移"""
+        legacy_file = session_path / LEGACY_CONTEXT_FILE
+        meta_file = session_path / META_FILE
+        if meta_file.exists() or not legacy_file.exists():
+            return False
+
+        with open(legacy_file, "r", encoding="utf-8") as f:
+            context = json.load(f)
+
+        messages = context.pop("messages", [])
+        # 先写消息日志再写元数据：meta.json存在即代表迁移完成
+        messages_file = session_path / MESSAGES_FILE
+        if messages_file.exists():
+            messages_file.unlink()
+        self._append_lines(messages_file, messages)
+        self._write_json_atomic(meta_file, context)
+        os.replace(
+            legacy_file, legacy_file.with_name(LEGACY_CONTEXT_FILE + MIGRATED_SUFFIX)
+        )
+
+        print(f"📦 迁移旧版会话上下文: {session_path.name} | Messages: {len(messages)}")
+        return True
+
+    def _load_meta(self, session_path: Path) -> Optional[Dict[str, Any]]:
+        self._migrate_legacy_context(session_path)
+        meta_file = session_path / META_FILE
+        if not meta_file.exists():
+            return None
+        with open(meta_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _read_messages(self, session_path: Path, offset: int = 0, limit: Optional[int] = None):
+        """逐行读取消息日志，跳过崩溃时可能残留的半行"""
+        messages = []
+        messages_file = session_path / MESSAGES_FILE
+        if not messages_file.exists():
+            return messages
+
+        with open(messages_file, "r", encoding="utf-8") as f:
+            for index, message in enumerate(self._parse_lines(f, session_path.name)):
+                if index < offset:
+                    continue
+                messages.append(message)
+                if limit is not None and len(messages) >= limit:
+                    break
+        return messages
+
+    @staticmethod
+    def _parse_lines(lines, name: str) -> Iterator[Dict[str, Any]]:
+        """解析JSON Lines，跳过崩溃时可能残留的半行"""
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                print(f"⚠️ 跳过损坏的消息行: {name}")
+
+    # ---- 后端接口 ----
+
+    def load(self, session_id: str) -> Optional[SessionData]:
+        session_path = self.path_for(session_id)
+        meta = self._load_meta(session_path)
+        if meta is None and not (session_path / MESSAGES_FILE).exists():
+            return None
+        return meta or {}, self._read_messages(session_path)
+
+    def write(self, session_id, meta, messages):
+        """追加消息并替换元数据；任一步失败时撤回已追加的消息，整项可以原样重试"""
+        session_path = self.path_for(session_id)
+        session_path.mkdir(parents=True, exist_ok=True)
+        messages_file = session_path / MESSAGES_FILE
+        start = self._append_lines(messages_file, messages)
+        if meta is not None:
+            try:
+                self._write_json_atomic(session_path / META_FILE, meta)
+            except BaseException:
+                if start is not None:
+                    os.truncate(messages_file, start)
+                raise
+
+    def exists(self, session_id: str) -> bool:
+        # 不解压归档：存在性检查（索引回退）不算一次访问
+        return self.layout.exists(session_id)
+
+    def fingerprint(self, session_id: str) -> Optional[Tuple]:
+        session_path, archive = self.layout.locate(session_id)
+        if archive is not None:
+            # 已归档：以归档文件为指纹，不解压
+            st = os.stat(archive)
+            return ("archived", st.st_mtime_ns, st.st_size)
+        if session_path is None:
+            return (None, None)
+        result = []
+        for name in (META_FILE, MESSAGES_FILE):
+            try:
+                st = os.stat(session_path / name)
+                result.append((st.st_mtime_ns, st.st_size))
+            except OSError:
+                result.append(None)
+        return tuple(result)
+
+    def load_messages(self, session_id, offset=0, limit=None):
+        session_path = self.path_for(session_id)
+        self._migrate_legacy_context(session_path)
+        return self._read_messages(session_path, offset, limit)
+
+    def _find_archived(self, session_id: str) -> Optional[Path]:
+        """会话只以归档形式存在时返回归档文件"""
+        return self.layout.locate(session_id)[1]
+
+    def load_meta(self, session_id):
+        # 归档会话直接读meta帧，不触发解压
+        archive = self._find_archived(session_id)
+        if archive is not None:
+            meta = self.layout.read_archived_meta(archive)
+            if meta is not None:
+                return meta
+        session_path = self.path_for(session_id)
+        meta = self._load_meta(session_path)
+        if meta is None and (session_path / MESSAGES_FILE).exists():
+            return {}
+        return meta
+
+    def iter_messages(self, session_id, batch_size=500):
+        archive = self._find_archived(session_id)
+        if archive is not None:
+            text = self.layout.read_archived_file(archive, MESSAGES_FILE)
+            if text is not None:
+                yield from self._parse_lines(io.StringIO(text), session_id)
+                return
+        session_path = self.path_for(session_id)
+        self._migrate_legacy_context(session_path)
+        messages_file = session_path / MESSAGES_FILE
+        if not messages_file.exists():
+            return
+        with open(messages_file, "r", encoding="utf-8") as f:
+            yield from self._parse_lines(f, session_id)
+
+    def list_sessions(self, username=None, offset=0, limit=50):
+        # 文件系统布局只能全量扫描目录
+        sessions = []
+        for _, session_path in self.layout.iter_session_paths():
+            if not (
+                (session_path / META_FILE).exists()
+                or (session_path / LEGACY_CONTEXT_FILE).exists()
+            ):
+                continue
+            try:
+                meta = self._load_meta(session_path) or {}
+                updated_at = max(
+                    os.stat(path).st_mtime
+                    for path in (session_path / META_FILE, session_path / MESSAGES_FILE)
+                    if path.exists()
+                )
+            except (OSError, ValueError):
+                continue
+            if username is not None and meta.get("username") != username:
+                continue
+            sessions.append((updated_at, meta))
+        for _, _, archive in self.layout.iter_archives():
+            # 归档会话只读meta帧，不触发解压
+            try:
+                meta = self.layout.read_archived_meta(archive) or {}
+                updated_at = archive.stat().st_mtime
+            except (OSError, ValueError):
+                continue
+            if username is not None and meta.get("username") != username:
+                continue
+            sessions.append((updated_at, meta))
+        sessions.sort(key=lambda item: item[0], reverse=True)
+        return [meta for _, meta in sessions[offset:offset + limit]]
+
+    def iter_usage(self):
+        for session_id, session_path in self.layout.iter_session_paths():
+            last_active, total = _dir_usage(session_path)
+            yield session_id, last_active, total, False
+        for session_id, _, archive in self.layout.iter_archives():
+            st = archive.stat()
+            yield session_id, st.st_mtime, st.st_size, True
+
+    def delete(self, session_id):
+        return _delete_session_files(self.layout, session_id)
+
+
+class SQLiteBackend(SessionBackend):
+    """WAL模式SQLite后端：消息追加在单个事务内完成"""
+
+    name = "sqlite"
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS sessions (
+        session_id TEXT PRIMARY KEY,
+        username TEXT,
+        created_at TEXT,
+        updated_at TEXT,
+        claude_session_id TEXT,
+        meta TEXT NOT NULL DEFAULT '{}',
+        message_count INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS idx_sessions_username
+        ON sessions (username, updated_at DESC);
+    CREATE INDEX IF NOT EXISTS idx_sessions_updated_at
+        ON sessions (updated_at DESC);
+    CREATE TABLE IF NOT EXISTS messages (
+        session_id TEXT NOT NULL,
+        seq INTEGER NOT NULL,
+        data TEXT NOT NULL,
+        PRIMARY KEY (session_id, seq)
+    ) WITHOUT ROWID;
+    """
+
+    def __init__(
+        self,
+        db_path: Path,
+        layout: SessionLayout,
+        legacy: Optional[FileSystemBackend] = None,
+        synchronous: str = "NORMAL",
+    ):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # 会话工作目录仍按布局存放
+        self.layout = layout
+        # 旧的目录式会话在首次访问时导入数据库
+        self.legacy = legacy
+        self.synchronous = synchronous
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+
+        conn = self._conn()
+        conn.executescript(self.SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        """每个线程一个连接，WAL模式下读写互不阻塞"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                str(self.db_path), timeout=30, isolation_level=None,
+                check_same_thread=False,
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    @staticmethod
+    def _row_to_meta(row) -> Dict[str, Any]:
+        meta = json.loads(row[0])
+        meta["claude_session_id"] = row[1]
+        return meta
+
+    def _import_legacy(self, session_id: str) -> Optional[SessionData]:
+        if self.legacy is None:
+            return None
+        data = self.legacy.load(session_id)
+        if data is None:
+            return None
+        meta, messages = data
+        self.write(session_id, meta, messages)
+        print(f"📦 导入目录式会话到SQLite: {session_id} | Messages: {len(messages)}")
+        return meta, messages
+
+    def load(self, session_id):
+        conn = self._conn()
+        row = conn.execute(
+            "SELECT meta, claude_session_id FROM sessions WHERE session_id = ?",
+            (session_id,),
+        ).fetchone()
+        if row is None:
+            return self._import_legacy(session_id)
+        return self._row_to_meta(row), self.load_messages(session_id)
+
+    def write(self, session_id, meta, messages):
+        self._write_many([(session_id, meta, messages)])
+
+    def write_batch(self, items):
+        """整批放在一个事务里提交，一次WAL同步覆盖所有会话"""
+        try:
+            self._write_many(items)
+            return {}
+        except Exception as e:
+            return {i: e for i in range(len(items))}
+
+    def _write_many(self, items):
+        conn = self._conn()
+        now = datetime.now().isoformat()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for session_id, meta, messages in items:
+                self._write_locked(conn, now, session_id, meta, messages)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _write_locked(conn, now, session_id, meta, messages):
+        conn.execute(
+            "INSERT OR IGNORE INTO sessions (session_id, created_at, updated_at) "
+            "VALUES (?, ?, ?)",
+            (session_id, now, now),
+        )
+        if meta is not None:
+            conn.execute(
+                "UPDATE sessions SET username = ?, created_at = COALESCE(?, created_at), "
+                "claude_session_id = ?, meta = ?, updated_at = ? WHERE session_id = ?",
+                (
+                    meta.get("username"),
+                    meta.get("created_at"),
+                    meta.get("claude_session_id"),
+                    json.dumps(meta, ensure_ascii=False),
+                    now,
+                    session_id,
+                ),
+            )
+        if messages:
+            (count,) = conn.execute(
+                "SELECT message_count FROM sessions WHERE session_id = ?",
+                (session_id,),
+            ).fetchone()
+            conn.executemany(
+                "INSERT INTO messages (session_id, seq, data) VALUES (?, ?, ?)",
+                [
+                    (session_id, count + i, json.dumps(m, ensure_ascii=False))
+                    for i, m in enumerate(messages)
+                ],
+            )
+            conn.execute(
+                "UPDATE sessions SET message_count = ?, updated_at = ? "
+                "WHERE session_id = ?",
+                (count + len(messages), now, session_id),
+            )
+
+    def exists(self, session_id):
+        row = self._conn().execute(
+            "SELECT 1 FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is not None:
+            return True
+        return self.legacy is not None and self.legacy.exists(session_id)
+
+    def fingerprint(self, session_id):
+        return self._conn().execute(
+            "SELECT message_count, updated_at FROM sessions WHERE session_id = ?",
+            (session_id,),
+        ).fetchone()
+
+    def load_meta(self, session_id):
+        row = self._conn().execute(
+            "SELECT meta, claude_session_id FROM sessions WHERE session_id = ?",
+            (session_id,),
+        ).fetchone()
+        if row is None:
+            data = self._import_legacy(session_id)
+            return None if data is None else data[0]
+        return self._row_to_meta(row)
+
+    def load_messages(self, session_id, offset=0, limit=None):
+        rows = self._conn().execute(
+            "SELECT data FROM messages WHERE session_id = ? AND seq >= ? "
+            "ORDER BY seq LIMIT ?",
+            (session_id, offset, -1 if limit is None else limit),
+        ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def list_sessions(self, username=None, offset=0, limit=50):
+        if username is None:
+            rows = self._conn().execute(
+                "SELECT meta, claude_session_id FROM sessions "
+                "ORDER BY updated_at DESC LIMIT ? OFFSET ?",
+                (limit, offset),
+            ).fetchall()
+        else:
+            rows = self._conn().execute(
+                "SELECT meta, claude_session_id FROM sessions WHERE username = ? "
+                "ORDER BY updated_at DESC LIMIT ? OFFSET ?",
+                (username, limit, offset),
+            ).fetchall()
+        return [self._row_to_meta(row) for row in rows]
+
+    def iter_session_ids(self):
+        for (session_id,) in self._conn().execute("SELECT session_id FROM sessions"):
+            yield session_id
+        # 尚未导入数据库的目录式会话
+        yield from super().iter_session_ids()
+
+    def iter_usage(self):
+        rows = self._conn().execute(
+            "SELECT s.session_id, s.updated_at, COALESCE(SUM(LENGTH(m.data)), 0) "
+            "FROM sessions s LEFT JOIN messages m ON m.session_id = s.session_id "
+            "GROUP BY s.session_id"
+        ).fetchall()
+        seen = set()
+        for session_id, updated_at, db_bytes in rows:
+            seen.add(session_id)
+            try:
+                last_active = datetime.fromisoformat(updated_at).timestamp()
+            except (TypeError, ValueError):
+                last_active = 0.0
+            archived = False
+            dir_active, dir_bytes = 0.0, 0
+            for session_path in (
+                self.layout.sharded_path(session_id),
+                self.layout.legacy_path(session_id),
+            ):
+                if session_path.is_dir():
+                    dir_active, dir_bytes = _dir_usage(session_path)
+                    break
+                archive = self.layout.find_archive(session_path)
+                if archive is not None:
+                    archived = True
+                    dir_bytes = archive.stat().st_size
+                    break
+            yield (
+                session_id, max(last_active, dir_active), db_bytes + dir_bytes, archived
+            )
+        # 数据库中没有记录的工作目录（未导入的旧会话等）
+        for session_id, session_path in self.layout.iter_session_paths():
+            if session_id not in seen:
+                last_active, total = _dir_usage(session_path)
+                yield session_id, last_active, total, False
+        for session_id, _, archive in self.layout.iter_archives():
+            if session_id not in seen:
+                st = archive.stat()
+                yield session_id, st.st_mtime, st.st_size, True
+
+    def delete(self, session_id):
+        conn = self._conn()
+        (db_bytes,) = conn.execute(
+            "SELECT COALESCE(SUM(LENGTH(data)), 0) FROM messages WHERE session_id = ?",
+            (session_id,),
+        ).fetchone()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return db_bytes + _delete_session_files(self.layout, session_id)
+
+    def close(self):
+        with self._connections_lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            self._connections.clear()
+        self._local = threading.local()
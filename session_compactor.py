@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+聊天历史压缩：后台线程为长会话生成滚动摘要
+
+摘要保存在会话元数据的 summary 字段（与消息日志放在一起）：
+    {"text": 摘要, "upto": 已被摘要覆盖的消息条数, "updated_at": 时间}
+load_chat_history 使用 摘要 + 最近 SUMMARY_KEEP_MESSAGES 条原文 构建提示词。
+"""
+
+import asyncio
+import os
+import queue
+import tempfile
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+from session_store import SessionStore
+from ultra_simple_server_paths import (
+    SUMMARY_KEEP_MESSAGES,
+    compaction_listeners,
+    session_store,
+)
+
+# 摘要方式：llm 调用Claude Agent SDK生成，失败时退回 extractive；extractive 截取每条消息开头
+SUMMARY_MODE = os.getenv("PODCAST_SUMMARY_MODE", "llm").lower()
+# 摘要文本的最大字符数
+SUMMARY_MAX_CHARS = int(os.getenv("PODCAST_SUMMARY_MAX_CHARS", "4000"))
+# extractive 模式下每条消息保留的字符数
+SUMMARY_EXCERPT_CHARS = int(os.getenv("PODCAST_SUMMARY_EXCERPT_CHARS", "120"))
+# 单次LLM摘要的超时时间（秒）
+SUMMARY_TIMEOUT = float(os.getenv("PODCAST_SUMMARY_TIMEOUT", "60"))
+# 多worker时领取其他worker登记的压缩请求的间隔（秒）
+SUMMARY_POLL_INTERVAL = float(os.getenv("PODCAST_SUMMARY_POLL_INTERVAL", "5"))
+
+SUMMARY_SYSTEM_PROMPT = """你负责压缩播客编导与用户的对话记录。
+把"已有摘要"和"新对话"合并成一份新的摘要，保留：用户的身份和偏好、播客主题、已经确定的内容和素材、尚未解决的问题。
+只输出摘要正文，不要解释，不超过{max_chars}字。"""
+
+
+def _render(messages: List[Dict[str, Any]], excerpt: Optional[int] = None) -> str:
+    lines = []
+    for msg in messages:
+        content = str(msg.get("content", ""))
+        if excerpt is not None and len(content) > excerpt:
+            content = content[:excerpt] + "…"
+        lines.append(f"{msg.get('role')}: {content}")
+    return "\n".join(lines)
+
+
+def extractive_summary(previous: str, messages: List[Dict[str, Any]]) -> str:
+    """不调用模型的摘要：保留每条消息的开头，超长时丢弃最早的内容"""
+    text = (previous + "\n" if previous else "") + _render(messages, SUMMARY_EXCERPT_CHARS)
+    if len(text) > SUMMARY_MAX_CHARS:
+        text = text[-SUMMARY_MAX_CHARS:]
+        newline = text.find("\n")
+        text = text[newline + 1:] if newline >= 0 else text
+    return text
+
+
+async def _llm_summary_async(previous: str, messages: List[Dict[str, Any]]) -> str:
+    from claude_agent_sdk import query, ClaudeAgentOptions
+    from claude_agent_sdk.types import ResultMessage
+
+    options = ClaudeAgentOptions(
+        system_prompt=SUMMARY_SYSTEM_PROMPT.format(max_chars=SUMMARY_MAX_CHARS),
+        allowed_tools=[],
+        max_turns=1,
+        cwd=tempfile.gettempdir(),
+    )
+    prompt = f"已有摘要：\n{previous or '（无）'}\n\n新对话：\n{_render(messages)}"
+    result = ""
+    async for message in query(prompt=prompt, options=options):
+        if isinstance(message, ResultMessage) and message.result:
+            if getattr(message, "is_error", False):
+                raise RuntimeError(message.result)
+            result = message.result
+    if not result.strip():
+        raise RuntimeError("摘要结果为空")
+    return result.strip()[:SUMMARY_MAX_CHARS]
+
+
+def llm_summary(previous: str, messages: List[Dict[str, Any]]) -> str:
+    """调用Claude Agent SDK生成摘要（在后台线程中运行独立的事件循环）"""
+    return asyncio.run(
+        asyncio.wait_for(_llm_summary_async(previous, messages), SUMMARY_TIMEOUT)
+    )
+
+
+class SessionCompactor:
+    """按需为会话生成滚动摘要的后台任务"""
+
+    def __init__(
+        self,
+        store: SessionStore,
+        keep_messages: int = SUMMARY_KEEP_MESSAGES,
+        mode: str = SUMMARY_MODE,
+        summarize: Optional[Callable[[str, List[Dict[str, Any]]], str]] = None,
+    ):
+        self.store = store
+        self.keep_messages = keep_messages
+        self.mode = mode
+        # 自定义摘要函数 (已有摘要, 新消息) -> 新摘要
+        self.summarize = summarize
+
+        self._queue: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._queued = set()
+        self._queued_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        # 领取其他来源（多worker时是共享状态）登记的压缩请求
+        self._poll: Optional[Callable[[], List[str]]] = None
+
+        self.requested = 0
+        self.polled = 0
+        self.compactions = 0
+        self.summarized_messages = 0
+        self.llm_failures = 0
+        self.extractive_fallbacks = 0
+        self.errors = 0
+        self.stale = 0
+        self.last_seconds = 0.0
+
+    def request(self, session_id: str):
+        """请求压缩一个会话；已在队列中的会话不重复排队"""
+        with self._queued_lock:
+            if session_id in self._queued:
+                return
+            self._queued.add(session_id)
+        self.requested += 1
+        self._queue.put(session_id)
+
+    def _summarize(self, previous: str, messages: List[Dict[str, Any]]) -> str:
+        if self.summarize is not None:
+            return self.summarize(previous, messages)
+        if self.mode == "llm":
+            try:
+                return llm_summary(previous, messages)
+            except Exception as e:
+                self.llm_failures += 1
+                self.extractive_fallbacks += 1
+                print(f"⚠️ LLM摘要失败，改用截取摘要: {str(e)}")
+        return extractive_summary(previous, messages)
+
+    def compact(self, session_id: str) -> bool:
+        """把最近 keep_messages 条之前、尚未摘要的消息并入摘要，返回是否更新"""
+        meta = self.store.get_meta(session_id)
+        if meta is None:
+            return False
+        summary = meta.get("summary") or {}
+        upto = int(summary.get("upto") or 0)
+        since = self.store.get_messages_since(session_id, upto)
+        if since is None:
+            return False
+        pending, total = since
+        cut = total - self.keep_messages
+        if cut <= upto:
+            return False
+
+        start = time.monotonic()
+        text = self._summarize(summary.get("text") or "", pending[: cut - upto])
+        created_at = meta.get("created_at")
+
+        def unchanged(current: Dict[str, Any]) -> bool:
+            # 摘要期间会话可能被删除后重建，或摘要已被其他压缩更新
+            current_upto = int((current.get("summary") or {}).get("upto") or 0)
+            return current.get("created_at") == created_at and current_upto == upto
+
+        written = self.store.update_meta_if(
+            session_id,
+            {
+                "summary": {
+                    "text": text,
+                    "upto": cut,
+                    "updated_at": datetime.now().isoformat(),
+                }
+            },
+            unchanged,
+        )
+        if written is None:
+            self.stale += 1
+            print(f"⚠️ 会话在摘要期间已变化，放弃本次压缩: {session_id}")
+            return False
+        self.last_seconds = time.monotonic() - start
+        self.compactions += 1
+        self.summarized_messages += cut - upto
+        print(f"🗜️ 压缩聊天历史: {session_id} | 摘要覆盖 {cut} 条消息")
+        return True
+
+    def _take(self) -> Optional[str]:
+        if self._poll is None:
+            return self._queue.get()
+        while True:
+            try:
+                return self._queue.get(timeout=SUMMARY_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+            try:
+                session_ids = self._poll()
+            except Exception as e:
+                print(f"⚠️ 领取压缩请求失败: {str(e)}")
+                continue
+            self.polled += len(session_ids)
+            for session_id in session_ids:
+                self.request(session_id)
+
+    def _loop(self):
+        while True:
+            session_id = self._take()
+            if session_id is None:
+                return
+            with self._queued_lock:
+                self._queued.discard(session_id)
+            try:
+                self.compact(session_id)
+            except Exception as e:
+                self.errors += 1
+                print(f"❌ 压缩聊天历史失败: {session_id} | {str(e)}")
+
+    def start(self, poll: Optional[Callable[[], List[str]]] = None):
+        """启动后台线程；poll 返回其他worker登记的待压缩会话，空闲时定期调用"""
+        if self._thread is not None:
+            return
+        self._poll = poll
+        self._thread = threading.Thread(
+            target=self._loop, name="session-compactor", daemon=True
+        )
+        self._thread.start()
+        compaction_listeners.append(self.request)
+
+    def stop(self):
+        if self.request in compaction_listeners:
+            compaction_listeners.remove(self.request)
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self._thread is not None,
+            "mode": self.mode,
+            "keep_messages": self.keep_messages,
+            "queued": self._queue.qsize(),
+            "requested": self.requested,
+            "polled": self.polled,
+            "compactions": self.compactions,
+            "summarized_messages": self.summarized_messages,
+            "llm_failures": self.llm_failures,
+            "extractive_fallbacks": self.extractive_fallbacks,
+            "errors": self.errors,
+            "stale": self.stale,
+            "last_seconds": round(self.last_seconds, 3),
+        }
+
+
+session_compactor = SessionCompactor(session_store)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+会话存在性索引：启动时从存储后端构建，创建/删除时维护，校验会话无需系统调用
+"""
+
+import re
+import threading
+from typing import Any, Callable, Dict, Iterable, Optional
+
+UUID_PATTERN = re.compile(
+    r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$"
+)
+MAX_SESSION_ID_LENGTH = 128
+
+
+class SessionIndex:
+    """已知session_id的内存集合"""
+
+    def __init__(
+        self,
+        strict: bool = False,
+        fallback: Optional[Callable[[str], bool]] = None,
+    ):
+        # strict模式下只接受UUID格式的session_id
+        self.strict = strict
+        # 未命中时的兜底检查（例如多进程部署下其他进程创建的会话），None表示索引即权威
+        self.fallback = fallback
+        self._ids = set()
+        self._lock = threading.Lock()
+        self.ready = False
+
+        self.hits = 0
+        self.misses = 0
+        self.fallback_hits = 0
+        self.rejected_malformed = 0
+
+    def is_well_formed(self, session_id: str) -> bool:
+        """不接触文件系统的格式检查：拒绝路径穿越和超长id，strict模式要求UUID"""
+        if not session_id or len(session_id) > MAX_SESSION_ID_LENGTH:
+            return False
+        if self.strict:
+            return UUID_PATTERN.match(session_id) is not None
+        if session_id in (".", "..") or session_id.startswith("."):
+            return False
+        return not any(ch in session_id for ch in ("/", "\\", "\0"))
+
+    def build(self, session_ids: Iterable[str]):
+        ids = set(session_ids)
+        with self._lock:
+            # 构建期间新建的会话也要保留
+            self._ids |= ids
+            self.ready = True
+
+    def add(self, session_id: str):
+        with self._lock:
+            self._ids.add(session_id)
+
+    def discard(self, session_id: str):
+        with self._lock:
+            self._ids.discard(session_id)
+
+    def exists(self, session_id: str, slow_check: Callable[[str], bool]) -> bool:
+        """判断会话是否存在；索引未构建完成时退回slow_check"""
+        if not self.is_well_formed(session_id):
+            self.rejected_malformed += 1
+            return False
+        if session_id in self._ids:
+            self.hits += 1
+            return True
+        if not self.ready:
+            return slow_check(session_id)
+        self.misses += 1
+        if self.fallback is not None and self.fallback(session_id):
+            self.fallback_hits += 1
+            self.add(session_id)
+            return True
+        return False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready,
+            "strict": self.strict,
+            "fallback": self.fallback is not None,
+            "known_sessions": len(self._ids),
+            "hits": self.hits,
+            "misses": self.misses,
+            "fallback_hits": self.fallback_hits,
+            "rejected_malformed": self.rejected_malformed,
+        }
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+会话写入串行化：按session_id分段（striped）的异步锁
+
+固定数量的锁，内存占用与会话数量无关；同一会话总是落在同一把锁上，
+不同会话偶尔共享一把锁只会带来轻微的排队，不影响正确性。
+"""
+
+import asyncio
+import os
+import zlib
+from concurrent.futures import Executor
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+# 锁分段数量
+SESSION_LOCK_STRIPES = int(os.getenv("PODCAST_SESSION_LOCK_STRIPES", "256"))
+
+
+class SessionLockManager:
+    """按会话分段的异步锁管理器"""
+
+    def __init__(self, stripes: int = SESSION_LOCK_STRIPES):
+        self._locks: List[asyncio.Lock] = [asyncio.Lock() for _ in range(stripes)]
+        self.executor: Optional[Executor] = None
+        self.acquisitions = 0
+        self.contended = 0
+
+    def lock_for(self, session_id: str) -> asyncio.Lock:
+        index = zlib.crc32(session_id.encode("utf-8")) % len(self._locks)
+        return self._locks[index]
+
+    @asynccontextmanager
+    async def hold(self, session_id: str):
+        """持有会话写锁"""
+        lock = self.lock_for(session_id)
+        if lock.locked():
+            self.contended += 1
+        async with lock:
+            self.acquisitions += 1
+            yield
+
+    async def run(self, session_id: str, func: Callable[..., Any], *args: Any) -> Any:
+        """持锁在线程池中执行一个会话写操作"""
+        async with self.hold(session_id):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "stripes": len(self._locks),
+            "locked_stripes": sum(1 for lock in self._locks if lock.locked()),
+            "acquisitions": self.acquisitions,
+            "contended": self.contended,
+        }
+
+
+session_locks = SessionLockManager()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+会话回收器：后台线程按空闲TTL和总占用上限删除旧会话，并把冷会话压缩归档
+"""
+
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from session_store import SessionStore
+from ultra_simple_server_paths import session_store
+
+# 空闲超过该时间（秒）的会话被回收，0表示不按TTL回收
+SESSION_IDLE_TTL = float(os.getenv("PODCAST_SESSION_IDLE_TTL", str(30 * 24 * 3600)))
+# 全部会话的总占用上限（字节），超出时从最久未活跃的会话开始回收，0表示不限制
+SESSIONS_MAX_BYTES = int(os.getenv("PODCAST_SESSIONS_MAX_BYTES", "0"))
+# 回收扫描间隔（秒）
+SESSION_GC_INTERVAL = float(os.getenv("PODCAST_SESSION_GC_INTERVAL", "600"))
+# 按容量回收时，最近这段时间内活跃过的会话不会被删除（秒）
+SESSION_GC_MIN_IDLE = float(os.getenv("PODCAST_SESSION_GC_MIN_IDLE", "3600"))
+# 空闲超过该时间（秒）的会话压缩归档，0表示不归档
+SESSION_ARCHIVE_AFTER = float(os.getenv("PODCAST_SESSION_ARCHIVE_AFTER", str(24 * 3600)))
+
+
+class SessionReaper:
+    """按TTL和容量上限回收会话"""
+
+    def __init__(
+        self,
+        store: SessionStore,
+        idle_ttl: float = SESSION_IDLE_TTL,
+        max_total_bytes: int = SESSIONS_MAX_BYTES,
+        interval: float = SESSION_GC_INTERVAL,
+        min_idle: float = SESSION_GC_MIN_IDLE,
+        archive_after: float = SESSION_ARCHIVE_AFTER,
+        is_active: Optional[Callable[[str], bool]] = None,
+    ):
+        self.store = store
+        self.idle_ttl = idle_ttl
+        self.max_total_bytes = max_total_bytes
+        self.interval = interval
+        self.min_idle = min_idle
+        self.archive_after = archive_after
+        # 额外的活跃判断（例如正在流式输出的会话），返回True的会话跳过
+        self.is_active = is_active
+
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._run_lock = threading.Lock()
+
+        self.passes = 0
+        self.reclaimed_sessions = 0
+        self.reclaimed_bytes = 0
+        self.reclaimed_by_ttl = 0
+        self.reclaimed_by_size = 0
+        self.skipped_active = 0
+        self.archived_sessions = 0
+        self.archived_bytes_before = 0
+        self.archived_bytes_after = 0
+        self.errors = 0
+        self.last_pass_seconds = 0.0
+        self.last_total_bytes = 0
+        self.last_session_count = 0
+
+    def _reclaim(self, session_id: str) -> Optional[int]:
+        if self.is_active is not None and self.is_active(session_id):
+            self.skipped_active += 1
+            return None
+        try:
+            freed = self.store.delete(session_id)
+        except Exception as e:
+            self.errors += 1
+            print(f"❌ 回收会话失败: {session_id} | {str(e)}")
+            return None
+        if freed is None:
+            self.skipped_active += 1
+            return None
+        self.reclaimed_sessions += 1
+        self.reclaimed_bytes += freed
+        return freed
+
+    def _archive(self, session_id: str) -> Optional[int]:
+        """归档一个会话，返回归档后的字节数"""
+        if self.is_active is not None and self.is_active(session_id):
+            self.skipped_active += 1
+            return None
+        try:
+            result = self.store.archive(session_id)
+        except Exception as e:
+            self.errors += 1
+            print(f"❌ 归档会话失败: {session_id} | {str(e)}")
+            return None
+        if result is None:
+            return None
+        before, after = result
+        self.archived_sessions += 1
+        self.archived_bytes_before += before
+        self.archived_bytes_after += after
+        return after
+
+    def run_once(self) -> Dict[str, int]:
+        """执行一轮回收，返回本轮回收的会话数和字节数"""
+        with self._run_lock:
+            start = time.monotonic()
+            now = time.time()
+            usages = list(self.store.backend.iter_usage())
+            total_bytes = sum(usage[2] for usage in usages)
+            reclaimed = 0
+            freed_total = 0
+            archived = 0
+
+            survivors = []
+            for session_id, last_active, size, is_archived in usages:
+                idle = now - last_active
+                if self.idle_ttl and idle > self.idle_ttl:
+                    freed = self._reclaim(session_id)
+                    if freed is not None:
+                        self.reclaimed_by_ttl += 1
+                        reclaimed += 1
+                        freed_total += freed
+                        total_bytes -= size
+                        continue
+                if self.archive_after and not is_archived and idle > self.archive_after:
+                    after = self._archive(session_id)
+                    if after is not None:
+                        archived += 1
+                        total_bytes -= size - after
+                        size = after
+                survivors.append((last_active, session_id, size))
+
+            if self.max_total_bytes and total_bytes > self.max_total_bytes:
+                survivors.sort()
+                for last_active, session_id, size in survivors:
+                    if total_bytes <= self.max_total_bytes:
+                        break
+                    if now - last_active < self.min_idle:
+                        break
+                    freed = self._reclaim(session_id)
+                    if freed is not None:
+                        self.reclaimed_by_size += 1
+                        reclaimed += 1
+                        freed_total += freed
+                        total_bytes -= size
+
+            self.passes += 1
+            self.last_pass_seconds = time.monotonic() - start
+            self.last_total_bytes = total_bytes
+            self.last_session_count = len(usages) - reclaimed
+            if reclaimed:
+                print(f"🧹 回收会话: {reclaimed} 个 | 释放 {freed_total} 字节")
+            if archived:
+                print(f"🗜️ 归档冷会话: {archived} 个")
+            return {"sessions": reclaimed, "bytes": freed_total, "archived": archived}
+
+    def _loop(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                self.errors += 1
+                print(f"❌ 会话回收出错: {str(e)}")
+
+    def start(self):
+        if self._thread is not None or not (
+            self.idle_ttl or self.max_total_bytes or self.archive_after
+        ):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._loop, name="session-reaper", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self._thread is not None,
+            "idle_ttl_seconds": self.idle_ttl,
+            "max_total_bytes": self.max_total_bytes,
+            "interval_seconds": self.interval,
+            "passes": self.passes,
+            "reclaimed_sessions": self.reclaimed_sessions,
+            "reclaimed_bytes": self.reclaimed_bytes,
+            "reclaimed_by_ttl": self.reclaimed_by_ttl,
+            "reclaimed_by_size": self.reclaimed_by_size,
+            "skipped_active": self.skipped_active,
+            "archive_after_seconds": self.archive_after,
+            "archived_sessions": self.archived_sessions,
+            "archived_bytes_before": self.archived_bytes_before,
+            "archived_bytes_after": self.archived_bytes_after,
+            "rehydrated_sessions": self.store.backend.layout.rehydrated,
+            "errors": self.errors,
+            "last_pass_seconds": round(self.last_pass_seconds, 3),
+            "last_total_bytes": self.last_total_bytes,
+            "last_session_count": self.last_session_count,
+        }
+
+
+session_reaper = SessionReaper(session_store)
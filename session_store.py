@@ -0,0 +1,637 @@
+#!/usr/bin/env python3
+"""
+会话内存缓存：热会话常驻内存，按字节预算LRU淘汰，脏数据由后台线程写回
+
+写回采用组提交（group commit）：所有会话的待写消息合并成一批，由后端一次提交。
+默认写入只保证在 flush_interval 内落盘；调用方可以要求等待本次写入持久化。
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from latency_stats import LatencyWindow
+from session_backends import SessionBackend
+
+# 单条消息之外的固定开销估算（dict、时间戳等）
+_MESSAGE_OVERHEAD = 96
+_ENTRY_OVERHEAD = 512
+# _try_get_entry：会话正在删除/归档，需要重新取
+_REMOVING = object()
+
+
+def _estimate_message_bytes(message: Dict[str, Any]) -> int:
+    return _MESSAGE_OVERHEAD + len(str(message.get("content", ""))) * 2
+
+
+class _SessionEntry:
+    __slots__ = (
+        "meta", "messages", "pending", "meta_dirty", "flushing", "size",
+        "rendered", "rendered_count", "fingerprint",
+    )
+
+    def __init__(
+        self,
+        meta: Dict[str, Any],
+        messages: List[Dict[str, Any]],
+        fingerprint: Optional[Tuple] = None,
+    ):
+        self.meta = meta
+        self.messages = messages
+        self.pending: List[Dict[str, Any]] = []
+        self.meta_dirty = False
+        # 正在被写回线程提交，提交完成前不能淘汰
+        self.flushing = False
+        self.size = _ENTRY_OVERHEAD + sum(_estimate_message_bytes(m) for m in messages)
+        # 已渲染的对话文本及其覆盖的消息条数，消息只追加，新消息到来时原地扩展
+        self.rendered = ""
+        self.rendered_count = 0
+        # 加载/写回时后端数据的指纹，用于发现其他进程的修改
+        self.fingerprint = fingerprint
+
+    @property
+    def dirty(self) -> bool:
+        return self.meta_dirty or bool(self.pending) or self.flushing
+
+
+class SessionStore:
+    """热会话缓存 + 写回（write-behind）持久化"""
+
+    def __init__(
+        self,
+        backend: SessionBackend,
+        max_bytes: int = 64 * 1024 * 1024,
+        flush_interval: float = 1.0,
+        revalidate: bool = False,
+        group_commit_window: float = 0.005,
+        group_commit_max_batch: int = 256,
+        durable_timeout: float = 10.0,
+    ):
+        self.backend = backend
+        self.max_bytes = max_bytes
+        # 脏数据最长在内存中停留的时间（秒）
+        self.flush_interval = flush_interval
+        # 命中缓存时是否比对后端指纹（mtime/size 或行数），用于多写者场景
+        self.revalidate = revalidate
+        # 被唤醒后等待的合并窗口（秒），让并发写入进入同一批提交
+        self.group_commit_window = group_commit_window
+        # 待写消息累计到该数量时立即提交
+        self.group_commit_max_batch = group_commit_max_batch
+        # durable写入等待落盘的最长时间（秒）
+        self.durable_timeout = durable_timeout
+
+        self._entries: "OrderedDict[str, _SessionEntry]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+        # 正在从后端删除/归档的会话：期间不从后端加载、不写入，结束时通知等待者
+        self._removing: Set[str] = set()
+        self._removed = threading.Condition(self._lock)
+        # 串行化所有落盘操作，保证同一会话的追加顺序
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._flusher: Optional[threading.Thread] = None
+        # 写入序号：每次追加/元数据更新分配一个；已持久化的最大序号
+        self._write_seq = 0
+        self._durable_seq = 0
+        self._pending_count = 0
+        self._durable_cond = threading.Condition()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.batch_messages_total = 0
+        self.max_batch_messages = 0
+        self.max_batch_sessions = 0
+        self.durable_waits = 0
+        self._flush_latencies = LatencyWindow()
+        self._durable_wait_latencies = LatencyWindow()
+        self.invalidations = 0
+        self.render_extends = 0
+        # 会话被删除后的回调（例如维护存在性索引）
+        self.delete_listeners: List[Callable[[str], None]] = []
+
+    # ---- 内部工具 ----
+
+    def _ensure_flusher(self):
+        if self._flusher is None and not self._closed:
+            self._flusher = threading.Thread(
+                target=self._flush_loop, name="session-store-flusher", daemon=True
+            )
+            self._flusher.start()
+
+    def _flush_loop(self):
+        while not self._closed:
+            triggered = self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            if triggered and self.group_commit_window > 0 and not self._closed:
+                # 被提前唤醒（有人等待持久化或批次已满）时稍等，合并更多写入
+                time.sleep(self.group_commit_window)
+            try:
+                self.flush()
+                with self._lock:
+                    self._evict_locked()
+            except Exception as e:
+                print(f"❌ 会话写回失败: {str(e)}")
+
+    def _drop_locked(self, session_id: str):
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def _is_stale(self, session_id: str, entry: _SessionEntry) -> bool:
+        """干净的缓存项若后端指纹已变化，说明被其他写者修改过"""
+        if not self.revalidate or entry.dirty:
+            return False
+        return self.backend.fingerprint(session_id) != entry.fingerprint
+
+    def _wait_removal_locked(self, session_id: str):
+        while session_id in self._removing:
+            self._removed.wait()
+
+    def _get_entry(self, session_id: str) -> Optional[_SessionEntry]:
+        while True:
+            entry = self._try_get_entry(session_id)
+            if entry is not _REMOVING:
+                return entry
+
+    def _try_get_entry(self, session_id: str):
+        with self._lock:
+            self._wait_removal_locked(session_id)
+            entry = self._entries.get(session_id)
+        if entry is not None:
+            if not self._is_stale(session_id, entry):
+                with self._lock:
+                    if session_id in self._entries:
+                        self._entries.move_to_end(session_id)
+                    self.hits += 1
+                return entry
+            with self._lock:
+                if self._entries.get(session_id) is entry and not entry.dirty:
+                    self._drop_locked(session_id)
+                    self.invalidations += 1
+
+        # 先取指纹再加载：两者之间的修改会在下次访问时再次触发失效
+        fingerprint = self.backend.fingerprint(session_id) if self.revalidate else None
+        loaded = self.backend.load(session_id)
+        if loaded is None:
+            return None
+
+        with self._lock:
+            if session_id in self._removing:
+                # 加载期间开始删除/归档，读到的可能是一半的数据，等结束后重新取
+                return _REMOVING
+            # 加载期间可能已被其他线程放入缓存
+            entry = self._entries.get(session_id)
+            if entry is None:
+                self.misses += 1
+                entry = _SessionEntry(*loaded, fingerprint=fingerprint)
+                self._entries[session_id] = entry
+                self._bytes += entry.size
+                self._evict_locked(keep=session_id)
+            else:
+                self._entries.move_to_end(session_id)
+            return entry
+
+    @contextmanager
+    def _locked_entry(self, session_id: str, defaults: Optional[Dict[str, Any]] = None):
+        """取得会话的缓存项并持有缓存锁，用于修改缓存项
+
+        _get_entry 返回后、加锁前，干净的缓存项可能被淘汰、因失效被丢弃或被归档/删除，
+        改到这样的游离缓存项上的数据永远不会写回；因此加锁后确认它仍在缓存中，否则重新取。
+        会话不存在时：defaults 不为None则用它初始化一个空会话，否则产出None。
+        """
+        while True:
+            entry = self._get_entry(session_id)
+            with self._lock:
+                if session_id in self._removing:
+                    continue
+                current = self._entries.get(session_id)
+                if entry is None and current is None:
+                    if defaults is None:
+                        yield None
+                        return
+                    entry = _SessionEntry(dict(defaults), [])
+                    self._entries[session_id] = entry
+                    self._bytes += entry.size
+                    current = entry
+                if current is entry:
+                    # 标记为脏（pending/meta_dirty）之后就不会再被淘汰
+                    yield entry
+                    return
+
+    def _evict_locked(self, keep: Optional[str] = None):
+        """淘汰最久未使用的干净会话；脏会话交给写回线程处理后再淘汰"""
+        skipped_dirty = False
+        for session_id in list(self._entries):
+            if self._bytes <= self.max_bytes:
+                break
+            if session_id == keep:
+                continue
+            entry = self._entries[session_id]
+            if entry.dirty:
+                skipped_dirty = True
+                continue
+            del self._entries[session_id]
+            self._bytes -= entry.size
+            self.evictions += 1
+        if skipped_dirty and self._bytes > self.max_bytes:
+            self._wakeup.set()
+
+    def _next_seq_locked(self) -> int:
+        self._write_seq += 1
+        self._pending_count += 1
+        if self._pending_count >= self.group_commit_max_batch:
+            self._wakeup.set()
+        return self._write_seq
+
+    def _mark_dirty(self, seq: int, durable: bool):
+        with self._lock:
+            self._ensure_flusher()
+        if durable and not self.wait_durable(seq, self.durable_timeout):
+            raise TimeoutError(f"会话写入未能在 {self.durable_timeout}s 内落盘")
+
+    # ---- 对外接口 ----
+
+    def create(self, session_id: str, meta: Dict[str, Any]):
+        """创建会话：元数据同步写入，保证会话目录立即可用"""
+        self.backend.write(session_id, dict(meta), [])
+        fingerprint = self.backend.fingerprint(session_id) if self.revalidate else None
+        entry = _SessionEntry(dict(meta), [], fingerprint=fingerprint)
+        with self._lock:
+            self._drop_locked(session_id)
+            self._entries[session_id] = entry
+            self._bytes += entry.size
+            self._evict_locked(keep=session_id)
+
+    def get_meta(self, session_id: str) -> Optional[Dict[str, Any]]:
+        entry = self._get_entry(session_id)
+        if entry is None:
+            return None
+        with self._lock:
+            return dict(entry.meta)
+
+    def get_messages(self, session_id: str) -> Optional[List[Dict[str, Any]]]:
+        entry = self._get_entry(session_id)
+        if entry is None:
+            return None
+        with self._lock:
+            return list(entry.messages)
+
+    def message_count(self, session_id: str) -> Optional[int]:
+        entry = self._get_entry(session_id)
+        if entry is None:
+            return None
+        with self._lock:
+            return len(entry.messages)
+
+    def get_messages_since(
+        self, session_id: str, offset: int
+    ) -> Optional[Tuple[List[Dict[str, Any]], int]]:
+        """返回 offset 之后的消息副本和消息总数，避免复制整段历史"""
+        entry = self._get_entry(session_id)
+        if entry is None:
+            return None
+        with self._lock:
+            return list(entry.messages[offset:]), len(entry.messages)
+
+    def get_rendered(
+        self, session_id: str, render: Callable[[Dict[str, Any]], str]
+    ) -> Optional[Tuple[Dict[str, Any], str]]:
+        """返回 (元数据, 渲染后的消息文本)；只渲染上次之后新增的消息"""
+        entry = self._get_entry(session_id)
+        if entry is None:
+            return None
+        with self._lock:
+            if entry.rendered_count < len(entry.messages):
+                new_part = "".join(
+                    render(m) for m in entry.messages[entry.rendered_count:]
+                )
+                entry.rendered += new_part
+                entry.rendered_count = len(entry.messages)
+                entry.size += len(new_part) * 2
+                if self._entries.get(session_id) is entry:
+                    self._bytes += len(new_part) * 2
+                self.render_extends += 1
+            return dict(entry.meta), entry.rendered
+
+    def append_message(
+        self,
+        session_id: str,
+        message: Dict[str, Any],
+        durable: bool = False,
+        counters: Optional[Dict[str, int]] = None,
+    ) -> int:
+        """追加消息，返回写入序号；durable=True时等到该消息随某一批提交落盘
+
+        counters 为 {元数据键: 增量}，与追加在同一次加锁内累加到已有的计数器上；
+        计数器还不存在时不创建，留给 counter_meta 回填（回填时已包含这条消息）。
+        """
+        size = _estimate_message_bytes(message)
+        # 没有任何持久化数据的会话，按空会话处理
+        with self._locked_entry(session_id, defaults={}) as entry:
+            entry.messages.append(message)
+            entry.pending.append(message)
+            entry.size += size
+            for key, amount in (counters or {}).items():
+                if amount and key in entry.meta:
+                    entry.meta[key] += amount
+                    entry.meta_dirty = True
+            self._bytes += size
+            self._evict_locked(keep=session_id)
+            seq = self._next_seq_locked()
+        self._mark_dirty(seq, durable)
+        return seq
+
+    def update_meta(
+        self,
+        session_id: str,
+        updates: Dict[str, Any],
+        defaults: Optional[Dict[str, Any]] = None,
+        durable: bool = False,
+    ) -> int:
+        """更新元数据；会话不存在时用defaults初始化"""
+        with self._locked_entry(session_id, defaults=defaults or {}) as entry:
+            entry.meta.update(updates)
+            entry.meta_dirty = True
+            seq = self._next_seq_locked()
+        self._mark_dirty(seq, durable)
+        return seq
+
+    def update_meta_if(
+        self,
+        session_id: str,
+        updates: Dict[str, Any],
+        check: Callable[[Dict[str, Any]], bool],
+    ) -> Optional[int]:
+        """在缓存锁内重新读取元数据，check通过才更新；会话不存在或check不通过返回None
+
+        用于基于较早读到的元数据、经过耗时计算后的写入：期间会话被删除或元数据被改过时放弃写入。
+        """
+        with self._locked_entry(session_id) as entry:
+            if entry is None or not check(entry.meta):
+                return None
+            entry.meta.update(updates)
+            entry.meta_dirty = True
+            seq = self._next_seq_locked()
+        self._mark_dirty(seq, False)
+        return seq
+
+    def counter_meta(
+        self,
+        session_id: str,
+        key: str,
+        compute: Callable[[List[Dict[str, Any]]], int],
+    ) -> Optional[int]:
+        """读取元数据中的计数器：缺失时用全部消息计算一次（惰性回填）
+
+        之后的累加由 append_message(counters=...) 与追加消息在同一次加锁内完成，
+        回填和累加不会重复计算同一条消息。
+        """
+        with self._locked_entry(session_id) as entry:
+            if entry is None:
+                return None
+            if key in entry.meta:
+                return entry.meta[key]
+            entry.meta[key] = compute(entry.messages)
+            value = entry.meta[key]
+            entry.meta_dirty = True
+            seq = self._next_seq_locked()
+        self._mark_dirty(seq, False)
+        return value
+
+    def get_messages_page(
+        self, session_id: str, offset: int = 0, limit: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """分页读取消息：热会话直接切片，冷会话交给后端分页查询"""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None:
+                end = None if limit is None else offset + limit
+                return list(entry.messages[offset:end])
+        # 不在缓存中的会话没有未写回的数据，后端即为最新
+        return self.backend.load_messages(session_id, offset, limit)
+
+    def list_sessions(
+        self, username: Optional[str] = None, offset: int = 0, limit: int = 50
+    ) -> List[Dict[str, Any]]:
+        """列出会话元数据，缓存中尚未写回的元数据优先"""
+        sessions = self.backend.list_sessions(username, offset, limit)
+        with self._lock:
+            for i, meta in enumerate(sessions):
+                entry = self._entries.get(meta.get("session_id"))
+                if entry is not None:
+                    sessions[i] = dict(entry.meta)
+        return sessions
+
+    @contextmanager
+    def _removal(self, session_id: str):
+        """删除/归档期间持有写回锁并登记会话：写回不会写进正在删除的目录，
+        并发的读写等操作结束后再从后端加载。产出False表示有未写回数据，不执行。
+        """
+        with self._flush_lock:
+            with self._lock:
+                entry = self._entries.get(session_id)
+                if entry is not None and entry.dirty:
+                    yield False
+                    return
+                self._drop_locked(session_id)
+                self._removing.add(session_id)
+            try:
+                yield True
+            finally:
+                with self._lock:
+                    self._removing.discard(session_id)
+                    self._removed.notify_all()
+
+    def delete(self, session_id: str) -> Optional[int]:
+        """删除会话（缓存 + 后端）；有未写回数据的会话视为活跃，不删除并返回None"""
+        with self._removal(session_id) as idle:
+            if not idle:
+                return None
+            freed = self.backend.delete(session_id)
+        for listener in self.delete_listeners:
+            listener(session_id)
+        return freed
+
+    def archive(self, session_id: str) -> Optional[Tuple[int, int]]:
+        """压缩归档冷会话并移出缓存；有未写回数据时不归档"""
+        with self._removal(session_id) as idle:
+            if not idle:
+                return None
+            return self.backend.archive(session_id)
+
+    def bulk_load(
+        self,
+        items: List[Tuple[str, Optional[Dict[str, Any]], List[Dict[str, Any]]]],
+        replace: Optional[Set[str]] = None,
+    ) -> Dict[int, Exception]:
+        """批量导入：绕过缓存直接组提交到后端，返回 {失败项下标: 异常}
+
+        replace 中的会话先从后端删除再写入，删除和写入在同一次持有写回锁期间完成，
+        期间的读写等到结束后再加载；有未写回数据的会话不替换，对应的项记为失败。
+        导入的会话若已在缓存中（且没有未写回数据），同时移出缓存，下次访问从后端重新加载。
+        """
+        replace = replace or set()
+        with self._flush_lock:
+            with self._lock:
+                busy = {
+                    session_id for session_id in replace
+                    if session_id in self._entries and self._entries[session_id].dirty
+                }
+                removing = replace - busy
+                for session_id in removing:
+                    self._drop_locked(session_id)
+                self._removing |= removing
+            try:
+                for session_id in removing:
+                    self.backend.delete(session_id)
+                    for listener in self.delete_listeners:
+                        listener(session_id)
+                indexes = [i for i, item in enumerate(items) if item[0] not in busy]
+                written = self.backend.write_batch([items[i] for i in indexes])
+            finally:
+                with self._lock:
+                    self._removing -= removing
+                    self._removed.notify_all()
+        failed = {indexes[i]: error for i, error in written.items()}
+        for i, (session_id, _, _) in enumerate(items):
+            if session_id in busy:
+                failed[i] = RuntimeError("会话正在写入，未替换")
+        with self._lock:
+            for session_id, _, _ in items:
+                entry = self._entries.get(session_id)
+                if entry is not None and not entry.dirty:
+                    self._drop_locked(session_id)
+        return failed
+
+    def flush(self) -> bool:
+        """组提交：把所有会话的待写数据合并为一批写回，返回是否全部成功"""
+        with self._flush_lock:
+            with self._lock:
+                batch_seq = self._write_seq
+                self._pending_count = 0
+                batch = []
+                for session_id, entry in self._entries.items():
+                    if not (entry.pending or entry.meta_dirty):
+                        continue
+                    pending, entry.pending = entry.pending, []
+                    meta = dict(entry.meta) if entry.meta_dirty else None
+                    entry.meta_dirty = False
+                    entry.flushing = True
+                    batch.append((session_id, entry, meta, pending))
+
+            failed = {}
+            if batch:
+                start = time.perf_counter()
+                try:
+                    failed = self.backend.write_batch(
+                        [(sid, meta, pending) for sid, _, meta, pending in batch]
+                    )
+                except Exception as e:
+                    failed = {i: e for i in range(len(batch))}
+                elapsed = time.perf_counter() - start
+
+                fingerprints = {}
+                if self.revalidate:
+                    for i, (sid, _, _, _) in enumerate(batch):
+                        if i not in failed:
+                            fingerprints[sid] = self.backend.fingerprint(sid)
+
+                messages = sum(len(pending) for _, _, _, pending in batch)
+                with self._lock:
+                    for i, (sid, entry, meta, pending) in enumerate(batch):
+                        entry.flushing = False
+                        if i in failed:
+                            # 写回失败则放回队列，下一轮重试
+                            entry.pending[:0] = pending
+                            if meta is not None:
+                                entry.meta_dirty = True
+                        elif sid in fingerprints:
+                            entry.fingerprint = fingerprints[sid]
+                    self.flushes += 1
+                    self.batch_messages_total += messages
+                    self.max_batch_messages = max(self.max_batch_messages, messages)
+                    self.max_batch_sessions = max(self.max_batch_sessions, len(batch))
+                    self._flush_latencies.record(elapsed)
+
+            if failed:
+                self.flush_errors += 1
+                first_error = next(iter(failed.values()))
+                print(f"❌ 会话组提交失败: {len(failed)}/{len(batch)} | {str(first_error)}")
+                return False
+
+            with self._durable_cond:
+                self._durable_seq = max(self._durable_seq, batch_seq)
+                self._durable_cond.notify_all()
+            return True
+
+    def wait_durable(self, seq: int, timeout: Optional[float] = None) -> bool:
+        """等待写入序号seq所在的批次提交完成"""
+        start = time.perf_counter()
+        deadline = None if timeout is None else start + timeout
+        self._wakeup.set()
+        with self._durable_cond:
+            while self._durable_seq < seq:
+                if self._flusher is None or self._closed:
+                    # 没有写回线程时由调用方自己提交
+                    self._durable_cond.release()
+                    try:
+                        self.flush()
+                    finally:
+                        self._durable_cond.acquire()
+                    if self._durable_seq >= seq:
+                        break
+                remaining = None if deadline is None else deadline - time.perf_counter()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._durable_cond.wait(
+                    self.flush_interval if remaining is None else min(remaining, self.flush_interval)
+                )
+        self.durable_waits += 1
+        self._durable_wait_latencies.record(time.perf_counter() - start)
+        return True
+
+    def close(self):
+        """停止后台写回线程并写回全部脏数据"""
+        self._closed = True
+        self._wakeup.set()
+        if self._flusher is not None:
+            self._flusher.join(timeout=max(self.flush_interval * 2, 1.0))
+        self.flush()
+        self.backend.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            dirty = sum(1 for e in self._entries.values() if e.dirty)
+            return {
+                "backend": self.backend.name,
+                "cached_sessions": len(self._entries),
+                "cached_bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "dirty_sessions": dirty,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "render_extends": self.render_extends,
+                "flush_interval": self.flush_interval,
+                "group_commit": {
+                    "window_ms": round(self.group_commit_window * 1000, 3),
+                    "max_batch": self.group_commit_max_batch,
+                    "batches": self.flushes,
+                    "errors": self.flush_errors,
+                    "avg_batch_messages": round(
+                        self.batch_messages_total / self.flushes, 2
+                    ) if self.flushes else 0,
+                    "max_batch_messages": self.max_batch_messages,
+                    "max_batch_sessions": self.max_batch_sessions,
+                    "flush_latency_ms": self._flush_latencies.snapshot(),
+                    "durable_waits": self.durable_waits,
+                    "durable_wait_ms": self._durable_wait_latencies.snapshot(),
+                },
+            }
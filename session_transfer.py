@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+会话导出/导入：NDJSON流式格式，内存占用与会话数量和长度无关
+
+每行一个JSON对象：
+    {"type": "export", "format": "podcast-session-export", "version": 1, ...}
+    {"type": "session", "session_id": "...", "meta": {...}}
+    {"type": "message", "session_id": "...", "message": {...}}   # 紧跟所属会话
+    {"type": "end", "sessions": 2, "messages": 10}
+"""
+
+import json
+import os
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from ultra_simple_server_paths import (
+    init_session_workspace,
+    session_index,
+    session_store,
+)
+
+EXPORT_FORMAT = "podcast-session-export"
+EXPORT_VERSION = 1
+# 导出时每次交给响应的块大小（字节）
+EXPORT_CHUNK_BYTES = int(os.getenv("PODCAST_EXPORT_CHUNK_BYTES", str(64 * 1024)))
+# 导入时累计多少条消息提交一批
+IMPORT_BATCH_MESSAGES = int(os.getenv("PODCAST_IMPORT_BATCH_MESSAGES", "1000"))
+# 导入流中单行的最大长度（字节），超出视为格式错误
+IMPORT_MAX_LINE_BYTES = int(os.getenv("PODCAST_IMPORT_MAX_LINE_BYTES", str(16 * 1024 * 1024)))
+
+
+def _line(record: Dict[str, Any]) -> bytes:
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def select_sessions(
+    username: Optional[str] = None,
+    created_after: Optional[str] = None,
+    created_before: Optional[str] = None,
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """按条件筛选会话，逐个产出 (session_id, 元数据)；created_* 为ISO时间字符串"""
+    backend = session_store.backend
+    seen = set()
+    for session_id in backend.iter_session_ids():
+        if session_id in seen:
+            continue
+        seen.add(session_id)
+        meta = backend.load_meta(session_id)
+        if meta is None:
+            continue
+        if username is not None and meta.get("username") != username:
+            continue
+        created_at = meta.get("created_at") or ""
+        if created_after is not None and created_at < created_after:
+            continue
+        if created_before is not None and created_at >= created_before:
+            continue
+        yield session_id, meta
+
+
+def iter_export(sessions: Iterable[Tuple[str, Dict[str, Any]]]) -> Iterator[bytes]:
+    """把会话序列编码为NDJSON，按 EXPORT_CHUNK_BYTES 聚合成块产出"""
+    # 先把缓存里未写回的数据提交，导出直接读后端
+    session_store.flush()
+    backend = session_store.backend
+
+    buffer = [_line({
+        "type": "export",
+        "format": EXPORT_FORMAT,
+        "version": EXPORT_VERSION,
+        "exported_at": datetime.now().isoformat(),
+    })]
+    size = len(buffer[0])
+    session_count = 0
+    message_count = 0
+
+    for session_id, meta in sessions:
+        data = _line({"type": "session", "session_id": session_id, "meta": meta})
+        buffer.append(data)
+        size += len(data)
+        session_count += 1
+        for message in backend.iter_messages(session_id):
+            data = _line({"type": "message", "session_id": session_id, "message": message})
+            buffer.append(data)
+            size += len(data)
+            message_count += 1
+            if size >= EXPORT_CHUNK_BYTES:
+                yield b"".join(buffer)
+                buffer, size = [], 0
+        if size >= EXPORT_CHUNK_BYTES:
+            yield b"".join(buffer)
+            buffer, size = [], 0
+
+    buffer.append(_line({"type": "end", "sessions": session_count, "messages": message_count}))
+    yield b"".join(buffer)
+
+
+def export_session(session_id: str) -> Iterator[bytes]:
+    """导出单个会话"""
+    meta = session_store.get_meta(session_id)
+    if meta is None:
+        return iter_export([])
+    return iter_export([(session_id, dict(meta))])
+
+
+class SessionImporter:
+    """逐行消费NDJSON导出流，按批组提交到会话存储"""
+
+    def __init__(self, on_conflict: str = "skip", batch_messages: int = IMPORT_BATCH_MESSAGES):
+        if on_conflict not in ("skip", "replace"):
+            raise ValueError(f"未知的冲突策略: {on_conflict}")
+        # skip 保留已有会话；replace 在新数据提交时删除已有会话
+        self.on_conflict = on_conflict
+        self.batch_messages = batch_messages
+
+        self._current: Optional[str] = None
+        self._accepting = False
+        self._pending: List[Tuple[str, Optional[Dict[str, Any]], List[Dict[str, Any]]]] = []
+        self._pending_messages = 0
+        # 待提交批次中要替换已有会话的session_id；替换的会话整段缓冲，不跨批提交
+        self._replacing: Set[str] = set()
+
+        self.lines = 0
+        self.sessions_imported = 0
+        self.sessions_skipped = 0
+        self.messages_imported = 0
+        self.errors: List[str] = []
+
+    def _error(self, message: str):
+        # 只保留前若干条错误，避免大批量坏数据占满内存
+        if len(self.errors) < 100:
+            self.errors.append(message)
+
+    def _commit(self):
+        if not self._pending:
+            return
+        failed = session_store.bulk_load(self._pending, replace=self._replacing)
+        for i, (session_id, meta, messages) in enumerate(self._pending):
+            if i in failed:
+                self._error(f"{session_id}: 写入失败 {failed[i]}")
+                continue
+            self.messages_imported += len(messages)
+            if meta is not None:
+                init_session_workspace(session_id, meta)
+                session_index.add(session_id)
+                self.sessions_imported += 1
+        self._discard_pending()
+
+    def _discard_pending(self):
+        self._pending = []
+        self._pending_messages = 0
+        self._replacing = set()
+
+    def _start_session(self, session_id: Any, meta: Any):
+        self._current = None
+        self._accepting = False
+        if not isinstance(session_id, str) or not session_index.is_well_formed(session_id):
+            self._error(f"非法的session_id: {session_id!r}")
+            return
+        if not isinstance(meta, dict):
+            meta = {}
+
+        # 上一个会话是替换时推迟了提交，到这里整段写入
+        if self._pending_messages >= self.batch_messages:
+            self._commit()
+        if session_store.backend.exists(session_id):
+            if self.on_conflict == "skip":
+                self.sessions_skipped += 1
+                return
+            # 已有会话不在这里删除：与新数据在同一次提交中替换，导入中止时原会话保持不变
+            self._replacing.add(session_id)
+
+        self._pending.append((session_id, {**meta, "session_id": session_id}, []))
+        self._current = session_id
+        self._accepting = True
+
+    def _add_message(self, session_id: Any, message: Any):
+        if not self._accepting or session_id != self._current:
+            return
+        if not isinstance(message, dict):
+            self._error(f"{session_id}: 忽略非对象消息")
+            return
+        last_id, _, messages = self._pending[-1] if self._pending else (None, None, None)
+        if last_id != session_id:
+            # 上一批已提交，同一会话的后续消息开新的一项
+            messages = []
+            self._pending.append((session_id, None, messages))
+        messages.append(message)
+        self._pending_messages += 1
+        if self._pending_messages >= self.batch_messages and session_id not in self._replacing:
+            self._commit()
+
+    def feed(self, lines: Iterable[bytes]):
+        """消费一批NDJSON行（可在线程池中调用）"""
+        for raw in lines:
+            raw = raw.strip()
+            if not raw:
+                continue
+            self.lines += 1
+            try:
+                record = json.loads(raw)
+            except ValueError:
+                self._error(f"第{self.lines}行不是合法JSON")
+                continue
+            if not isinstance(record, dict):
+                self._error(f"第{self.lines}行不是JSON对象")
+                continue
+            kind = record.get("type")
+            if kind == "session":
+                self._start_session(record.get("session_id"), record.get("meta"))
+            elif kind == "message":
+                self._add_message(record.get("session_id"), record.get("message"))
+            elif kind == "export":
+                if record.get("format") != EXPORT_FORMAT:
+                    raise ValueError(f"未知的导出格式: {record.get('format')}")
+
+    def finish(self) -> Dict[str, Any]:
+        """提交剩余数据并返回导入结果"""
+        self._commit()
+        return self.result()
+
+    def abort(self) -> Dict[str, Any]:
+        """丢弃尚未提交的数据并返回已提交部分的结果（导入出错时调用）"""
+        self._discard_pending()
+        self._current = None
+        self._accepting = False
+        return self.result()
+
+    def result(self) -> Dict[str, Any]:
+        return {
+            "lines": self.lines,
+            "sessions_imported": self.sessions_imported,
+            "sessions_skipped": self.sessions_skipped,
+            "messages_imported": self.messages_imported,
+            "errors": self.errors,
+        }
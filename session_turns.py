@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+会话轮次调度：同一会话的聊天请求一次只执行一个
+
+- 重复请求合并到正在执行（或排队中）的同一次执行，回放其输出：
+    带 Idempotency-Key 的请求与键和内容都相同的请求合并（前端重试）；
+    不带键的请求只在原请求到达后 SESSION_COALESCE_WINDOW 秒内、内容完全相同时合并（重复提交），
+    之后再发相同的内容视为用户有意重复，正常排队执行
+- 其余请求按FIFO排队，排队长度超过 SESSION_MAX_QUEUE 时拒绝
+- 多worker部署时轮到执行后还要取得会话租约，同一会话不会同时在两个worker中执行
+只在事件循环中使用。
+"""
+
+import asyncio
+import hashlib
+import os
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional
+
+from latency_stats import LatencyWindow
+from shared_state import hold_session, shared_state
+
+# 每个会话最多排队的请求数（不含正在执行的）
+SESSION_MAX_QUEUE = int(os.getenv("PODCAST_SESSION_MAX_QUEUE", "2"))
+# 是否把重复请求合并到同一次执行
+SESSION_COALESCE = os.getenv("PODCAST_SESSION_COALESCE", "1") == "1"
+# 不带 Idempotency-Key 的相同请求在原请求到达后多少秒内视为重复提交（秒）
+SESSION_COALESCE_WINDOW = float(os.getenv("PODCAST_SESSION_COALESCE_WINDOW", "2"))
+
+
+def request_fingerprint(*parts: Any) -> str:
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class TurnFlight:
+    """一次执行的输出：流式chunk或非流式结果，供合并进来的请求回放"""
+
+    def __init__(self, key: tuple):
+        # ("key", 幂等键, 指纹) 或 ("fp", 指纹)
+        self.key = key
+        self.created_at = time.monotonic()
+        self.chunks: List[str] = []
+        self.done = False
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.followers = 0
+        self._changed = asyncio.Event()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def publish(self, chunk: str):
+        self.chunks.append(chunk)
+        self._notify()
+
+    def finish(self, result: Any = None, error: Optional[str] = None):
+        if self.done:
+            return
+        self.done = True
+        self.result = result
+        self.error = error
+        self._notify()
+
+    async def replay(self) -> AsyncIterator[str]:
+        """从头回放已输出的chunk，并跟随后续输出直到结束"""
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.done:
+                return
+            await self._changed.wait()
+
+    async def wait_result(self) -> Any:
+        while not self.done:
+            await self._changed.wait()
+        if self.error is not None:
+            raise RuntimeError(self.error)
+        return self.result
+
+
+class TurnTicket:
+    """一个请求在会话中的位置：running 立即执行；queued 排队；coalesced 合并到已有执行"""
+
+    def __init__(self, scheduler: "SessionTurnScheduler", session_id: str, status: str, flight: TurnFlight, position: int = 0):
+        self.scheduler = scheduler
+        self.session_id = session_id
+        self.status = status
+        self.flight = flight
+        # 进入时前面还有几个请求（正在执行的也算）
+        self.position = position
+        self.created_at = time.monotonic()
+        self._granted = asyncio.Event()
+        self._released = False
+        self._leased = False
+
+    async def wait_turn(self):
+        """等待轮到本请求执行；其他worker一直占着该会话时抛出 RuntimeError"""
+        await self._granted.wait()
+        if not await hold_session(self.session_id):
+            raise RuntimeError("该会话正在其他worker中处理，等待超时，请稍后重试")
+        self._leased = True
+
+    def release(self):
+        """执行结束或请求被取消时调用（可重复调用）"""
+        if self._released:
+            return
+        self._released = True
+        if self._leased:
+            shared_state.unlock_session(self.session_id)
+        self.scheduler._release(self)
+
+
+class _SessionTurns:
+    __slots__ = ("running", "waiting", "flights")
+
+    def __init__(self):
+        self.running: Optional[TurnTicket] = None
+        self.waiting: Deque[TurnTicket] = deque()
+        # 合并键 -> 正在执行或排队中的执行
+        self.flights: Dict[tuple, TurnFlight] = {}
+
+
+class SessionTurnScheduler:
+    """按会话串行执行聊天请求"""
+
+    def __init__(
+        self,
+        max_queue: int = SESSION_MAX_QUEUE,
+        coalesce: bool = SESSION_COALESCE,
+        coalesce_window: float = SESSION_COALESCE_WINDOW,
+    ):
+        self.max_queue = max_queue
+        self.coalesce = coalesce
+        self.coalesce_window = coalesce_window
+        self._sessions: Dict[str, _SessionTurns] = {}
+        self.queue_wait = LatencyWindow()
+
+        self.started = 0
+        self.queued = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.abandoned = 0
+
+    def enter(
+        self, session_id: str, fingerprint: str, idempotency_key: Optional[str] = None
+    ) -> Optional[TurnTicket]:
+        """登记一个请求；排队已满时返回None"""
+        state = self._sessions.get(session_id)
+        if state is None:
+            state = self._sessions[session_id] = _SessionTurns()
+
+        key = ("key", idempotency_key, fingerprint) if idempotency_key else ("fp", fingerprint)
+        flight = state.flights.get(key)
+        if (
+            self.coalesce
+            and flight is not None
+            and not flight.done
+            and (idempotency_key or time.monotonic() - flight.created_at <= self.coalesce_window)
+        ):
+            flight.followers += 1
+            self.coalesced += 1
+            return TurnTicket(self, session_id, "coalesced", flight)
+
+        if state.running is not None and len(state.waiting) >= self.max_queue:
+            self.rejected += 1
+            return None
+
+        flight = TurnFlight(key)
+        state.flights[key] = flight
+        if state.running is None:
+            ticket = TurnTicket(self, session_id, "running", flight)
+            state.running = ticket
+            ticket._granted.set()
+            self.started += 1
+        else:
+            ticket = TurnTicket(self, session_id, "queued", flight, len(state.waiting) + 1)
+            state.waiting.append(ticket)
+            self.queued += 1
+        return ticket
+
+    def queue_depth(self, session_id: str) -> int:
+        state = self._sessions.get(session_id)
+        return len(state.waiting) if state else 0
+
+    def _release(self, ticket: TurnTicket):
+        if ticket.status == "coalesced":
+            return
+        state = self._sessions.get(ticket.session_id)
+        if state is None:
+            return
+        # 没有正常结束（被取消或出错）的执行，合并进来的请求收到错误
+        ticket.flight.finish(error="同一会话的原始请求已中断")
+        if state.flights.get(ticket.flight.key) is ticket.flight:
+            del state.flights[ticket.flight.key]
+
+        if state.running is ticket:
+            state.running = None
+            if state.waiting:
+                nxt = state.waiting.popleft()
+                state.running = nxt
+                self.queue_wait.record(time.monotonic() - nxt.created_at)
+                self.started += 1
+                nxt._granted.set()
+        else:
+            try:
+                state.waiting.remove(ticket)
+                self.abandoned += 1
+            except ValueError:
+                pass
+
+        if state.running is None and not state.waiting:
+            del self._sessions[ticket.session_id]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_queue": self.max_queue,
+            "coalesce": self.coalesce,
+            "coalesce_window": self.coalesce_window,
+            "active_sessions": len(self._sessions),
+            "waiting": sum(len(s.waiting) for s in self._sessions.values()),
+            "started": self.started,
+            "queued": self.queued,
+            "coalesced": self.coalesced,
+            "rejected": self.rejected,
+            "abandoned": self.abandoned,
+            "queue_wait_ms": self.queue_wait.snapshot(),
+        }
+
+
+session_turns = SessionTurnScheduler()
@@ -0,0 +1,562 @@
+#!/usr/bin/env python3
+"""
+多进程共享状态：PODCAST_WORKERS > 1 时多个uvicorn worker通过同一个SQLite文件（WAL）共享
+
+- our_session_id -> claude_session_id 映射
+- 准入道的全局并发名额（按worker进程登记，进程退出后由其他worker清理）
+- 每个会话同一时刻只在一个worker中执行一轮对话（会话租约，带过期时间）
+- 按用户的令牌桶限流
+- 后台维护任务（会话回收、历史压缩）只在一个worker中运行，其他worker把压缩请求登记给它
+
+单worker时使用进程内实现，接口相同。
+
+事件循环中的调用不等待数据库锁（另一个worker正在写入时SQLite立即返回busy）：
+- 取名额、取会话租约：busy 视为暂时取不到，由准入道的定时重试 / hold_session 的轮询再试
+- 限流：busy 时改到后台线程中等待（中间件可以await）
+- 释放名额、释放租约、写会话映射、登记压缩请求：busy 时交给后台线程按顺序写入，不阻塞请求
+后台线程使用另一个连接，最多等待 PODCAST_SHARED_STATE_BUSY_TIMEOUT 秒。WAL模式下读不会被写阻塞。
+"""
+
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+# uvicorn worker进程数
+SERVER_WORKERS = int(os.getenv("PODCAST_WORKERS", "1"))
+# 共享状态数据库
+SHARED_STATE_DB = Path(os.getenv("PODCAST_SHARED_STATE_DB", "data/shared_state.db"))
+# 后台线程中数据库被其他worker锁住时的最长等待（秒）；事件循环中从不等待
+SHARED_STATE_BUSY_TIMEOUT = float(os.getenv("PODCAST_SHARED_STATE_BUSY_TIMEOUT", "2"))
+# 全局名额用完（或数据库正忙）时重新尝试的间隔（秒）
+SHARED_SLOT_RETRY = float(os.getenv("PODCAST_SHARED_SLOT_RETRY", "0.05"))
+# 会话租约的有效期（秒），持有者异常退出后租约过期
+SESSION_LEASE_TTL = float(os.getenv("PODCAST_SESSION_LEASE_TTL", "600"))
+# 名额或租约被占用时，检查持有的worker是否已退出的最短间隔（秒）
+SHARED_STATE_REAP_INTERVAL = float(os.getenv("PODCAST_SHARED_STATE_REAP_INTERVAL", "5"))
+# 等待其他worker释放会话租约的最长时间（秒）
+SESSION_LEASE_WAIT = float(os.getenv("PODCAST_SESSION_LEASE_WAIT", "60"))
+# 每个用户每分钟的聊天请求数上限，0表示不限流
+RATE_LIMIT_PER_MINUTE = float(os.getenv("PODCAST_RATE_LIMIT_PER_MINUTE", "0"))
+# 令牌桶容量（允许的突发请求数）
+RATE_LIMIT_BURST = int(os.getenv("PODCAST_RATE_LIMIT_BURST", "10"))
+
+# 数据库被其他连接锁住，本次没有执行
+_BUSY = object()
+_MISSING = object()
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _is_busy(error: sqlite3.OperationalError) -> bool:
+    # SQLITE_BUSY / SQLITE_LOCKED: "database is locked" / "database table is locked"
+    return "locked" in str(error)
+
+
+@contextmanager
+def _transaction(db: sqlite3.Connection) -> Iterator[sqlite3.Connection]:
+    """写事务：BEGIN IMMEDIATE 在开始时就取得写锁"""
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        yield db
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+
+
+# 以下操作都以连接为第一个参数，由调用方决定在哪个连接（事件循环 / 后台线程）上执行
+
+def _take_token(db: sqlite3.Connection, key: str, per_minute: float, burst: int) -> float:
+    now = time.time()
+    rate = per_minute / 60.0
+    with _transaction(db):
+        row = db.execute(
+            "SELECT tokens, updated_at FROM rate_buckets WHERE key = ?", (key,)
+        ).fetchone()
+        tokens = float(burst) if row is None else min(float(burst), row[0] + (now - row[1]) * rate)
+        allowed = tokens >= 1.0
+        if allowed:
+            tokens -= 1.0
+        db.execute(
+            "INSERT OR REPLACE INTO rate_buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+            (key, tokens, now),
+        )
+    return 0.0 if allowed else (1.0 - tokens) / rate
+
+
+def _acquire_slot(db: sqlite3.Connection, name: str, pid: int, limit: int) -> bool:
+    with _transaction(db):
+        total = db.execute(
+            "SELECT COALESCE(SUM(count), 0) FROM slots WHERE name = ?", (name,)
+        ).fetchone()[0]
+        if total >= limit:
+            return False
+        db.execute(
+            "INSERT INTO slots (name, pid, count) VALUES (?, ?, 1) "
+            "ON CONFLICT(name, pid) DO UPDATE SET count = count + 1",
+            (name, pid),
+        )
+    return True
+
+
+def _release_slot(db: sqlite3.Connection, name: str, pid: int):
+    db.execute(
+        "UPDATE slots SET count = MAX(count - 1, 0) WHERE name = ? AND pid = ?", (name, pid)
+    )
+
+
+def _lock_session(db: sqlite3.Connection, session_id: str, pid: int) -> bool:
+    now = time.time()
+    with _transaction(db):
+        row = db.execute(
+            "SELECT pid, expires_at FROM session_leases WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is not None and row[0] != pid and row[1] > now:
+            return False
+        db.execute(
+            "INSERT OR REPLACE INTO session_leases (session_id, pid, expires_at) VALUES (?, ?, ?)",
+            (session_id, pid, now + SESSION_LEASE_TTL),
+        )
+    return True
+
+
+def _unlock_session(db: sqlite3.Connection, session_id: str, pid: int):
+    db.execute("DELETE FROM session_leases WHERE session_id = ? AND pid = ?", (session_id, pid))
+
+
+def _set_claude_session(db: sqlite3.Connection, key: str, value: Optional[str]):
+    if value is None:
+        db.execute("DELETE FROM claude_sessions WHERE our_session_id = ?", (key,))
+        return
+    db.execute(
+        "INSERT INTO claude_sessions (our_session_id, claude_session_id, updated_at) VALUES (?, ?, ?) "
+        "ON CONFLICT(our_session_id) DO UPDATE SET claude_session_id = excluded.claude_session_id, updated_at = excluded.updated_at",
+        (key, value, time.time()),
+    )
+
+
+def _reap_dead_workers(db: sqlite3.Connection, pid: int) -> List[int]:
+    with _transaction(db):
+        pids = {
+            row[0]
+            for table in ("slots", "session_leases", "leaders")
+            for row in db.execute(f"SELECT DISTINCT pid FROM {table}").fetchall()
+        }
+        dead = [other for other in pids if other != pid and not _pid_alive(other)]
+        for other in dead:
+            for table in ("slots", "session_leases", "leaders"):
+                db.execute(f"DELETE FROM {table} WHERE pid = ?", (other,))
+    return dead
+
+
+def _lead(db: sqlite3.Connection, name: str, pid: int) -> bool:
+    with _transaction(db):
+        db.execute("INSERT OR IGNORE INTO leaders (name, pid) VALUES (?, ?)", (name, pid))
+        row = db.execute("SELECT pid FROM leaders WHERE name = ?", (name,)).fetchone()
+    return row is not None and row[0] == pid
+
+
+def _request_compaction(db: sqlite3.Connection, session_id: str):
+    db.execute(
+        "INSERT OR IGNORE INTO compaction_requests (session_id, requested_at) VALUES (?, ?)",
+        (session_id, time.time()),
+    )
+
+
+def _take_compaction_requests(db: sqlite3.Connection) -> List[str]:
+    with _transaction(db):
+        rows = db.execute("SELECT session_id FROM compaction_requests").fetchall()
+        db.execute("DELETE FROM compaction_requests")
+    return [row[0] for row in rows]
+
+
+def _forget_worker(db: sqlite3.Connection, pid: int):
+    with _transaction(db):
+        for table in ("slots", "session_leases", "leaders"):
+            db.execute(f"DELETE FROM {table} WHERE pid = ?", (pid,))
+
+
+class LocalSharedState:
+    """单worker：状态都在进程内"""
+
+    shared = False
+
+    def __init__(self):
+        self.claude_sessions: Dict[str, str] = {}
+        self._buckets: Dict[str, Any] = {}
+        self.rate_limited = 0
+
+    def slots(self, name: str) -> None:
+        # 单进程时准入道自身的计数就是全局计数
+        return None
+
+    def try_lock_session(self, session_id: str) -> bool:
+        # 同一进程内由会话轮次调度串行
+        return True
+
+    def unlock_session(self, session_id: str):
+        pass
+
+    async def take_token(self, key: str, per_minute: float, burst: int) -> float:
+        """取一个令牌，返回0表示放行，否则返回需要等待的秒数"""
+        now = time.monotonic()
+        rate = per_minute / 60.0
+        tokens, updated = self._buckets.get(key, (float(burst), now))
+        tokens = min(float(burst), tokens + (now - updated) * rate)
+        if tokens >= 1.0:
+            self._buckets[key] = (tokens - 1.0, now)
+            return 0.0
+        self._buckets[key] = (tokens, now)
+        self.rate_limited += 1
+        return (1.0 - tokens) / rate
+
+    def try_lead(self, name: str) -> bool:
+        return True
+
+    def request_compaction(self, session_id: str):
+        # 本进程就运行压缩任务，不需要转交
+        pass
+
+    def take_compaction_requests(self) -> List[str]:
+        return []
+
+    def close(self):
+        pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "shared": False,
+            "workers": 1,
+            "claude_sessions": len(self.claude_sessions),
+            "rate_limited": self.rate_limited,
+        }
+
+
+class ClaudeSessionMap:
+    """our_session_id -> claude_session_id，保存在共享数据库中（提供dict的常用方法）
+
+    数据库正忙时写入交给后台线程，写完之前本worker读到的是待写入的值。
+    """
+
+    def __init__(self, state: "SQLiteSharedState"):
+        self._state = state
+        # 交给后台线程、尚未写入的值（None 表示删除）
+        self._pending: Dict[str, Optional[str]] = {}
+        self._pending_lock = threading.Lock()
+
+    def get(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        with self._pending_lock:
+            value = self._pending.get(key, _MISSING)
+        if value is _MISSING:
+            row = self._state._read_one(
+                "SELECT claude_session_id FROM claude_sessions WHERE our_session_id = ?", (key,)
+            )
+            value = row[0] if row else None
+        return default if value is None else value
+
+    def _write(self, key: str, value: Optional[str]):
+        future = self._state._write_soon(_set_claude_session, key, value)
+        with self._pending_lock:
+            if future is None:
+                self._pending.pop(key, None)
+                return
+            self._pending[key] = value
+
+        def written(_):
+            with self._pending_lock:
+                if self._pending.get(key, _MISSING) == value:
+                    del self._pending[key]
+
+        future.add_done_callback(written)
+
+    def __setitem__(self, key: str, value: str):
+        self._write(key, value)
+
+    def __getitem__(self, key: str) -> str:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def pop(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        value = self.get(key, default)
+        self._write(key, None)
+        return value
+
+    def __len__(self) -> int:
+        row = self._state._read_one("SELECT COUNT(*) FROM claude_sessions")
+        return row[0] if row else 0
+
+    def __iter__(self) -> Iterator[str]:
+        rows = self._state._read_all("SELECT our_session_id FROM claude_sessions")
+        return iter([row[0] for row in rows])
+
+
+class SharedSlots:
+    """一个准入道在所有worker中的全局名额，按 (道, 进程) 登记占用数"""
+
+    def __init__(self, state: "SQLiteSharedState", name: str):
+        self._state = state
+        self.name = name
+        self.retry_interval = SHARED_SLOT_RETRY
+        self.acquired = 0
+        self.denied = 0
+
+    def try_acquire(self, limit: int) -> bool:
+        """不等待：名额用完或数据库正忙都返回False，由准入道定时重试"""
+        acquired = self._state._try_now(_acquire_slot, self.name, self._state.pid, limit)
+        if acquired is True:
+            self.acquired += 1
+            return True
+        # 名额可能被已退出的worker占着
+        if acquired is False and self._state.maybe_reap():
+            return self.try_acquire(limit)
+        self.denied += 1
+        return False
+
+    def release(self):
+        self._state._write_soon(_release_slot, self.name, self._state.pid)
+
+    def total(self) -> int:
+        row = self._state._read_one(
+            "SELECT COALESCE(SUM(count), 0) FROM slots WHERE name = ?", (self.name,)
+        )
+        return row[0] if row else 0
+
+
+class SQLiteSharedState:
+    """多worker：状态保存在共享的SQLite数据库中
+
+    两个连接：事件循环的连接遇到锁立即返回；后台线程的连接（加锁后可在任意线程中使用）等待锁。
+    """
+
+    shared = True
+
+    def __init__(self, path: Path = SHARED_STATE_DB, workers: int = SERVER_WORKERS):
+        self.path = path
+        self.workers = workers
+        self.pid = os.getpid()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = self._connect(SHARED_STATE_BUSY_TIMEOUT)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS claude_sessions (
+                our_session_id TEXT PRIMARY KEY, claude_session_id TEXT, updated_at REAL);
+            CREATE TABLE IF NOT EXISTS slots (
+                name TEXT, pid INTEGER, count INTEGER, PRIMARY KEY (name, pid));
+            CREATE TABLE IF NOT EXISTS session_leases (
+                session_id TEXT PRIMARY KEY, pid INTEGER, expires_at REAL);
+            CREATE TABLE IF NOT EXISTS rate_buckets (
+                key TEXT PRIMARY KEY, tokens REAL, updated_at REAL);
+            CREATE TABLE IF NOT EXISTS leaders (
+                name TEXT PRIMARY KEY, pid INTEGER);
+            CREATE TABLE IF NOT EXISTS compaction_requests (
+                session_id TEXT PRIMARY KEY, requested_at REAL);
+            """
+        )
+        self._loop_db = self._connect(0)
+        # 交给后台线程的操作按提交顺序在一个线程中执行
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-state")
+        self._last_background: Optional[Future] = None
+        self.claude_sessions = ClaudeSessionMap(self)
+        self._slots: Dict[str, SharedSlots] = {}
+        self._last_reap = 0.0
+        self.rate_limited = 0
+        self.session_lease_waits = 0
+        self.reaped_workers = 0
+        self.busy = 0
+        self.background_ops = 0
+        self.reap_dead_workers()
+
+    def _connect(self, timeout: float) -> sqlite3.Connection:
+        db = sqlite3.connect(
+            str(self.path), timeout=timeout, isolation_level=None, check_same_thread=False
+        )
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _blocking(self, op: Callable, *args) -> Any:
+        """在当前线程中执行，等待数据库锁（后台线程、启动和退出时使用）"""
+        with self._lock:
+            return op(self._db, *args)
+
+    def _try_now(self, op: Callable, *args) -> Any:
+        """在事件循环中执行，不等待：数据库被锁住或还有交给后台线程的操作未完成时返回 _BUSY"""
+        if self._last_background is not None and not self._last_background.done():
+            # 不越过排队中的写入
+            self.busy += 1
+            return _BUSY
+        try:
+            return op(self._loop_db, *args)
+        except sqlite3.OperationalError as e:
+            if not _is_busy(e):
+                raise
+            self.busy += 1
+            return _BUSY
+
+    def _background(self, op: Callable, *args) -> Future:
+        self.background_ops += 1
+        future = self._executor.submit(self._blocking, op, *args)
+        self._last_background = future
+        return future
+
+    def _write_soon(self, op: Callable, *args) -> Optional[Future]:
+        """不需要结果的写入：数据库正忙时交给后台线程并返回其Future，已写入时返回None"""
+        if self._try_now(op, *args) is _BUSY:
+            return self._background(op, *args)
+        return None
+
+    async def _call(self, op: Callable, *args) -> Any:
+        """先不等待地执行一次；数据库正忙时在后台线程中等待结果"""
+        result = self._try_now(op, *args)
+        if result is _BUSY:
+            result = await asyncio.wrap_future(self._background(op, *args))
+        return result
+
+    def _read_one(self, sql: str, params: tuple = ()):
+        """事件循环中的读（WAL下不被写阻塞）；极少数情况下遇到锁时返回None"""
+        try:
+            return self._loop_db.execute(sql, params).fetchone()
+        except sqlite3.OperationalError as e:
+            if not _is_busy(e):
+                raise
+            self.busy += 1
+            return None
+
+    def _read_all(self, sql: str, params: tuple = ()):
+        try:
+            return self._loop_db.execute(sql, params).fetchall()
+        except sqlite3.OperationalError as e:
+            if not _is_busy(e):
+                raise
+            self.busy += 1
+            return []
+
+    def _count(self, sql: str) -> Optional[int]:
+        row = self._read_one(sql)
+        return row[0] if row else None
+
+    def maybe_reap(self) -> bool:
+        """距上次清理超过 SHARED_STATE_REAP_INTERVAL 时清理一次（不等待锁），返回是否清理了已退出的worker"""
+        if time.monotonic() - self._last_reap < SHARED_STATE_REAP_INTERVAL:
+            return False
+        self._last_reap = time.monotonic()
+        dead = self._try_now(_reap_dead_workers, self.pid)
+        return dead is not _BUSY and self._reaped(dead) > 0
+
+    def reap_dead_workers(self) -> int:
+        """清理已退出的worker登记的名额、租约和维护任务，返回清理的worker数（等待锁）"""
+        self._last_reap = time.monotonic()
+        return self._reaped(self._blocking(_reap_dead_workers, self.pid))
+
+    def _reaped(self, dead: List[int]) -> int:
+        if dead:
+            self.reaped_workers += len(dead)
+            print(f"🧹 清理已退出worker的共享状态: {dead}")
+        return len(dead)
+
+    def slots(self, name: str) -> SharedSlots:
+        slots = self._slots.get(name)
+        if slots is None:
+            slots = self._slots[name] = SharedSlots(self, name)
+        return slots
+
+    def try_lock_session(self, session_id: str) -> bool:
+        """不等待：租约被其他worker持有或数据库正忙都返回False，由 hold_session 轮询"""
+        locked = self._try_now(_lock_session, session_id, self.pid)
+        if locked is True:
+            return True
+        # 租约可能属于已退出的worker
+        if locked is False and self.maybe_reap():
+            return self.try_lock_session(session_id)
+        return False
+
+    def unlock_session(self, session_id: str):
+        self._write_soon(_unlock_session, session_id, self.pid)
+
+    async def take_token(self, key: str, per_minute: float, burst: int) -> float:
+        """取一个令牌，返回0表示放行，否则返回需要等待的秒数"""
+        retry_after = await self._call(_take_token, key, per_minute, burst)
+        if retry_after:
+            self.rate_limited += 1
+        return retry_after
+
+    def try_lead(self, name: str) -> bool:
+        """争取运行某个后台维护任务；持有者退出后由下一个启动的worker接手（等待锁，在线程池中调用）"""
+        self.reap_dead_workers()
+        return self._blocking(_lead, name, self.pid)
+
+    def request_compaction(self, session_id: str):
+        """登记压缩请求，由运行压缩任务的worker领取（构建提示词时在事件循环中调用，不等待锁）"""
+        self._write_soon(_request_compaction, session_id)
+
+    def take_compaction_requests(self) -> List[str]:
+        """取走所有登记的压缩请求（在压缩任务的线程中调用，等待锁）"""
+        return self._blocking(_take_compaction_requests)
+
+    def close(self):
+        """worker退出：写完交给后台线程的操作，释放本进程登记的名额、租约和维护任务"""
+        self._executor.shutdown(wait=True)
+        self._blocking(_forget_worker, self.pid)
+        self._loop_db.close()
+        with self._lock:
+            self._db.close()
+
+    def stats(self) -> Dict[str, Any]:
+        slots = self._read_all("SELECT name, SUM(count) FROM slots GROUP BY name")
+        workers = self._read_all("SELECT DISTINCT pid FROM slots WHERE count > 0")
+        return {
+            "shared": True,
+            "path": str(self.path),
+            "workers": self.workers,
+            "pid": self.pid,
+            "busy_workers": len(workers),
+            "claude_sessions": len(self.claude_sessions),
+            "global_slots": {name: total for name, total in slots},
+            "slots": {
+                name: {"acquired": s.acquired, "denied": s.denied}
+                for name, s in self._slots.items()
+            },
+            "session_leases": self._count("SELECT COUNT(*) FROM session_leases"),
+            "session_lease_waits": self.session_lease_waits,
+            "compaction_requests": self._count("SELECT COUNT(*) FROM compaction_requests"),
+            "rate_limited": self.rate_limited,
+            "reaped_workers": self.reaped_workers,
+            "busy": self.busy,
+            "background_ops": self.background_ops,
+        }
+
+
+async def hold_session(session_id: str, wait: float = SESSION_LEASE_WAIT) -> bool:
+    """等待取得会话租约（同一会话的上一轮可能在其他worker中执行），超时返回False"""
+    if shared_state.try_lock_session(session_id):
+        return True
+    shared_state.session_lease_waits += 1
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+        if shared_state.try_lock_session(session_id):
+            return True
+    return False
+
+
+shared_state = SQLiteSharedState() if SERVER_WORKERS > 1 else LocalSharedState()
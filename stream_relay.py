@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+流式响应中继：Agent输出在独立的读取任务中运行，经有界缓冲交给HTTP写出
+
+- 读取任务与写出解耦：上游可以领先客户端，领先量受高水位限制
+- 缓冲达到高水位时按策略处理慢客户端：
+    buffer    暂停读取上游，直到缓冲回落到低水位
+    coalesce  把新的文本增量并入缓冲末尾的chunk（不增加深度），不能合并的chunk同 buffer
+    drop      等待 STREAM_DROP_AFTER 秒仍未回落到低水位时断开客户端
+- 客户端断开时取消读取任务
+
+Starlette在客户端断开时取消响应所在的cancel scope，此后该scope内的每次await都会再次被取消，
+生成器里的收尾（关闭SDK迭代器、结束Agent子进程、保存部分输出）无法完成。
+读取任务不在该scope内：消费方被取消时只对它发出一次取消，它的 CancelledError 处理和 finally 可以正常await。
+"""
+
+import asyncio
+import itertools
+import os
+import time
+from collections import deque
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Optional, Set
+
+from fast_json import merge_content_chunks, sse_event
+
+# 缓冲的高/低水位（chunk数）
+STREAM_BUFFER_HIGH = int(os.getenv("PODCAST_STREAM_BUFFER_HIGH", "256"))
+STREAM_BUFFER_LOW = int(os.getenv("PODCAST_STREAM_BUFFER_LOW", "64"))
+# 慢客户端策略：buffer、coalesce 或 drop
+STREAM_SLOW_POLICY = os.getenv("PODCAST_STREAM_SLOW_POLICY", "coalesce").lower()
+# drop 策略下在高水位等待客户端的最长时间（秒）
+STREAM_DROP_AFTER = float(os.getenv("PODCAST_STREAM_DROP_AFTER", "10"))
+
+_DONE = object()
+
+
+class _Failure:
+    __slots__ = ("error",)
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class StreamBuffer:
+    """读取任务与HTTP写出之间的有界缓冲（单生产者、单消费者）"""
+
+    def __init__(
+        self,
+        kind: str,
+        high: int = STREAM_BUFFER_HIGH,
+        low: int = STREAM_BUFFER_LOW,
+        policy: str = STREAM_SLOW_POLICY,
+        drop_after: float = STREAM_DROP_AFTER,
+        merge: Optional[Callable[[Any, Any], Optional[Any]]] = merge_content_chunks,
+    ):
+        self.kind = kind
+        self.high = max(1, high)
+        self.low = min(max(0, low), self.high - 1)
+        self.policy = policy
+        self.drop_after = drop_after
+        self.merge = merge
+        self.started = time.monotonic()
+
+        self._items: Deque[Any] = deque()
+        self._readable = asyncio.Event()
+        self._drained = asyncio.Event()
+
+        self.max_depth = 0
+        self.chunks = 0
+        self.pauses = 0
+        self.paused_seconds = 0.0
+        self.coalesced = 0
+        self.dropped = False
+
+    @property
+    def depth(self) -> int:
+        return len(self._items)
+
+    def _append(self, item: Any):
+        self._items.append(item)
+        self.max_depth = max(self.max_depth, len(self._items))
+        self._readable.set()
+
+    async def _wait_drained(self, timeout: Optional[float] = None):
+        self._drained.clear()
+        self.pauses += 1
+        start = time.monotonic()
+        try:
+            if timeout is None:
+                await self._drained.wait()
+            else:
+                await asyncio.wait_for(self._drained.wait(), timeout)
+        finally:
+            self.paused_seconds += time.monotonic() - start
+
+    async def put(self, item: Any) -> bool:
+        """放入一个chunk；客户端被判定过慢而断开时返回False"""
+        if self.dropped:
+            return False
+        self.chunks += 1
+        if len(self._items) >= self.high:
+            if self.policy == "coalesce" and self.merge is not None and self._items:
+                merged = self.merge(self._items[-1], item)
+                if merged is not None:
+                    self._items[-1] = merged
+                    self.coalesced += 1
+                    return True
+            if self.policy == "drop":
+                try:
+                    await self._wait_drained(self.drop_after)
+                except asyncio.TimeoutError:
+                    self._drop()
+                    return False
+            else:
+                await self._wait_drained()
+        self._append(item)
+        return True
+
+    def _drop(self):
+        """丢弃未发送的chunk，告知客户端后结束流"""
+        self.dropped = True
+        self._items.clear()
+        self._append(sse_event({"type": "error", "text": "客户端读取过慢，流已中断"}))
+        self._append("data: [DONE]\n\n")
+        self._append(_DONE)
+
+    def finish(self):
+        self._append(_DONE)
+
+    def fail(self, error: BaseException):
+        self._append(_Failure(error))
+
+    async def get(self) -> Any:
+        while not self._items:
+            self._readable.clear()
+            await self._readable.wait()
+        item = self._items.popleft()
+        if len(self._items) <= self.low:
+            self._drained.set()
+        return item
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "kind": self.kind,
+            "age_seconds": round(time.monotonic() - self.started, 1),
+            "depth": len(self._items),
+            "max_depth": self.max_depth,
+            "chunks": self.chunks,
+            "pauses": self.pauses,
+            "paused_seconds": round(self.paused_seconds, 3),
+            "coalesced": self.coalesced,
+        }
+
+
+class StreamRunStats:
+    """按类型统计流式执行：完成耗时（指数平均）、被取消的次数、估算节省的时间和缓冲情况"""
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self._kinds: Dict[str, Dict[str, Any]] = {}
+
+    def _kind(self, kind: str) -> Dict[str, Any]:
+        stats = self._kinds.get(kind)
+        if stats is None:
+            stats = self._kinds[kind] = {
+                "completed": 0,
+                "cancelled": 0,
+                "dropped_slow_clients": 0,
+                "avg_seconds": 0.0,
+                "cancelled_elapsed_seconds": 0.0,
+                "seconds_saved_estimate": 0.0,
+                "max_buffer_depth": 0,
+                "buffer_pauses": 0,
+                "buffer_paused_seconds": 0.0,
+                "coalesced_chunks": 0,
+            }
+        return stats
+
+    def completed(self, kind: str, seconds: float):
+        stats = self._kind(kind)
+        stats["completed"] += 1
+        if stats["completed"] == 1:
+            stats["avg_seconds"] = seconds
+        else:
+            stats["avg_seconds"] += self.alpha * (seconds - stats["avg_seconds"])
+
+    def cancelled(self, kind: str, elapsed: float) -> float:
+        """记录一次被取消的执行，返回估算节省的秒数（平均完成耗时 - 已执行时间）"""
+        stats = self._kind(kind)
+        saved = max(0.0, stats["avg_seconds"] - elapsed)
+        stats["cancelled"] += 1
+        stats["cancelled_elapsed_seconds"] += elapsed
+        stats["seconds_saved_estimate"] += saved
+        return saved
+
+    def buffered(self, buffer: StreamBuffer):
+        """流结束时汇总它的缓冲情况"""
+        stats = self._kind(buffer.kind)
+        stats["max_buffer_depth"] = max(stats["max_buffer_depth"], buffer.max_depth)
+        stats["buffer_pauses"] += buffer.pauses
+        stats["buffer_paused_seconds"] += buffer.paused_seconds
+        stats["coalesced_chunks"] += buffer.coalesced
+        if buffer.dropped:
+            stats["dropped_slow_clients"] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            kind: {key: round(value, 3) if isinstance(value, float) else value for key, value in stats.items()}
+            for kind, stats in self._kinds.items()
+        }
+
+
+stream_runs = StreamRunStats()
+# 进行中的流：编号 -> 缓冲
+_active: Dict[int, StreamBuffer] = {}
+_stream_ids = itertools.count(1)
+# 已被取消、仍在收尾的读取任务（保持引用，避免被回收）
+_cancelling: Set[asyncio.Task] = set()
+
+
+async def relay(source: AsyncIterator[Any], kind: str = "chat", **buffer_options: Any) -> AsyncIterator[Any]:
+    """在独立任务中读取source，经有界缓冲转发；消费方提前退出（客户端断开）时取消读取任务
+
+    source 抛出的异常原样抛给消费方。buffer_options 覆盖 StreamBuffer 的水位和策略。
+    """
+    buffer = StreamBuffer(kind, **buffer_options)
+    stream_id = next(_stream_ids)
+    _active[stream_id] = buffer
+
+    async def produce():
+        try:
+            # 无论正常结束、出错、被取消还是断开慢客户端，source都在本任务中关闭，完成中断时的收尾
+            async with aclosing(source):
+                async for item in source:
+                    if not await buffer.put(item):
+                        break
+        except asyncio.CancelledError:
+            raise
+        except BaseException as e:
+            buffer.fail(e)
+            return
+        if buffer.dropped:
+            elapsed = time.monotonic() - buffer.started
+            stream_runs.cancelled(kind, elapsed)
+            print(f"🐢 客户端读取过慢，断开{kind}流 | 已执行: {elapsed:.1f}s | 缓冲: {buffer.high}")
+            return
+        buffer.finish()
+        stream_runs.completed(kind, time.monotonic() - buffer.started)
+
+    task = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await buffer.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        _active.pop(stream_id, None)
+        stream_runs.buffered(buffer)
+        if not task.done():
+            # 不等待读取任务：消费方所在的scope已被取消，await会被再次打断
+            _cancelling.add(task)
+            task.add_done_callback(_cancelling.discard)
+            if not buffer.dropped:
+                elapsed = time.monotonic() - buffer.started
+                saved = stream_runs.cancelled(kind, elapsed)
+                task.cancel()
+                print(f"✂️ 客户端断开，取消{kind}执行 | 已执行: {elapsed:.1f}s | 预计节省: {saved:.1f}s")
+
+
+def stats() -> Dict[str, Any]:
+    active = sorted(_active.values(), key=lambda b: b.depth, reverse=True)
+    return {
+        "buffer_high": STREAM_BUFFER_HIGH,
+        "buffer_low": STREAM_BUFFER_LOW,
+        "slow_policy": STREAM_SLOW_POLICY,
+        "active_streams": len(_active),
+        "cancelling": len(_cancelling),
+        # 缓冲最深的前20个流
+        "active": [buffer.stats() for buffer in active[:20]],
+        "runs": stream_runs.stats(),
+    }
@@ -0,0 +1,12 @@
+"""测试公共配置：仓库根目录加入导入路径；会话目录指向临时目录（必须在导入会话模块前设置）"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+os.environ.setdefault("PODCAST_SESSIONS_DIR", tempfile.mkdtemp(prefix="podcast-tests-"))
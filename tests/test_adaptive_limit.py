@@ -0,0 +1,133 @@
+"""自适应并发上限：出错或首token延迟变差时乘性减，只有顶到上限时加性增，降低后冷却一个窗口，上下限钳制"""
+
+from adaptive_limit import AIMDLimiter
+
+
+class Lane:
+    def __init__(self, limit, active=0, waiting=0):
+        self.name = "chat"
+        self.limit = limit
+        self.active = active
+        self.waiting = waiting
+
+    def set_limit(self, limit):
+        self.limit = limit
+
+
+def _limiter(lane, **kwargs):
+    options = dict(
+        enabled=True,
+        min_limit=2,
+        max_limit=20,
+        window=4,
+        ttft_target_ms=1000,
+        ttft_tolerance=2.0,
+        max_error_rate=0.25,
+        backoff=0.5,
+        baseline_drift=0.0,
+    )
+    options.update(kwargs)
+    limiter = AIMDLimiter(**options)
+    limiter.attach(lane)
+    return limiter
+
+
+def _window(limiter, ttft=0.5, errors=0, size=4):
+    for i in range(size):
+        limiter.observe(ttft, error=i < errors)
+
+
+def test_attach_clamps_initial_limit():
+    assert _limiter(Lane(100)).lane.limit == 20
+    assert _limiter(Lane(0)).lane.limit == 2
+    # 关闭时不改动准入道
+    assert _limiter(Lane(100), enabled=False).lane.limit == 100
+
+
+def test_errors_decrease_multiplicatively():
+    lane = Lane(10)
+    limiter = _limiter(lane)
+    _window(limiter, errors=2)
+    assert lane.limit == 5
+    assert limiter.decreases == 1
+    assert limiter.adjustments[-1]["reason"] == "errors"
+
+
+def test_ttft_regression_decreases():
+    lane = Lane(10)
+    limiter = _limiter(lane)
+    _window(limiter, ttft=0.8)
+    assert limiter.baseline_ms == 800
+    # 中位数超过目标且超过基线2倍
+    _window(limiter, ttft=2.0)
+    assert lane.limit == 5
+    assert limiter.adjustments[-1]["reason"] == "latency"
+
+
+def test_slow_but_stable_ttft_does_not_decrease():
+    lane = Lane(10)
+    limiter = _limiter(lane)
+    # 超过目标，但与基线相比没有变差
+    _window(limiter, ttft=3.0)
+    _window(limiter, ttft=3.5)
+    assert lane.limit == 10
+    assert limiter.decreases == 0
+
+
+def test_increase_only_when_saturated():
+    lane = Lane(10, active=3)
+    limiter = _limiter(lane)
+    _window(limiter)
+    assert lane.limit == 10
+    assert limiter.increases == 0
+
+    lane.active = 10
+    _window(limiter)
+    assert lane.limit == 11
+    lane.active = 0
+    lane.waiting = 1
+    _window(limiter)
+    assert lane.limit == 12
+    assert limiter.increases == 2
+    assert limiter.adjustments[-1]["reason"] == "saturated"
+
+
+def test_cooldown_skips_decrease_in_next_window():
+    lane = Lane(16)
+    limiter = _limiter(lane)
+    _window(limiter, errors=4)
+    assert lane.limit == 8
+    # 下一个窗口里还有按旧上限放行的执行，不再降低
+    _window(limiter, errors=4)
+    assert lane.limit == 8
+    _window(limiter, errors=4)
+    assert lane.limit == 4
+    assert limiter.decreases == 2
+
+
+def test_limits_are_clamped():
+    lane = Lane(3)
+    limiter = _limiter(lane, backoff=0.1)
+    _window(limiter, errors=4)
+    assert lane.limit == 2
+    _window(limiter)  # 冷却窗口
+    _window(limiter, errors=4)
+    assert lane.limit == 2
+
+    lane = Lane(20, active=20)
+    limiter = _limiter(lane)
+    _window(limiter)
+    assert lane.limit == 20
+    assert limiter.increases == 0
+
+
+def test_window_resets_after_evaluation():
+    lane = Lane(10)
+    limiter = _limiter(lane)
+    _window(limiter, size=3, errors=3)
+    assert lane.limit == 10
+    assert limiter.stats()["window_samples"] == 3
+    limiter.observe(None)
+    assert limiter.windows == 1
+    assert limiter.stats()["window_samples"] == 0
+    assert lane.limit == 5
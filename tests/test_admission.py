@@ -0,0 +1,212 @@
+"""准入控制：分道、名额交接、排队已满429、排队超时503、取消排队，以及按用户的公平调度"""
+
+import asyncio
+
+from admission import (
+    AdmissionController,
+    AdmissionLane,
+    AdmissionPermit,
+    AdmissionRejection,
+    FairAdmissionLane,
+    SessionUsers,
+)
+
+
+def test_lane_for_routes_by_path():
+    assert AdmissionController.lane_for("POST", "/v1/chat/completions") == "chat"
+    assert AdmissionController.lane_for("POST", "/api/podcast/generate") == "podcast"
+    assert AdmissionController.lane_for("GET", "/v1/chat/completions") == "control"
+    assert AdmissionController.lane_for("GET", "/health") == "control"
+
+
+def test_lanes_do_not_share_slots():
+    async def main():
+        controller = AdmissionController([
+            AdmissionLane("control", 1, 10, 1.0),
+            AdmissionLane("chat", 1, 10, 1.0),
+        ])
+        chat = await controller.admit("POST", "/v1/chat/completions")
+        assert isinstance(chat, AdmissionPermit)
+        # 聊天道占满时轻量请求照样立即放行
+        control = await controller.admit("GET", "/health")
+        assert isinstance(control, AdmissionPermit)
+        assert controller.active("chat") == 1
+        assert controller.active("control") == 1
+        chat.release()
+        control.release()
+
+    asyncio.run(main())
+
+
+def test_released_slot_goes_to_waiters_in_order():
+    async def main():
+        lane = AdmissionLane("chat", 1, 10, 5.0)
+        first = await lane.admit()
+        order = []
+
+        async def waiter(i):
+            permit = await lane.admit()
+            order.append(i)
+            await asyncio.sleep(0)
+            permit.release()
+
+        tasks = [asyncio.create_task(waiter(i)) for i in range(3)]
+        await asyncio.sleep(0.01)
+        assert lane.waiting == 3
+        first.release()
+        # 重复释放不会多放行
+        first.release()
+        await asyncio.gather(*tasks)
+        assert order == [0, 1, 2]
+        assert lane.active == 0
+        assert lane.queued == 3
+
+    asyncio.run(main())
+
+
+def test_full_queue_rejects_with_429():
+    async def main():
+        lane = AdmissionLane("chat", 1, 1, 5.0)
+        held = await lane.admit()
+        queued = asyncio.create_task(lane.admit())
+        await asyncio.sleep(0.01)
+        rejected = await lane.admit()
+        assert isinstance(rejected, AdmissionRejection)
+        assert rejected.status_code == 429
+        assert rejected.retry_after >= 1
+        assert lane.waiting == 1
+        held.release()
+        (await queued).release()
+        assert lane.stats()["rejected_429"] == 1
+
+    asyncio.run(main())
+
+
+def test_queue_timeout_rejects_with_503():
+    async def main():
+        lane = AdmissionLane("podcast", 1, 10, 0.05)
+        held = await lane.admit()
+        rejected = await lane.admit()
+        assert isinstance(rejected, AdmissionRejection)
+        assert rejected.status_code == 503
+        # 超时的请求已离开队列，不会在名额释放时被放行
+        assert lane.waiting == 0
+        held.release()
+        assert lane.active == 0
+        assert lane.stats()["rejected_503"] == 1
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def main():
+        lane = AdmissionLane("chat", 1, 10, 5.0)
+        held = await lane.admit()
+        cancelled = asyncio.create_task(lane.admit())
+        behind = asyncio.create_task(lane.admit())
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        await asyncio.sleep(0.01)
+        assert lane.waiting == 1
+        held.release()
+        permit = await behind
+        assert isinstance(permit, AdmissionPermit)
+        assert lane.active == 1
+        permit.release()
+        assert lane.active == 0
+
+    asyncio.run(main())
+
+
+def test_lowered_limit_drains_before_granting():
+    async def main():
+        lane = AdmissionLane("chat", 2, 10, 5.0)
+        a = await lane.admit()
+        b = await lane.admit()
+        lane.set_limit(1)
+        queued = asyncio.create_task(lane.admit())
+        await asyncio.sleep(0.01)
+        a.release()
+        await asyncio.sleep(0.01)
+        # 仍有一个名额占用，达到新上限，不放行
+        assert not queued.done()
+        b.release()
+        (await queued).release()
+        assert lane.active == 0
+
+    asyncio.run(main())
+
+
+def test_fair_lane_caps_each_user():
+    async def main():
+        lane = FairAdmissionLane("chat", 4, 10, 5.0, user_max_active=1, user_caps={"vip": 2}, user_weights={})
+        alice = await lane.admit("alice")
+        # 道里还有名额，但alice已达上限，只能排队
+        second = asyncio.create_task(lane.admit("alice"))
+        await asyncio.sleep(0.01)
+        assert not second.done()
+        vip = [await lane.admit("vip"), await lane.admit("vip")]
+        assert lane.active == 3
+        alice.release()
+        (await second).release()
+        for permit in vip:
+            permit.release()
+        assert lane.active == 0
+        assert lane.stats()["fair"]["users"] == 0
+
+    asyncio.run(main())
+
+
+def test_fair_lane_shares_slots_by_weight():
+    async def main():
+        lane = FairAdmissionLane("chat", 1, 100, 5.0, user_max_active=10, user_weights={"heavy": 2.0}, max_starvation=60)
+        held = await lane.admit("other")
+        order = []
+
+        async def waiter(user):
+            permit = await lane.admit(user)
+            order.append(user)
+            await asyncio.sleep(0)
+            permit.release()
+
+        # 一个用户先排满队，另一个用户随后到达也不会排在它的全部请求之后
+        tasks = [asyncio.create_task(waiter("light")) for _ in range(6)]
+        tasks += [asyncio.create_task(waiter("heavy")) for _ in range(6)]
+        await asyncio.sleep(0.01)
+        held.release()
+        await asyncio.gather(*tasks)
+        first = order[:9]
+        assert first.count("heavy") == 6
+        assert first.count("light") == 3
+
+    asyncio.run(main())
+
+
+def test_fair_lane_grants_starving_request_first():
+    async def main():
+        lane = FairAdmissionLane("chat", 1, 100, 5.0, user_max_active=10, user_weights={"light": 0.01}, max_starvation=0.02)
+        held = await lane.admit("light")
+        light = asyncio.create_task(lane.admit("light"))
+        await asyncio.sleep(0.05)
+        heavy = asyncio.create_task(lane.admit("heavy"))
+        await asyncio.sleep(0.01)
+        held.release()
+        # light已用过一个名额，虚拟时间远大于heavy，但已排队超过 max_starvation，先放行
+        permit = await light
+        assert not heavy.done()
+        permit.release()
+        (await heavy).release()
+        assert lane.starvation_grants >= 1
+
+    asyncio.run(main())
+
+
+def test_session_users_cache_skips_unresolved():
+    users = SessionUsers(max_entries=2)
+    users.remember("s0", None)
+    assert users.get("s0") is None
+    users.remember("s1", "alice")
+    users.remember("s2", "bob")
+    users.remember("s3", "carol")
+    assert users.get("s1") is None
+    assert users.get("s3") == "carol"
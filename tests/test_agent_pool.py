@@ -0,0 +1,174 @@
+"""Agent预热池：复用、选项不符时换新进程、空闲超时、使用次数上限后接着Claude会话预热、复用失败换新进程重试"""
+
+import asyncio
+import dataclasses
+from types import SimpleNamespace
+from typing import Optional
+
+import pytest
+
+from agent_pool import AgentClientPool
+
+
+@dataclasses.dataclass
+class Options:
+    cwd: str
+    resume: Optional[str] = None
+    include_partial_messages: bool = False
+
+
+class FakeClient:
+    """假的 ClaudeSDKClient：每轮产出init消息（带Claude会话ID）和结果"""
+
+    created = []
+
+    def __init__(self, options, fail_on_turn=None):
+        self.options = options
+        self.turns = 0
+        self.fail_on_turn = fail_on_turn
+        self.disconnected = False
+        self.prompt = None
+        FakeClient.created.append(self)
+
+    async def connect(self):
+        await asyncio.sleep(0)
+
+    async def query(self, prompt):
+        self.turns += 1
+        if self.turns == self.fail_on_turn:
+            raise RuntimeError("进程已退出")
+        self.prompt = prompt
+
+    async def receive_response(self):
+        yield SimpleNamespace(data={"session_id": "claude-1"})
+        yield SimpleNamespace(result=f"{self.prompt}#{self.turns}")
+
+    async def disconnect(self):
+        self.disconnected = True
+
+
+@pytest.fixture(autouse=True)
+def _reset_clients():
+    FakeClient.created = []
+
+
+def _pool(**kwargs):
+    factory = kwargs.pop("factory", FakeClient)
+    return AgentClientPool(
+        size=kwargs.pop("size", 4), connect_timeout=1.0, client_factory=factory, **kwargs
+    )
+
+
+async def _turn(pool, options, prompt="p", session_id="s1"):
+    return [getattr(m, "result", None) async for m in pool.run(session_id, options, prompt)]
+
+
+def test_idle_client_is_reused_for_next_turn():
+    async def main():
+        pool = _pool()
+        pool.start()
+        assert await _turn(pool, Options("/w")) == [None, "p#1"]
+        # 第一轮之后客户端停在 claude-1 会话里
+        assert await _turn(pool, Options("/w", resume="claude-1"), "q") == [None, "q#2"]
+        stats = pool.stats()
+        await pool.close()
+        return stats
+
+    stats = asyncio.run(main())
+    assert len(FakeClient.created) == 1
+    assert stats["cold_starts"] == 1
+    assert stats["warm_hits"] == 1
+    assert FakeClient.created[0].disconnected
+
+
+@pytest.mark.parametrize("changed", [
+    {"cwd": "/other"},
+    {"resume": None},
+    {"include_partial_messages": True},
+])
+def test_client_with_different_options_is_not_reused(changed):
+    async def main():
+        pool = _pool()
+        pool.start()
+        await _turn(pool, Options("/w"))
+        options = dataclasses.replace(Options("/w", resume="claude-1"), **changed)
+        await _turn(pool, options)
+        stats = pool.stats()
+        await pool.close()
+        return stats
+
+    stats = asyncio.run(main())
+    assert len(FakeClient.created) == 2
+    assert stats["stale"] == 1
+    assert stats["warm_hits"] == 0
+
+
+def test_idle_client_expires_after_ttl():
+    async def main():
+        pool = _pool(idle_ttl=0.01)
+        pool.start()
+        await _turn(pool, Options("/w"))
+        await asyncio.sleep(0.03)
+        await _turn(pool, Options("/w", resume="claude-1"))
+        stats = pool.stats()
+        await pool.close()
+        return stats
+
+    stats = asyncio.run(main())
+    assert stats["expired"] == 1
+    assert stats["cold_starts"] == 2
+    assert FakeClient.created[0].disconnected
+
+
+def test_max_uses_replaces_client_and_prewarms_resume():
+    async def main():
+        pool = _pool(max_uses=1)
+        pool.start()
+        await _turn(pool, Options("/w"))
+        stats = pool.stats()
+        # 下一轮使用后台接着 claude-1 预热的新进程
+        assert await _turn(pool, Options("/w", resume="claude-1"), "q") == [None, "q#1"]
+        after = pool.stats()
+        await pool.close()
+        return stats, after
+
+    stats, after = asyncio.run(main())
+    assert stats["retired"] == 1
+    assert stats["replenished"] == 1
+    assert len(FakeClient.created) == 2
+    assert FakeClient.created[1].options.resume == "claude-1"
+    assert after["warm_hits"] == 1
+    assert after["cold_starts"] == 1
+
+
+def test_failed_warm_client_retries_on_cold_client():
+    def factory(options):
+        # 第一个客户端在第二轮时失败
+        return FakeClient(options, fail_on_turn=2 if not FakeClient.created else None)
+
+    async def main():
+        pool = _pool(factory=factory)
+        pool.start()
+        await _turn(pool, Options("/w"))
+        result = await _turn(pool, Options("/w", resume="claude-1"), "q")
+        stats = pool.stats()
+        await pool.close()
+        return result, stats
+
+    result, stats = asyncio.run(main())
+    assert result == [None, "q#1"]
+    assert len(FakeClient.created) == 2
+    assert stats["replaced"] == 1
+    assert stats["cold_starts"] == 2
+
+
+def test_failed_cold_client_is_not_retried():
+    async def main():
+        pool = _pool(factory=lambda options: FakeClient(options, fail_on_turn=1))
+        pool.start()
+        with pytest.raises(RuntimeError):
+            await _turn(pool, Options("/w"))
+        await pool.close()
+
+    asyncio.run(main())
+    assert len(FakeClient.created) == 1
@@ -0,0 +1,81 @@
+"""JSON编码层：预序列化的chunk与完整对象编码逐字节一致，文本增量合并正确处理转义和非ASCII"""
+
+import json
+
+import pytest
+
+import fast_json
+from fast_json import SSEChunkBuilder, merge_content_chunks, sse_event
+
+TEXTS = [
+    "普通中文",
+    'quote " and backslash \\ end',
+    "换行\n制表\t回车\r",
+    "控制字符\x00\x1f",
+    "emoji 🎙️ 和   分隔符",
+    "",
+    '"},"finish_reason":null}],"session_id":"x"}',
+]
+
+
+@pytest.fixture(params=["stdlib", "orjson"])
+def backend(request, monkeypatch):
+    if request.param == "orjson" and fast_json.orjson is None:
+        pytest.skip("未安装 orjson")
+    monkeypatch.setattr(fast_json, "USE_ORJSON", request.param == "orjson")
+    return request.param
+
+
+def _full_chunk(delta, finish_reason=None, session_id="s1"):
+    return {
+        "id": "chatcmpl-1",
+        "object": "chat.completion.chunk",
+        "created": 1700000000,
+        "model": "kimi-for-podcast",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        "session_id": session_id,
+    }
+
+
+def _builder(session_id="s1"):
+    return SSEChunkBuilder("chatcmpl-1", 1700000000, "kimi-for-podcast", session_id)
+
+
+@pytest.mark.parametrize("text", TEXTS)
+def test_content_chunk_matches_full_encoding(backend, text):
+    chunk = _builder().content(text)
+    assert chunk.startswith("data: ") and chunk.endswith("\n\n")
+    assert json.loads(chunk[len("data: "):]) == _full_chunk({"content": text})
+    if backend == "stdlib":
+        assert chunk == sse_event(_full_chunk({"content": text}))
+
+
+def test_delta_and_chunk_match_full_encoding(backend):
+    builder = _builder(session_id=None)
+    delta = {"role": "assistant", "content": ""}
+    assert json.loads(builder.delta(delta)[6:]) == _full_chunk(delta, session_id=None)
+    final = builder.chunk({}, "stop", ttft_ms=12.5)
+    assert json.loads(final[6:]) == {**_full_chunk({}, "stop", session_id=None), "ttft_ms": 12.5}
+
+
+@pytest.mark.parametrize("first", TEXTS)
+@pytest.mark.parametrize("second", TEXTS)
+def test_merge_is_byte_identical_to_merged_text(backend, first, second):
+    builder = _builder()
+    merged = merge_content_chunks(builder.content(first), builder.content(second))
+    assert merged == builder.content(first + second)
+    assert json.loads(merged[6:])["choices"][0]["delta"]["content"] == first + second
+
+
+def test_merge_rejects_chunks_that_are_not_plain_text_deltas():
+    builder = _builder()
+    text = builder.content("a")
+    assert merge_content_chunks(text, _builder("s2").content("b")) is None
+    assert merge_content_chunks(text, builder.delta({"role": "assistant", "content": ""})) is None
+    assert merge_content_chunks(text, builder.delta({"content": "b", "tool_calls": []})) is None
+    assert merge_content_chunks(text, builder.delta({"content": "b"}, "stop")) is None
+    assert merge_content_chunks(text, builder.chunk({}, "stop", ttft_ms=1)) is None
+    assert merge_content_chunks(text, 'data: {"comfirm_generate": true}\n\n') is None
+    assert merge_content_chunks(text, "data: [DONE]\n\n") is None
+    assert merge_content_chunks(text, b"bytes") is None
+    assert merge_content_chunks(builder.delta({"content": "a"}), builder.content("b")) == builder.content("ab")
@@ -0,0 +1,113 @@
+"""聊天历史渲染：只增量渲染新消息、结果与完整渲染一致，截断保留整行，摘要 + 最近原文"""
+
+import uuid
+
+from session_backends import FileSystemBackend, SessionLayout
+from session_store import SessionStore
+from ultra_simple_server_paths import (
+    SUMMARY_KEEP_MESSAGES,
+    compaction_listeners,
+    load_chat_history,
+    save_message,
+    session_store,
+)
+
+
+def _counting_render():
+    rendered = []
+
+    def render(message):
+        rendered.append(message["content"])
+        return f"{message['role']}: {message['content']}\n"
+
+    return render, rendered
+
+
+def test_get_rendered_only_renders_new_messages(tmp_path):
+    store = SessionStore(FileSystemBackend(SessionLayout(tmp_path)))
+    store.create("s1", {"session_id": "s1"})
+    render, rendered = _counting_render()
+    store.append_message("s1", {"role": "user", "content": "a"})
+    store.append_message("s1", {"role": "assistant", "content": "b"})
+
+    meta, text = store.get_rendered("s1", render)
+    assert meta == {"session_id": "s1"}
+    assert text == "user: a\nassistant: b\n"
+    # 没有新消息时不再渲染
+    assert store.get_rendered("s1", render)[1] == text
+    store.append_message("s1", {"role": "user", "content": "c"})
+    assert store.get_rendered("s1", render)[1] == text + "user: c\n"
+    assert rendered == ["a", "b", "c"]
+    assert store.stats()["render_extends"] == 2
+    assert store.get_rendered("missing", render) is None
+
+
+def test_rendering_after_reload_matches_full_render(tmp_path):
+    backend = FileSystemBackend(SessionLayout(tmp_path))
+    store = SessionStore(backend)
+    store.create("s1", {"session_id": "s1"})
+    render, _ = _counting_render()
+    for content in "abc":
+        store.append_message("s1", {"role": "user", "content": content})
+        store.get_rendered("s1", render)
+    store.flush()
+
+    # 另一个缓存从后端加载后重新渲染，结果相同
+    fresh = SessionStore(backend)
+    assert fresh.get_rendered("s1", render)[1] == store.get_rendered("s1", render)[1]
+
+
+def _session(username="alice"):
+    session_id = str(uuid.uuid4())
+    session_store.create(session_id, {"session_id": session_id, "username": username})
+    return session_id
+
+
+def test_full_history_has_username_and_interrupted_marker():
+    session_id = _session()
+    save_message(session_id, "user", "你好")
+    save_message(session_id, "assistant", "部分回复", interrupted=True)
+
+    history = load_chat_history(session_id, compact=False)
+    assert history == "user:叫我[alice]。\nuser: 你好\nassistant: 部分回复（回复被中断）\n"
+    assert load_chat_history(str(uuid.uuid4()), compact=False) is None
+
+
+def test_max_chars_keeps_whole_recent_lines():
+    session_id = _session()
+    for i in range(10):
+        save_message(session_id, "user", f"第{i}条消息")
+
+    history = load_chat_history(session_id, max_chars=40, compact=False)
+    prefix, *lines = history.splitlines()
+    assert prefix == "user:叫我[alice]。"
+    assert lines and all(line.startswith("user: 第") and line.endswith("条消息") for line in lines)
+    assert lines[-1] == "user: 第9条消息"
+    assert len("\n".join(lines)) <= 40
+
+
+def test_compact_history_uses_summary_and_recent_messages():
+    session_id = _session()
+    for i in range(6):
+        save_message(session_id, "user", f"m{i}")
+    session_store.update_meta(session_id, {"summary": {"text": "之前聊了开场", "upto": 4}})
+
+    history = load_chat_history(session_id)
+    assert history == "user:叫我[alice]。\n[之前对话摘要]\n之前聊了开场\n[最近对话]\nuser: m4\nuser: m5\n"
+
+
+def test_long_history_requests_compaction():
+    session_id = _session()
+    requested = []
+    compaction_listeners.append(requested.append)
+    try:
+        for i in range(SUMMARY_KEEP_MESSAGES + 1):
+            save_message(session_id, "user", f"m{i}")
+        load_chat_history(session_id)
+        assert requested == []
+        for i in range(100):
+            save_message(session_id, "user", f"more{i}")
+        load_chat_history(session_id)
+        assert requested == [session_id]
+    finally:
+        compaction_listeners.remove(requested.append)
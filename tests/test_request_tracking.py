@@ -0,0 +1,124 @@
+"""请求生命周期：track_body 按完成、断开、出错结束请求并释放准入名额；回收回调回到事件循环执行"""
+
+import asyncio
+import threading
+
+import pytest
+
+from request_tracking import RequestTracker, finalize_on_loop, track_body
+
+
+class Permit:
+    def __init__(self):
+        self.released = 0
+
+    def release(self):
+        self.released += 1
+
+
+async def _body(chunks, error=None, delay=0.0):
+    for chunk in chunks:
+        if delay:
+            await asyncio.sleep(delay)
+        yield chunk
+    if error is not None:
+        raise error
+
+
+def _tracked(body):
+    tracker = RequestTracker()
+    permit = Permit()
+    record = tracker.begin("r1", "POST", "/v1/chat/completions", "chat", permit, "s1")
+    record.response_started(200, True)
+    finished = []
+    return tracker, permit, record, track_body(record, body, finished.append), finished
+
+
+def test_completed_body_counts_and_releases():
+    async def main():
+        tracker, permit, record, body, finished = _tracked(_body([b"ab", b"cde"]))
+        assert tracker.in_flight_streams() == 1
+        assert [chunk async for chunk in body] == [b"ab", b"cde"]
+        return tracker, permit, record, finished
+
+    tracker, permit, record, finished = asyncio.run(main())
+    assert record.outcome == "completed"
+    assert (record.bytes_sent, record.chunks) == (5, 2)
+    assert finished == [record]
+    assert permit.released == 1
+    lane = tracker.stats()["lanes"]["chat"]
+    assert (lane["completed"], lane["streams"], lane["bytes_sent"]) == (1, 1, 5)
+    assert tracker.in_flight() == 0
+
+
+@pytest.mark.parametrize("how", ["aclose", "cancel"])
+def test_disconnected_body(how):
+    async def main():
+        tracker, permit, record, body, finished = _tracked(_body([b"a"] * 100, delay=0.01))
+        if how == "aclose":
+            assert await body.__anext__() == b"a"
+            await body.aclose()
+        else:
+            async def consume():
+                async for _ in body:
+                    pass
+
+            task = asyncio.create_task(consume())
+            await asyncio.sleep(0.03)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+        return tracker, permit, record, finished
+
+    tracker, permit, record, finished = asyncio.run(main())
+    assert record.outcome == "disconnected"
+    assert finished == [record]
+    assert permit.released == 1
+    assert tracker.stats()["lanes"]["chat"]["disconnected"] == 1
+
+
+def test_failing_body_is_error():
+    async def main():
+        tracker, permit, record, body, finished = _tracked(_body([b"a"], error=ValueError("boom")))
+        with pytest.raises(ValueError):
+            async for _ in body:
+                pass
+        # 之后的回收不会重复结束请求
+        assert not record.finish("disconnected")
+        return tracker, permit, record, finished
+
+    tracker, permit, record, finished = asyncio.run(main())
+    assert record.outcome == "error"
+    assert record.chunks == 1
+    assert finished == [record]
+    assert permit.released == 1
+    assert tracker.stats()["lanes"]["chat"]["errors"] == 1
+
+
+def test_finalizer_runs_callback_on_loop_thread():
+    class Body:
+        pass
+
+    async def main():
+        loop_thread = threading.get_ident()
+        calls = []
+        done = asyncio.Event()
+
+        def callback(value):
+            calls.append((value, threading.get_ident()))
+            done.set()
+
+        body = Body()
+        finalizer = finalize_on_loop(body, callback, "disconnected")
+        # 模拟GC在其他线程里回收对象
+        thread = threading.Thread(target=finalizer)
+        thread.start()
+        thread.join()
+        assert calls == []
+        await asyncio.wait_for(done.wait(), 1)
+        assert not finalizer.alive
+        del body
+        return calls, loop_thread
+
+    calls, loop_thread = asyncio.run(main())
+    assert calls == [("disconnected", loop_thread)]
@@ -0,0 +1,75 @@
+"""首轮回复缓存：用户名按完整词替换，作为其他词的一部分出现时不缓存；TTL、容量淘汰与默认关闭"""
+
+import os
+
+import pytest
+
+import response_cache
+from response_cache import ResponseCache
+
+SYSTEM = "系统提示词"
+
+
+def _put(cache, username, prompt, result, thinks=()):
+    key = cache.fingerprint(SYSTEM, prompt, username)
+    assert key is not None
+    return key, cache.put(key, username, list(thinks), result, [{"type": "function"}])
+
+
+@pytest.mark.skipif("PODCAST_GREETING_CACHE_TTL" in os.environ, reason="环境变量覆盖了默认值")
+def test_disabled_by_default():
+    assert response_cache.GREETING_CACHE_TTL == 0
+    assert not response_cache.greeting_cache.enabled
+    assert response_cache.greeting_cache.fingerprint(SYSTEM, "你好 alice", "alice") is None
+
+
+def test_hit_substitutes_username_for_other_user():
+    cache = ResponseCache(ttl=60, max_entries=8)
+    key, stored = _put(cache, "alice", "用户 alice 开场", "你好 alice！", thinks=["alice 是新用户"])
+    assert stored
+
+    assert cache.fingerprint(SYSTEM, "用户 bob 开场", "bob") == key
+    hit = cache.get(key, "bob")
+    assert hit["result"] == "你好 bob！"
+    assert hit["thinks"] == ["bob 是新用户"]
+    assert hit["tool_calls"] == [{"type": "function"}]
+    assert cache.stats()["hits"] == 1
+
+
+def test_username_inside_other_words_is_not_cached():
+    cache = ResponseCache(ttl=60, max_entries=8)
+    # 提示词里用户名是其他词的一部分：不计算缓存键
+    assert cache.fingerprint(SYSTEM, "user al also here", "al") is None
+    # 回复里用户名是其他词的一部分：不写入
+    key, stored = _put(cache, "al", "user al", "hi al, also welcome")
+    assert not stored
+    assert cache.get(key, "bob") is None
+    assert cache.stats()["uncacheable"] == 1
+
+    key, stored = _put(cache, "al", "user al", "hi al, welcome")
+    assert stored
+    assert cache.get(key, "alexander")["result"] == "hi alexander, welcome"
+
+
+def test_unsafe_usernames_are_not_cached():
+    cache = ResponseCache(ttl=60, max_entries=8)
+    assert cache.fingerprint(SYSTEM, "x", "x") is None
+    assert cache.fingerprint(SYSTEM, "提示词", "提示词") is None
+    assert cache.fingerprint(SYSTEM, "hi", None) is None
+
+
+def test_ttl_and_lru_eviction(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(response_cache.time, "monotonic", lambda: now[0])
+    cache = ResponseCache(ttl=10, max_entries=2)
+    first, _ = _put(cache, "alice", "p1 alice", "r1")
+    second, _ = _put(cache, "alice", "p2 alice", "r2")
+    assert cache.get(first, "bob") is not None
+    third, _ = _put(cache, "alice", "p3 alice", "r3")
+    # second 最久未使用，被淘汰
+    assert cache.get(second, "bob") is None
+    assert cache.stats()["evictions"] == 1
+
+    now[0] += 11
+    assert cache.get(first, "bob") is None
+    assert cache.stats()["expired"] == 1
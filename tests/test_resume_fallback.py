@@ -0,0 +1,144 @@
+"""恢复Claude会话：只有CLI报告会话不存在时才清除会话ID并重放历史，其他错误照常返回并保留会话ID
+
+测试用最小的假 claude_agent_sdk 模块替换 query，只提供本模块用到的类型。
+"""
+
+import asyncio
+import sys
+import types
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, List, Optional
+
+import pytest
+
+from podcast_sdk import ClaudeAgentSDK
+from ultra_simple_server_paths import create_session_context, load_claude_session_id, update_claude_session_in_context
+
+MISSING = "No conversation found with session ID: claude-old"
+
+
+@dataclass
+class TextBlock:
+    text: str
+
+
+@dataclass
+class ToolUseBlock:
+    name: str
+    input: dict = field(default_factory=dict)
+
+
+@dataclass
+class AssistantMessage:
+    content: List[Any]
+
+
+@dataclass
+class ResultMessage:
+    result: Optional[str]
+    is_error: bool = False
+    subtype: str = "success"
+
+
+class ClaudeAgentOptions:
+    def __init__(self, **kwargs):
+        self.resume = None
+        self.__dict__.update(kwargs)
+
+
+class ProcessError(Exception):
+    def __init__(self, message, stderr=None):
+        super().__init__(message)
+        self.stderr = stderr
+
+
+@pytest.fixture
+def fake_sdk(monkeypatch):
+    """安装假SDK，返回 (调用记录, 设置每次resume时的行为)"""
+    calls = []
+    behavior = {}
+
+    async def query(prompt, options):
+        calls.append(options.resume)
+        if options.resume:
+            outcome = behavior["resume"]
+            if isinstance(outcome, Exception):
+                raise outcome
+            yield outcome
+            return
+        yield AssistantMessage([TextBlock("思考")])
+        yield ResultMessage("重放后的回复")
+
+    sdk = types.ModuleType("claude_agent_sdk")
+    sdk.query = query
+    sdk.ClaudeAgentOptions = ClaudeAgentOptions
+    sdk_types = types.ModuleType("claude_agent_sdk.types")
+    for cls in (TextBlock, ToolUseBlock, AssistantMessage, ResultMessage):
+        setattr(sdk_types, cls.__name__, cls)
+    sdk.types = sdk_types
+    monkeypatch.setitem(sys.modules, "claude_agent_sdk", sdk)
+    monkeypatch.setitem(sys.modules, "claude_agent_sdk.types", sdk_types)
+    return calls, behavior
+
+
+def _resumable_session(agent):
+    session_id = str(uuid.uuid4())
+    work_dir = str(create_session_context(session_id, "alice"))
+    update_claude_session_in_context(session_id, "claude-old")
+    agent.claude_session_ids[session_id] = "claude-old"
+    return session_id, work_dir
+
+
+def _query(agent, session_id, work_dir):
+    return asyncio.run(agent._query_claude_agent("继续", work_dir, session_id))
+
+
+def _stream(agent, session_id, work_dir):
+    async def collect():
+        return "".join([chunk async for chunk in agent._stream_claude_agent("继续", work_dir, session_id)])
+
+    return asyncio.run(collect())
+
+
+@pytest.mark.parametrize("run", [_query, _stream])
+@pytest.mark.parametrize("outcome", [
+    ResultMessage(MISSING, is_error=True, subtype="error_during_execution"),
+    ProcessError("Command failed with exit code 1", stderr=MISSING),
+])
+def test_missing_session_falls_back_to_replay(fake_sdk, run, outcome):
+    calls, behavior = fake_sdk
+    behavior["resume"] = outcome
+    agent = ClaudeAgentSDK()
+    session_id, work_dir = _resumable_session(agent)
+
+    output = run(agent, session_id, work_dir)
+    text = output if isinstance(output, str) else output["content"]
+
+    assert calls == ["claude-old", None]
+    assert "重放后的回复" in text
+    assert agent.resume_fallbacks == 1
+    assert agent.claude_session_ids.get(session_id) is None
+    assert load_claude_session_id(session_id) is None
+
+
+@pytest.mark.parametrize("run", [_query, _stream])
+@pytest.mark.parametrize("outcome", [
+    ResultMessage("API Error: 529 overloaded", is_error=True, subtype="error_during_execution"),
+    ProcessError("Command failed with exit code 1", stderr="rate limited"),
+])
+def test_other_errors_keep_session(fake_sdk, run, outcome):
+    calls, behavior = fake_sdk
+    behavior["resume"] = outcome
+    agent = ClaudeAgentSDK()
+    session_id, work_dir = _resumable_session(agent)
+
+    output = run(agent, session_id, work_dir)
+    text = output if isinstance(output, str) else output["content"]
+
+    assert calls == ["claude-old"]
+    assert "重放后的回复" not in text
+    assert ("API Error" in text) or ("Command failed" in text)
+    assert agent.resume_fallbacks == 0
+    assert agent.claude_session_ids.get(session_id) == "claude-old"
+    assert load_claude_session_id(session_id) == "claude-old"
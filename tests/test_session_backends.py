@@ -0,0 +1,50 @@
+"""会话归档：存在性检查和指纹不解压归档，解压用的临时目录不算会话"""
+
+from session_backends import REHYDRATE_PREFIX, FileSystemBackend, SessionLayout
+
+
+def _archived_backend(tmp_path):
+    backend = FileSystemBackend(SessionLayout(tmp_path))
+    backend.write("s1", {"session_id": "s1"}, [{"role": "user", "content": "hi"}])
+    assert backend.archive("s1") is not None
+    return backend
+
+
+def test_exists_and_fingerprint_do_not_rehydrate(tmp_path):
+    backend = _archived_backend(tmp_path)
+    layout = backend.layout
+    session_dir = layout.sharded_path("s1")
+
+    assert backend.exists("s1")
+    fingerprint = backend.fingerprint("s1")
+    assert fingerprint[0] == "archived"
+    assert layout.exists("s1")
+    assert not session_dir.exists()
+    assert layout.rehydrated == 0
+
+    assert not backend.exists("missing")
+    assert backend.fingerprint("missing") == (None, None)
+
+
+def test_access_still_rehydrates(tmp_path):
+    backend = _archived_backend(tmp_path)
+    fingerprint = backend.fingerprint("s1")
+
+    meta, messages = backend.load("s1")
+
+    assert meta["session_id"] == "s1"
+    assert [m["content"] for m in messages] == ["hi"]
+    assert backend.layout.rehydrated == 1
+    assert backend.layout.sharded_path("s1").is_dir()
+    assert backend.fingerprint("s1") != fingerprint
+
+
+def test_rehydrate_temp_dirs_are_not_sessions(tmp_path):
+    backend = FileSystemBackend(SessionLayout(tmp_path))
+    backend.write("s1", {"session_id": "s1"}, [])
+    shard = backend.layout.sharded_path("s1").parent
+    (shard / f"{REHYDRATE_PREFIX}abc").mkdir()
+    (tmp_path / f"{REHYDRATE_PREFIX}def").mkdir()
+    (tmp_path / f"{REHYDRATE_PREFIX}def" / "meta.json").write_text("{}")
+
+    assert [session_id for session_id, _ in backend.layout.iter_session_paths()] == ["s1"]
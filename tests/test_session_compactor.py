@@ -0,0 +1,89 @@
+"""聊天历史压缩：只摘要保留窗口之前的新消息；摘要期间会话被删除或摘要被更新时放弃写入"""
+
+import pytest
+
+from session_backends import FileSystemBackend, SessionLayout
+from session_compactor import SessionCompactor
+from session_store import SessionStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SessionStore(FileSystemBackend(SessionLayout(tmp_path)))
+    store.create("s1", {"session_id": "s1", "created_at": "2026-01-01T00:00:00"})
+    for i in range(10):
+        store.append_message("s1", {"role": "user", "content": f"m{i}"})
+    return store
+
+
+def _compactor(store, during=None):
+    calls = []
+
+    def summarize(previous, messages):
+        calls.append((previous, [m["content"] for m in messages]))
+        if during is not None:
+            during()
+        return f"{previous}+{len(messages)}"
+
+    return SessionCompactor(store, keep_messages=4, summarize=summarize), calls
+
+
+def test_summarizes_messages_before_keep_window(store):
+    compactor, calls = _compactor(store)
+
+    assert compactor.compact("s1")
+    assert calls == [("", [f"m{i}" for i in range(6)])]
+    summary = store.get_meta("s1")["summary"]
+    assert summary["text"] == "+6"
+    assert summary["upto"] == 6
+
+    # 没有新消息移出保留窗口时不再摘要
+    assert not compactor.compact("s1")
+    for i in range(10, 13):
+        store.append_message("s1", {"role": "user", "content": f"m{i}"})
+    assert compactor.compact("s1")
+    assert calls[-1] == ("+6", ["m6", "m7", "m8"])
+    assert store.get_meta("s1")["summary"]["upto"] == 9
+    assert compactor.stats()["summarized_messages"] == 9
+
+
+def test_missing_session_is_ignored(store):
+    compactor, calls = _compactor(store)
+    assert not compactor.compact("missing")
+    assert calls == []
+
+
+def _delete(store):
+    # 有未写回数据的会话不会被删除，先写回
+    store.flush()
+    assert store.delete("s1") is not None
+
+
+def test_session_deleted_during_summary_is_not_recreated(store):
+    compactor, _ = _compactor(store, during=lambda: _delete(store))
+
+    assert not compactor.compact("s1")
+    assert store.get_meta("s1") is None
+    assert compactor.stats()["stale"] == 1
+
+
+def test_session_recreated_during_summary_is_not_overwritten(store):
+    def recreate():
+        _delete(store)
+        store.create("s1", {"session_id": "s1", "created_at": "2026-02-01T00:00:00"})
+
+    compactor, _ = _compactor(store, during=recreate)
+
+    assert not compactor.compact("s1")
+    assert "summary" not in store.get_meta("s1")
+
+
+def test_concurrent_summary_update_wins(store):
+    def other_compaction():
+        store.update_meta("s1", {"summary": {"text": "other", "upto": 5}})
+
+    compactor, _ = _compactor(store, during=other_compaction)
+
+    assert not compactor.compact("s1")
+    assert store.get_meta("s1")["summary"] == {"text": "other", "upto": 5}
+    assert compactor.stats()["compactions"] == 0
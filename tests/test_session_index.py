@@ -0,0 +1,86 @@
+"""会话存在性索引：格式检查拒绝路径穿越，构建前退回慢检查，构建后索引为准，fallback 命中后补进索引"""
+
+import uuid
+
+import pytest
+
+from session_index import MAX_SESSION_ID_LENGTH, SessionIndex
+
+
+def _never(session_id):
+    raise AssertionError(f"不应调用慢检查: {session_id}")
+
+
+@pytest.mark.parametrize(
+    "session_id",
+    ["", ".", "..", ".hidden", "../etc", "a/b", "a\\b", "a\0b", "x" * (MAX_SESSION_ID_LENGTH + 1)],
+)
+def test_malformed_ids_are_rejected_without_checks(session_id):
+    index = SessionIndex(fallback=_never)
+    assert not index.is_well_formed(session_id)
+    assert not index.exists(session_id, _never)
+    index.build([])
+    assert not index.exists(session_id, _never)
+    assert index.stats()["rejected_malformed"] == 2
+
+
+def test_strict_mode_requires_uuid():
+    index = SessionIndex(strict=True)
+    assert index.is_well_formed(str(uuid.uuid4()))
+    assert not index.is_well_formed("session-1")
+    assert not index.is_well_formed(str(uuid.uuid4()).upper())
+    assert SessionIndex().is_well_formed("session-1")
+    assert SessionIndex().is_well_formed("x" * MAX_SESSION_ID_LENGTH)
+
+
+def test_slow_check_only_before_build():
+    index = SessionIndex()
+    checked = []
+
+    def slow_check(session_id):
+        checked.append(session_id)
+        return session_id == "on-disk"
+
+    assert index.exists("on-disk", slow_check)
+    assert not index.exists("missing", slow_check)
+    assert checked == ["on-disk", "missing"]
+
+    index.build(["on-disk"])
+    assert index.exists("on-disk", _never)
+    assert not index.exists("missing", _never)
+    stats = index.stats()
+    assert (stats["ready"], stats["hits"], stats["misses"]) == (True, 1, 1)
+
+
+def test_add_and_discard_after_build():
+    index = SessionIndex()
+    # 构建期间新建的会话不会被构建结果覆盖
+    index.add("created-during-build")
+    index.build(["s1", "s2"])
+    assert index.stats()["known_sessions"] == 3
+    assert index.exists("created-during-build", _never)
+
+    index.discard("s1")
+    index.discard("never-existed")
+    assert not index.exists("s1", _never)
+    index.add("s3")
+    assert index.exists("s3", _never)
+
+
+def test_fallback_hit_is_added_to_index():
+    external = {"other-process"}
+    calls = []
+
+    def fallback(session_id):
+        calls.append(session_id)
+        return session_id in external
+
+    index = SessionIndex(fallback=fallback)
+    index.build([])
+    assert not index.exists("missing", _never)
+    assert index.exists("other-process", _never)
+    # 命中后进入索引，之后不再走兜底检查
+    assert index.exists("other-process", _never)
+    assert calls == ["missing", "other-process"]
+    stats = index.stats()
+    assert (stats["fallback"], stats["fallback_hits"], stats["hits"], stats["misses"]) == (True, 1, 1, 2)
@@ -0,0 +1,87 @@
+"""会话写入串行化：许多任务同时写同一个会话，消息和Claude会话ID都不能丢失"""
+
+import asyncio
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from session_locks import SessionLockManager, session_locks
+from session_store import SessionStore
+from ultra_simple_server_paths import (
+    create_session_context,
+    save_message,
+    session_store,
+    update_claude_session_in_context,
+)
+
+TASKS = 20
+MESSAGES_PER_TASK = 10
+
+
+def _reloaded_store() -> SessionStore:
+    """写回全部数据后，绕过缓存从存储后端重新加载"""
+    session_store.flush()
+    return SessionStore(session_store.backend)
+
+
+def test_concurrent_writers_lose_nothing():
+    session_id = str(uuid.uuid4())
+    create_session_context(session_id, "stress")
+
+    async def writer(task: int):
+        for i in range(MESSAGES_PER_TASK):
+            await session_locks.run(
+                session_id, save_message, session_id, "user", f"{task}:{i}", None, f"{task}-{i}"
+            )
+            await session_locks.run(
+                session_id, update_claude_session_in_context, session_id, f"claude-{task}-{i}"
+            )
+
+    async def main():
+        with ThreadPoolExecutor(max_workers=10) as pool:
+            session_locks.executor = pool
+            try:
+                await asyncio.gather(*(writer(task) for task in range(TASKS)))
+            finally:
+                session_locks.executor = None
+
+    asyncio.run(main())
+
+    store = _reloaded_store()
+    messages = store.get_messages(session_id)
+    assert len(messages) == TASKS * MESSAGES_PER_TASK
+    by_task = {}
+    for message in messages:
+        task, i = map(int, message["content"].split(":"))
+        by_task.setdefault(task, []).append(i)
+    # 每个任务自己的消息按写入顺序出现
+    assert by_task == {task: list(range(MESSAGES_PER_TASK)) for task in range(TASKS)}
+
+    meta = store.get_meta(session_id)
+    assert meta["username"] == "stress"
+    assert meta["claude_session_id"].startswith("claude-")
+
+
+def test_same_session_always_maps_to_same_lock():
+    locks = SessionLockManager(stripes=8)
+    assert locks.lock_for("a") is locks.lock_for("a")
+    assert len({id(locks.lock_for(str(i))) for i in range(100)}) <= 8
+
+
+def test_hold_serializes_one_session():
+    locks = SessionLockManager(stripes=4)
+    active = []
+    peak = []
+
+    async def critical():
+        async with locks.hold("s"):
+            active.append(1)
+            peak.append(len(active))
+            await asyncio.sleep(0)
+            active.pop()
+
+    async def main():
+        await asyncio.gather(*(critical() for _ in range(50)))
+
+    asyncio.run(main())
+    assert max(peak) == 1
+    assert locks.contended > 0
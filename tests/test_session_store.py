@@ -0,0 +1,246 @@
+"""SessionStore：缓存项在读取与修改之间被移出缓存时，写入不能丢失"""
+
+import pytest
+
+from session_backends import FileSystemBackend, SessionLayout
+from session_store import SessionStore
+
+
+@pytest.fixture
+def backend(tmp_path):
+    return FileSystemBackend(SessionLayout(tmp_path))
+
+
+def _drop_after_get(store, times=1):
+    """让 _get_entry 返回后立即把缓存项移出缓存（模拟淘汰、失效或归档）"""
+    original = store._get_entry
+    remaining = [times]
+
+    def get_entry(session_id):
+        entry = original(session_id)
+        if entry is not None and remaining[0] > 0:
+            remaining[0] -= 1
+            with store._lock:
+                store._drop_locked(session_id)
+        return entry
+
+    store._get_entry = get_entry
+
+
+def _reload(backend, session_id):
+    return SessionStore(backend).get_messages(session_id)
+
+
+def test_append_survives_entry_dropped_before_lock(backend):
+    store = SessionStore(backend)
+    store.create("s1", {"session_id": "s1"})
+    _drop_after_get(store)
+
+    store.append_message("s1", {"role": "user", "content": "hello"}, durable=True)
+
+    assert [m["content"] for m in _reload(backend, "s1")] == ["hello"]
+    assert [m["content"] for m in store.get_messages("s1")] == ["hello"]
+
+
+def test_update_meta_survives_entry_dropped_before_lock(backend):
+    store = SessionStore(backend)
+    store.create("s1", {"session_id": "s1"})
+    _drop_after_get(store)
+
+    store.update_meta("s1", {"claude_session_id": "c1"}, durable=True)
+
+    assert SessionStore(backend).get_meta("s1")["claude_session_id"] == "c1"
+
+
+def test_counter_meta_survives_entry_dropped_before_lock(backend):
+    store = SessionStore(backend)
+    store.create("s1", {"session_id": "s1"})
+    store.append_message("s1", {"role": "assistant", "content": "x"}, durable=True)
+    _drop_after_get(store)
+
+    assert store.counter_meta("s1", "n", lambda messages: len(messages)) == 1
+    store.flush()
+
+    assert SessionStore(backend).get_meta("s1")["n"] == 1
+
+
+def test_revalidation_drop_does_not_lose_append(backend):
+    store = SessionStore(backend, revalidate=True)
+    store.create("s1", {"session_id": "s1"})
+    # 另一个写者修改了会话，缓存项失效后重新加载
+    SessionStore(backend).append_message("s1", {"role": "user", "content": "other"}, durable=True)
+
+    store.append_message("s1", {"role": "user", "content": "mine"}, durable=True)
+
+    assert [m["content"] for m in _reload(backend, "s1")] == ["other", "mine"]
+
+
+def test_append_creates_missing_session(backend):
+    store = SessionStore(backend)
+    store.append_message("new", {"role": "user", "content": "hi"}, durable=True)
+    assert [m["content"] for m in _reload(backend, "new")] == ["hi"]
+
+
+def test_counter_meta_missing_session(backend):
+    store = SessionStore(backend)
+    assert store.counter_meta("missing", "n", lambda messages: 0) is None
+
+
+def test_group_commit_batches_sessions(backend):
+    store = SessionStore(backend, flush_interval=60)
+    for i in range(5):
+        store.create(f"s{i}", {"session_id": f"s{i}"})
+    seqs = [
+        store.append_message(f"s{i % 5}", {"role": "user", "content": str(i)})
+        for i in range(20)
+    ]
+
+    assert store.flush()
+    assert store.flushes == 1
+    assert store.max_batch_sessions == 5
+    assert store.max_batch_messages == 20
+    assert store.wait_durable(seqs[-1], timeout=0)
+    assert [m["content"] for m in _reload(backend, "s3")] == ["3", "8", "13", "18"]
+
+
+def test_failed_meta_write_is_retried_without_duplicates(backend, monkeypatch):
+    store = SessionStore(backend, flush_interval=60)
+    store.create("s1", {"session_id": "s1"})
+    store.append_message("s1", {"role": "user", "content": "a"})
+    store.update_meta("s1", {"title": "t"})
+
+    original = backend._write_json_atomic
+    calls = []
+
+    def failing_write(path, data):
+        calls.append(path)
+        if len(calls) == 1:
+            raise OSError("disk full")
+        return original(path, data)
+
+    monkeypatch.setattr(backend, "_write_json_atomic", failing_write)
+    assert not store.flush()
+    assert store.flush()
+
+    assert [m["content"] for m in _reload(backend, "s1")] == ["a"]
+    assert SessionStore(backend).get_meta("s1")["title"] == "t"
+
+
+def test_short_write_is_rolled_back(backend, monkeypatch):
+    import session_backends
+
+    store = SessionStore(backend, flush_interval=60)
+    store.create("s1", {"session_id": "s1"})
+    store.append_message("s1", {"role": "user", "content": "a"}, durable=True)
+    store.append_message("s1", {"role": "user", "content": "b"})
+    store.append_message("s1", {"role": "user", "content": "c"})
+
+    real_write = session_backends.os.write
+    calls = []
+
+    def short_write(fd, data):
+        calls.append(len(data))
+        if len(calls) == 1:
+            return real_write(fd, data[: len(data) // 2])
+        return real_write(fd, data)
+
+    monkeypatch.setattr(session_backends.os, "write", short_write)
+    assert not store.flush()
+    assert store.flush()
+
+    assert [m["content"] for m in _reload(backend, "s1")] == ["a", "b", "c"]
+
+
+def _race_with_rmtree(monkeypatch, action):
+    """后端删除会话目录前执行 action（模拟回收器归档/删除时刚好来了新消息），最多等它0.5s"""
+    import session_backends
+    import threading
+
+    real_rmtree = session_backends.shutil.rmtree
+    done = threading.Event()
+    threads = []
+
+    def rmtree(path, *args, **kwargs):
+        if not threads:
+            thread = threading.Thread(target=lambda: (action(), done.set()))
+            threads.append(thread)
+            thread.start()
+            done.wait(0.5)
+        return real_rmtree(path, *args, **kwargs)
+
+    monkeypatch.setattr(session_backends.shutil, "rmtree", rmtree)
+    return threads
+
+
+@pytest.mark.parametrize("remove", ["archive", "delete"])
+def test_append_during_reaping_is_not_lost(backend, monkeypatch, remove):
+    store = SessionStore(backend)
+    store.create("s1", {"session_id": "s1"})
+    store.append_message("s1", {"role": "user", "content": "old"}, durable=True)
+    threads = _race_with_rmtree(
+        monkeypatch,
+        lambda: store.append_message("s1", {"role": "user", "content": "new"}, durable=True),
+    )
+
+    getattr(store, remove)("s1")
+    for thread in threads:
+        thread.join(5)
+    assert threads, "后端没有删除会话目录"
+    store.flush()
+
+    contents = [m["content"] for m in _reload(backend, "s1")]
+    # 归档的会话在追加时恢复；删除后到达的消息写入新会话
+    assert contents == (["old", "new"] if remove == "archive" else ["new"])
+
+
+def _tags(messages):
+    return sum(m["content"].count("<tag>") for m in messages)
+
+
+def test_counter_backfills_once_then_counts_appends(backend):
+    store = SessionStore(backend)
+    store.create("s1", {"session_id": "s1"})
+    store.append_message("s1", {"content": "<tag><tag>"}, counters={"tags": 2})
+    # 计数器还不存在：追加不创建，第一次读取时从全部消息回填
+    assert "tags" not in store.get_meta("s1")
+    assert store.counter_meta("s1", "tags", _tags) == 2
+
+    store.append_message("s1", {"content": "<tag>"}, counters={"tags": 1})
+    store.append_message("s1", {"content": "none"}, counters={"tags": 0})
+    assert store.counter_meta("s1", "tags", _tags) == 3
+    assert store.counter_meta("missing", "tags", _tags) is None
+
+    store.flush()
+    assert SessionStore(backend).get_meta("s1")["tags"] == 3
+
+
+def test_confirm_count_backfill_between_append_and_increment(monkeypatch):
+    """保存助手消息的同时读取计数（旧会话首次回填），同一条消息不能计两次"""
+    import uuid
+
+    from ultra_simple_server_paths import (
+        get_confirm_generate_count,
+        save_message,
+        session_store,
+    )
+
+    session_id = str(uuid.uuid4())
+    session_store.create(session_id, {"session_id": session_id})
+    # 旧会话：历史里有标记，元数据里还没有计数器
+    session_store.append_message(session_id, {"role": "assistant", "content": "<confirm_generate>旧"})
+
+    real_append = session_store.append_message
+
+    def append_then_backfill(*args, **kwargs):
+        seq = real_append(*args, **kwargs)
+        get_confirm_generate_count(session_id)
+        return seq
+
+    monkeypatch.setattr(session_store, "append_message", append_then_backfill)
+    save_message(session_id, "assistant", "<comfirm_generate>新</comfirm_generate>")
+    monkeypatch.undo()
+
+    assert get_confirm_generate_count(session_id) == 2
+    save_message(session_id, "assistant", "<confirm_generate>再</confirm_generate>")
+    save_message(session_id, "user", "<confirm_generate>")
+    assert get_confirm_generate_count(session_id) == 3
@@ -0,0 +1,126 @@
+"""会话导出/导入：往返一致、冲突策略、替换在提交时生效、导入中止不改动已有会话、坏数据报错"""
+
+import json
+import uuid
+
+import pytest
+
+from session_transfer import SessionImporter, export_session, iter_export
+from ultra_simple_server_paths import session_exists, session_store
+
+
+def _new_session(messages):
+    session_id = str(uuid.uuid4())
+    session_store.create(session_id, {"session_id": session_id, "username": "alice"})
+    for content in messages:
+        session_store.append_message(session_id, {"role": "user", "content": content})
+    session_store.flush()
+    return session_id
+
+
+def _export_lines(session_id):
+    return b"".join(export_session(session_id)).splitlines()
+
+
+def _contents(session_id):
+    return [m["content"] for m in session_store.get_messages(session_id)]
+
+
+def test_export_import_round_trip():
+    session_id = _new_session(["你好", "第二条"])
+    lines = _export_lines(session_id)
+    records = [json.loads(line) for line in lines]
+    assert [r["type"] for r in records] == ["export", "session", "message", "message", "end"]
+
+    session_store.delete(session_id)
+    assert session_store.get_meta(session_id) is None
+
+    importer = SessionImporter(batch_messages=1)
+    importer.feed(lines)
+    result = importer.finish()
+    assert result["sessions_imported"] == 1
+    assert result["messages_imported"] == 2
+    assert result["errors"] == []
+    assert session_store.get_meta(session_id)["username"] == "alice"
+    assert _contents(session_id) == ["你好", "第二条"]
+    assert session_exists(session_id)
+
+
+def test_conflict_skip_keeps_existing():
+    session_id = _new_session(["old"])
+    lines = _export_lines(session_id)
+    session_store.append_message(session_id, {"role": "user", "content": "local"})
+    session_store.flush()
+
+    importer = SessionImporter(on_conflict="skip")
+    importer.feed(lines)
+    result = importer.finish()
+    assert result["sessions_imported"] == 0
+    assert result["sessions_skipped"] == 1
+    assert _contents(session_id) == ["old", "local"]
+
+
+def test_conflict_replace_applies_at_commit():
+    session_id = _new_session(["a", "b", "c"])
+    lines = _export_lines(session_id)
+    session_store.append_message(session_id, {"role": "user", "content": "local"})
+    session_store.flush()
+
+    # 批大小小于会话消息数：替换的会话仍然整段提交，期间已有会话保持不变
+    importer = SessionImporter(on_conflict="replace", batch_messages=1)
+    importer.feed(lines[:-1])
+    assert _contents(session_id) == ["a", "b", "c", "local"]
+    result = importer.finish()
+    assert result["sessions_imported"] == 1
+    assert result["messages_imported"] == 3
+    assert _contents(session_id) == ["a", "b", "c"]
+
+
+def test_aborted_replace_keeps_existing():
+    session_id = _new_session(["a", "b"])
+    lines = _export_lines(session_id)
+    session_store.append_message(session_id, {"role": "user", "content": "local"})
+    session_store.flush()
+
+    importer = SessionImporter(on_conflict="replace", batch_messages=1)
+    importer.feed(lines[:3])
+    result = importer.abort()
+    assert result["sessions_imported"] == 0
+    assert result["messages_imported"] == 0
+    assert _contents(session_id) == ["a", "b", "local"]
+
+
+def test_malformed_lines_are_reported():
+    good = str(uuid.uuid4())
+    lines = [
+        b"not json",
+        b"[1, 2]",
+        json.dumps({"type": "session", "session_id": "../escape", "meta": {}}).encode(),
+        json.dumps({"type": "message", "session_id": "../escape", "message": {"content": "x"}}).encode(),
+        json.dumps({"type": "session", "session_id": good, "meta": {"username": "bob"}}).encode(),
+        json.dumps({"type": "message", "session_id": good, "message": "not an object"}).encode(),
+        json.dumps({"type": "message", "session_id": good, "message": {"content": "ok"}}).encode(),
+    ]
+    importer = SessionImporter()
+    importer.feed(lines)
+    result = importer.finish()
+    assert result["lines"] == 7
+    assert result["sessions_imported"] == 1
+    assert result["messages_imported"] == 1
+    assert len(result["errors"]) == 4
+    assert session_store.get_meta("../escape") is None
+    assert _contents(good) == ["ok"]
+
+
+def test_unknown_format_and_policy_are_rejected():
+    with pytest.raises(ValueError):
+        SessionImporter(on_conflict="merge")
+    importer = SessionImporter()
+    with pytest.raises(ValueError):
+        importer.feed([json.dumps({"type": "export", "format": "other"}).encode()])
+
+
+def test_export_without_sessions_is_header_and_end():
+    records = [json.loads(line) for line in b"".join(iter_export([])).splitlines()]
+    assert [r["type"] for r in records] == ["export", "end"]
+    assert records[-1]["sessions"] == 0
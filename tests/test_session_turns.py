@@ -0,0 +1,149 @@
+"""会话轮次调度：重复提交窗口和幂等键合并、合并请求回放、排队满拒绝、取消后让出轮次"""
+
+import asyncio
+
+import pytest
+
+from session_turns import SessionTurnScheduler
+
+
+def _run(main):
+    return asyncio.run(main())
+
+
+def test_double_submit_within_window_is_coalesced_and_replayed():
+    async def main():
+        turns = SessionTurnScheduler(max_queue=2, coalesce_window=60)
+        first = turns.enter("s1", "fp")
+        second = turns.enter("s1", "fp")
+        assert first.status == "running"
+        assert second.status == "coalesced"
+
+        await first.wait_turn()
+        first.flight.publish("a")
+        replayed = []
+
+        async def follow():
+            async for chunk in second.flight.replay():
+                replayed.append(chunk)
+
+        follower = asyncio.create_task(follow())
+        await asyncio.sleep(0)
+        first.flight.publish("b")
+        first.flight.finish()
+        first.release()
+        await follower
+        assert replayed == ["a", "b"]
+        assert turns.stats()["coalesced"] == 1
+
+    _run(main)
+
+
+def test_repeat_after_window_is_queued():
+    async def main():
+        turns = SessionTurnScheduler(max_queue=2, coalesce_window=0)
+        first = turns.enter("s1", "fp")
+        await asyncio.sleep(0.01)
+        # 同样的短消息在窗口外再次发送：有意重复，排队执行而不是回放上一轮
+        repeat = turns.enter("s1", "fp")
+        assert repeat.status == "queued"
+        assert repeat.position == 1
+        await first.wait_turn()
+        first.flight.finish(result="r1")
+        first.release()
+        await repeat.wait_turn()
+        assert repeat.flight is not first.flight
+        repeat.release()
+        assert turns.stats()["active_sessions"] == 0
+
+    _run(main)
+
+
+def test_idempotency_key_coalesces_outside_window():
+    async def main():
+        turns = SessionTurnScheduler(max_queue=2, coalesce_window=0)
+        first = turns.enter("s1", "fp", "k1")
+        await asyncio.sleep(0.01)
+        assert turns.enter("s1", "fp", "k1").status == "coalesced"
+        # 键不同，或同一个键但内容不同，都不合并
+        other_key = turns.enter("s1", "fp", "k2")
+        other_content = turns.enter("s1", "fp2", "k1")
+        assert other_key.status == "queued"
+        assert other_content.status == "queued"
+
+        other_key.release()
+        other_content.release()
+        await first.wait_turn()
+        first.flight.finish(result="r1")
+        # 已结束的执行不再合并
+        retry = turns.enter("s1", "fp", "k1")
+        assert retry.status == "queued"
+        first.release()
+        retry.release()
+
+    _run(main)
+
+
+def test_full_queue_is_rejected():
+    async def main():
+        turns = SessionTurnScheduler(max_queue=1, coalesce_window=0)
+        running = turns.enter("s1", "a")
+        queued = turns.enter("s1", "b")
+        assert queued.status == "queued"
+        assert turns.enter("s1", "c") is None
+        # 其他会话不受影响
+        assert turns.enter("s2", "c").status == "running"
+        assert turns.stats()["rejected"] == 1
+        running.release()
+        queued.release()
+
+    _run(main)
+
+
+def test_cancelled_waiter_releases_its_place():
+    async def main():
+        turns = SessionTurnScheduler(max_queue=2, coalesce_window=0)
+        running = turns.enter("s1", "a")
+        cancelled = turns.enter("s1", "b")
+        behind = turns.enter("s1", "c")
+
+        async def wait(ticket):
+            try:
+                await ticket.wait_turn()
+            except BaseException:
+                ticket.release()
+                raise
+
+        waiter = asyncio.create_task(wait(cancelled))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert turns.queue_depth("s1") == 1
+        assert turns.stats()["abandoned"] == 1
+
+        running.release()
+        await asyncio.wait_for(behind.wait_turn(), 1)
+        behind.release()
+        # 重复释放无副作用
+        behind.release()
+        assert turns.stats()["active_sessions"] == 0
+
+    _run(main)
+
+
+def test_interrupted_run_fails_coalesced_followers():
+    async def main():
+        turns = SessionTurnScheduler(max_queue=2, coalesce_window=60)
+        first = turns.enter("s1", "fp")
+        follower = turns.enter("s1", "fp")
+        await first.wait_turn()
+        result = asyncio.create_task(follower.flight.wait_result())
+        await asyncio.sleep(0)
+        # 原请求没有正常结束就释放（客户端断开）
+        first.release()
+        with pytest.raises(RuntimeError):
+            await result
+        follower.release()
+
+    _run(main)
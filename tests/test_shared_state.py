@@ -0,0 +1,108 @@
+"""多worker共享状态：另一个worker持有数据库写锁时，事件循环中的调用不等待"""
+
+import asyncio
+import os
+import sqlite3
+import time
+
+from admission import AdmissionLane, AdmissionPermit
+from shared_state import SQLiteSharedState
+
+
+def _hold_write_lock(path) -> sqlite3.Connection:
+    """模拟另一个worker正在写入"""
+    other = sqlite3.connect(str(path), isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    return other
+
+
+def test_loop_calls_do_not_wait_for_lock(tmp_path):
+    state = SQLiteSharedState(tmp_path / "shared.db", workers=2)
+    slots = state.slots("chat")
+    assert slots.try_acquire(2)
+    other = _hold_write_lock(state.path)
+    try:
+        start = time.monotonic()
+        assert not slots.try_acquire(2)
+        assert not state.try_lock_session("s1")
+        # 释放名额交给后台线程，等锁释放后写入
+        slots.release()
+        assert time.monotonic() - start < 0.5
+        assert slots.total() == 1
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+    state._last_background.result(timeout=5)
+    assert slots.total() == 0
+    assert state.try_lock_session("s1")
+    state.close()
+
+
+def test_session_map_reads_pending_writes(tmp_path):
+    state = SQLiteSharedState(tmp_path / "shared.db", workers=2)
+    sessions = state.claude_sessions
+    sessions["ours"] = "claude-1"
+    other = _hold_write_lock(state.path)
+    try:
+        sessions["ours"] = "claude-2"
+        assert sessions.get("ours") == "claude-2"
+        assert sessions.pop("ours") == "claude-2"
+        assert "ours" not in sessions
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+    state._last_background.result(timeout=5)
+    assert sessions.get("ours") is None
+    assert sessions._pending == {}
+    state.close()
+
+
+def test_take_token_waits_in_background(tmp_path):
+    state = SQLiteSharedState(tmp_path / "shared.db", workers=2)
+
+    async def main():
+        other = _hold_write_lock(state.path)
+        task = asyncio.create_task(state.take_token("user:a", 60, 1))
+        await asyncio.sleep(0.1)
+        # 事件循环没有被阻塞
+        assert not task.done()
+        other.execute("ROLLBACK")
+        other.close()
+        assert await task == 0.0
+        assert await state.take_token("user:a", 60, 1) > 0
+
+    asyncio.run(main())
+    state.close()
+
+
+def test_compaction_requests_are_handed_over(tmp_path):
+    state = SQLiteSharedState(tmp_path / "shared.db", workers=2)
+    state.request_compaction("s1")
+    state.request_compaction("s2")
+    state.request_compaction("s1")
+    assert sorted(state.take_compaction_requests()) == ["s1", "s2"]
+    assert state.take_compaction_requests() == []
+    state.close()
+
+
+def test_lane_retries_when_other_workers_hold_slots(tmp_path):
+    state = SQLiteSharedState(tmp_path / "shared.db", workers=2)
+    # 另一个（仍在运行的）worker占满了全局名额
+    state._db.execute("INSERT INTO slots (name, pid, count) VALUES ('chat', ?, 1)", (os.getppid(),))
+
+    async def main():
+        lane = AdmissionLane("chat", 1, 10, 5.0)
+        lane.shared = state.slots("chat")
+        waiter = asyncio.create_task(lane.admit())
+        await asyncio.sleep(0.2)
+        assert not waiter.done()
+        assert lane.active == 0
+        state._db.execute("DELETE FROM slots WHERE pid = ?", (os.getppid(),))
+        permit = await asyncio.wait_for(waiter, 2)
+        assert isinstance(permit, AdmissionPermit)
+        assert lane.shared.total() == 1
+        permit.release()
+        assert lane.shared.total() == 0
+
+    asyncio.run(main())
+    state.close()
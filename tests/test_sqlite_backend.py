@@ -0,0 +1,128 @@
+"""SQLite后端：读写往返、分页、整批事务、旧目录式会话导入、删除和多线程连接"""
+
+import threading
+
+import pytest
+
+from session_backends import FileSystemBackend, SessionLayout, SQLiteBackend
+
+
+@pytest.fixture
+def layout(tmp_path):
+    return SessionLayout(tmp_path / "sessions")
+
+
+@pytest.fixture
+def backend(tmp_path, layout):
+    backend = SQLiteBackend(tmp_path / "sessions.db", layout)
+    yield backend
+    backend.close()
+
+
+def _messages(*contents):
+    return [{"role": "user", "content": c} for c in contents]
+
+
+def test_write_load_round_trip(backend):
+    backend.write("s1", {"session_id": "s1", "username": "alice", "claude_session_id": "c1"}, _messages("a"))
+    backend.write("s1", None, _messages("b", "c"))
+
+    meta, messages = backend.load("s1")
+    assert meta["username"] == "alice"
+    assert meta["claude_session_id"] == "c1"
+    assert [m["content"] for m in messages] == ["a", "b", "c"]
+    assert backend.exists("s1")
+    assert not backend.exists("missing")
+    assert backend.load("missing") is None
+    assert backend.load_meta("missing") is None
+
+
+def test_meta_update_and_fingerprint(backend):
+    backend.write("s1", {"session_id": "s1", "username": "alice"}, [])
+    before = backend.fingerprint("s1")
+    backend.write("s1", {"session_id": "s1", "username": "bob", "claude_session_id": None}, _messages("a"))
+    assert backend.load_meta("s1")["username"] == "bob"
+    assert backend.fingerprint("s1") != before
+    assert backend.fingerprint("s1")[0] == 1
+
+
+def test_pagination_and_streaming(backend):
+    backend.write("s1", {"session_id": "s1"}, _messages(*map(str, range(7))))
+    assert [m["content"] for m in backend.load_messages("s1", 2, 3)] == ["2", "3", "4"]
+    assert [m["content"] for m in backend.load_messages("s1", 5)] == ["5", "6"]
+    assert [m["content"] for m in backend.iter_messages("s1", batch_size=3)] == list(map(str, range(7)))
+
+
+def test_write_batch_is_one_transaction(backend):
+    backend.write("s1", {"session_id": "s1"}, _messages("a"))
+    failed = backend.write_batch([
+        ("s1", None, _messages("b")),
+        ("s2", {"session_id": "s2", "bad": object()}, []),
+    ])
+    # 任一项失败时整批回滚，全部记为失败
+    assert set(failed) == {0, 1}
+    assert [m["content"] for m in backend.load_messages("s1")] == ["a"]
+    assert not backend.exists("s2")
+
+    assert backend.write_batch([("s1", None, _messages("b")), ("s2", {"session_id": "s2"}, _messages("x"))]) == {}
+    assert [m["content"] for m in backend.load_messages("s1")] == ["a", "b"]
+    assert [m["content"] for m in backend.load_messages("s2")] == ["x"]
+
+
+def test_list_sessions_by_user(backend):
+    backend.write("s1", {"session_id": "s1", "username": "alice"}, [])
+    backend.write("s2", {"session_id": "s2", "username": "bob"}, [])
+    backend.write("s3", {"session_id": "s3", "username": "alice"}, [])
+    backend.write("s1", None, _messages("newest"))
+
+    assert [m["session_id"] for m in backend.list_sessions("alice")] == ["s1", "s3"]
+    assert [m["session_id"] for m in backend.list_sessions(limit=2)] == ["s1", "s3"]
+    assert sorted(backend.iter_session_ids()) == ["s1", "s2", "s3"]
+
+
+def test_legacy_sessions_are_imported_on_first_access(tmp_path, layout):
+    legacy = FileSystemBackend(layout)
+    legacy.write("old", {"session_id": "old", "username": "carol"}, _messages("a", "b"))
+    backend = SQLiteBackend(tmp_path / "sessions.db", layout, legacy=legacy)
+    try:
+        assert backend.exists("old")
+        meta, messages = backend.load("old")
+        assert meta["username"] == "carol"
+        assert [m["content"] for m in messages] == ["a", "b"]
+        # 已导入数据库：之后的追加写在数据库里
+        backend.write("old", None, _messages("c"))
+        assert [m["content"] for m in backend.load_messages("old")] == ["a", "b", "c"]
+    finally:
+        backend.close()
+
+
+def test_delete_removes_rows_and_workspace(backend, layout):
+    backend.write("s1", {"session_id": "s1"}, _messages("abc"))
+    workspace = layout.path_for("s1")
+    workspace.mkdir(parents=True)
+    (workspace / "CLAUDE.md").write_text("{}")
+
+    assert backend.delete("s1") > 0
+    assert not backend.exists("s1")
+    assert backend.load_messages("s1") == []
+    assert not workspace.exists()
+
+
+def test_each_thread_uses_its_own_connection(backend):
+    errors = []
+
+    def writer(n):
+        try:
+            for i in range(20):
+                backend.write(f"t{n}", {"session_id": f"t{n}"} if i == 0 else None, _messages(str(i)))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    for n in range(4):
+        assert [m["content"] for m in backend.load_messages(f"t{n}")] == list(map(str, range(20)))
@@ -0,0 +1,167 @@
+"""流式中继：慢客户端下的 buffer/coalesce/drop 策略、高低水位回差，以及消费方退出时取消读取任务"""
+
+import asyncio
+import json
+from contextlib import aclosing
+
+import pytest
+
+import stream_relay
+from fast_json import SSEChunkBuilder
+from stream_relay import StreamBuffer, relay
+
+
+def _content(chunk):
+    return json.loads(chunk[len("data: "):])["choices"][0]["delta"]["content"]
+
+
+async def _source(items, delay=0.0, state=None):
+    state = state if state is not None else {}
+    try:
+        for item in items:
+            if delay:
+                await asyncio.sleep(delay)
+            yield item
+    except asyncio.CancelledError:
+        state["cancelled"] = True
+        raise
+    finally:
+        state["closed"] = True
+
+
+async def _slow_consume(stream, delay):
+    received = []
+    async with aclosing(stream) as items:
+        async for item in items:
+            received.append(item)
+            await asyncio.sleep(delay)
+    return received
+
+
+def test_buffer_policy_pauses_producer_without_losing_chunks():
+    async def main():
+        source = _source(list(range(20)))
+        received = await _slow_consume(relay(source, "test", high=4, low=1, policy="buffer"), 0.001)
+        return received
+
+    assert asyncio.run(main()) == list(range(20))
+    runs = stream_relay.stream_runs.stats()["test"]
+    assert runs["max_buffer_depth"] <= 4
+    assert runs["buffer_pauses"] >= 1
+
+
+def test_watermarks_resume_producer_only_below_low():
+    async def main():
+        buffer = StreamBuffer("test", high=4, low=1, policy="buffer")
+        for i in range(4):
+            assert await buffer.put(i)
+        blocked = asyncio.create_task(buffer.put(4))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+
+        # 回落到3、2：仍高于低水位，生产者保持暂停
+        assert await buffer.get() == 0
+        assert await buffer.get() == 1
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+
+        # 回落到低水位后恢复
+        assert await buffer.get() == 2
+        assert await asyncio.wait_for(blocked, 1)
+        assert buffer.depth == 2
+        assert buffer.pauses == 1
+        assert buffer.max_depth == 4
+
+    asyncio.run(main())
+
+
+def test_coalesce_merges_text_deltas_at_high_watermark():
+    builder = SSEChunkBuilder("chatcmpl-1", 1, "m", "s1")
+    texts = [f"第{i}段\"," for i in range(30)]
+
+    async def main():
+        buffer = StreamBuffer("test", high=2, low=0, policy="coalesce")
+        # 消费方不读：文本增量都并入缓冲末尾，生产者不暂停
+        for text in texts:
+            assert await asyncio.wait_for(buffer.put(builder.content(text)), 1)
+        assert buffer.depth == 2
+        assert buffer.pauses == 0
+        assert buffer.coalesced == len(texts) - 2
+
+        # 不能合并的chunk仍按 buffer 策略等待
+        done = asyncio.create_task(buffer.put("data: [DONE]\n\n"))
+        await asyncio.sleep(0.01)
+        assert not done.done()
+        received = [await buffer.get(), await buffer.get()]
+        await asyncio.wait_for(done, 1)
+        received.append(await buffer.get())
+        return received
+
+    received = asyncio.run(main())
+    assert "".join(_content(chunk) for chunk in received[:2]) == "".join(texts)
+    assert received[2] == "data: [DONE]\n\n"
+
+
+def test_drop_policy_ends_stream_for_stalled_consumer():
+    state = {}
+
+    async def main():
+        stream = relay(
+            _source(list(range(100)), state=state),
+            "test-drop",
+            high=3,
+            low=1,
+            policy="drop",
+            drop_after=0.05,
+        )
+        received = []
+        async with aclosing(stream) as items:
+            async for item in items:
+                received.append(item)
+                if len(received) == 1:
+                    # 客户端卡住，超过 drop_after 仍未回落到低水位
+                    await asyncio.sleep(0.2)
+        return received
+
+    received = asyncio.run(main())
+    assert received[0] == 0
+    assert received[-1] == "data: [DONE]\n\n"
+    assert json.loads(received[-2][len("data: "):])["type"] == "error"
+    assert len(received) < 10
+    assert state["closed"]
+    assert stream_relay.stream_runs.stats()["test-drop"]["dropped_slow_clients"] == 1
+
+
+def test_consumer_exit_cancels_producer():
+    state = {}
+
+    async def main():
+        stream = relay(_source(list(range(100)), delay=0.01, state=state), "test-cancel")
+        async with aclosing(stream) as items:
+            async for item in items:
+                assert item == 0
+                break
+        # 读取任务在自己的上下文中收尾
+        for _ in range(50):
+            if state.get("closed"):
+                break
+            await asyncio.sleep(0.01)
+
+    asyncio.run(main())
+    assert state == {"cancelled": True, "closed": True}
+    assert stream_relay.stream_runs.stats()["test-cancel"]["cancelled"] == 1
+
+
+def test_source_error_reaches_consumer():
+    async def failing():
+        yield 1
+        raise ValueError("上游出错")
+
+    async def main():
+        received = []
+        with pytest.raises(ValueError):
+            async for item in relay(failing(), "test-error"):
+                received.append(item)
+        return received
+
+    assert asyncio.run(main()) == [1]
@@ -20,7 +20,7 @@ venv_path = os.path.join(
 if os.path.exists(venv_path):
     sys.path.insert(0, venv_path)
 
-from fastapi import FastAPI, HTTPException, Header, Request
+from fastapi import FastAPI, HTTPException, Header, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any, Union, AsyncGenerator
@@ -30,20 +30,73 @@ from datetime import datetime
 from pathlib import Path
 import subprocess
 import asyncio
+import math
+import time
 from fastapi.responses import JSONResponse, StreamingResponse
+import fast_json
+import stream_relay
+from adaptive_limit import streaming_limiter
+from admission import (
+    ADMISSION_CHAT_QUEUE,
+    ADMISSION_CHAT_WAIT,
+    ADMISSION_CONTROL_QUEUE,
+    ADMISSION_CONTROL_WAIT,
+    ADMISSION_PODCAST_QUEUE,
+    ADMISSION_PODCAST_WAIT,
+    AdmissionController,
+    AdmissionLane,
+    AdmissionRejection,
+    FairAdmissionLane,
+    session_users,
+)
+from agent_pool import agent_pool
 from podcast_sdk import claude_agent_sdk_instance
+from request_tracking import finalize_on_loop, request_tracker, track_body
+from response_cache import greeting_cache
+from session_compactor import session_compactor
+from session_locks import session_locks
+from session_reaper import session_reaper
+from session_turns import request_fingerprint, session_turns
+from session_transfer import (
+    IMPORT_MAX_LINE_BYTES,
+    SessionImporter,
+    export_session,
+    iter_export,
+    select_sessions,
+)
+from shared_state import (
+    RATE_LIMIT_BURST,
+    RATE_LIMIT_PER_MINUTE,
+    SERVER_WORKERS,
+    shared_state,
+)
 from ultra_simple_server_paths import (
+    build_session_index,
+    close_session_store,
+    compaction_listeners,
     create_session_context,
-    get_session_path,
-    load_chat_history,
+    get_confirm_generate_count,
+    get_session_username,
+    list_sessions,
     load_claude_session_id,
+    load_messages,
+    load_messages_page,
+    load_session,
     save_message,
+    session_exists,
+    session_index,
+    session_store,
     update_claude_session_in_context,
 )
 
 # 配置日志系统
 def setup_logging():
     """配置日志系统，输出到文件和控制台"""
+    root_logger = logging.getLogger()
+    # 多worker时worker进程会把启动脚本再导入一次（__mp_main__），不重复添加处理器
+    if any(isinstance(handler, RotatingFileHandler) for handler in root_logger.handlers):
+        return root_logger
+
     # 创建logs目录
     log_dir = Path("logs")
     log_dir.mkdir(exist_ok=True)
@@ -80,7 +133,6 @@ def setup_logging():
     console_handler.setLevel(logging.INFO)
 
     # 配置根日志器
-    root_logger = logging.getLogger()
     root_logger.setLevel(logging.INFO)
     root_logger.addHandler(file_handler)
     root_logger.addHandler(error_handler)
@@ -92,24 +144,84 @@ def setup_logging():
 logger = setup_logging()
 
 # 并发控制配置
-MAX_CONCURRENT_REQUESTS = 50  # 最大并发请求数
-MAX_CONCURRENT_STREAMING = 20  # 最大并发流式请求数
+MAX_CONCURRENT_REQUESTS = int(os.getenv("PODCAST_MAX_CONCURRENT_REQUESTS", "50"))  # 最大并发请求数
+# 最大并发聊天请求数（含流式）；启用自适应上限时是初始值，之后在 [AIMD_MIN_LIMIT, AIMD_MAX_LIMIT] 内调整
+MAX_CONCURRENT_STREAMING = int(os.getenv("PODCAST_MAX_CONCURRENT_STREAMING", "20"))
+MAX_CONCURRENT_PODCAST = int(os.getenv("PODCAST_MAX_CONCURRENT_PODCAST", "5"))  # 最大并发播客生成数
 REQUEST_TIMEOUT = 300  # 请求超时时间（秒）
+CONFIRM_NUDGE_AFTER = 10  # 助手提议生成达到该次数后引导用户结束对话
+
+# 创建线程池用于CPU密集型任务和会话存储读写
+THREAD_POOL_WORKERS = int(os.getenv("PODCAST_THREAD_POOL_WORKERS", "10"))
+thread_pool = ThreadPoolExecutor(max_workers=THREAD_POOL_WORKERS)
+
+# 会话写操作统一走会话锁，在同一线程池中执行
+session_locks.executor = thread_pool
+
+# 准入控制：控制面、聊天、播客生成分道限流，排队有上限和时限；聊天名额按用户公平分配
+admission = AdmissionController([
+    AdmissionLane("control", MAX_CONCURRENT_REQUESTS, ADMISSION_CONTROL_QUEUE, ADMISSION_CONTROL_WAIT),
+    FairAdmissionLane("chat", MAX_CONCURRENT_STREAMING, ADMISSION_CHAT_QUEUE, ADMISSION_CHAT_WAIT),
+    AdmissionLane("podcast", MAX_CONCURRENT_PODCAST, ADMISSION_PODCAST_QUEUE, ADMISSION_PODCAST_WAIT),
+])
+# 聊天道的并发上限按首token延迟和错误率自适应调整
+streaming_limiter.attach(admission.lanes["chat"])
+# 多worker时聊天和播客生成的并发上限是所有worker合计的上限（控制面仍按进程计）
+if shared_state.shared:
+    for _lane in ("chat", "podcast"):
+        admission.lanes[_lane].shared = shared_state.slots(_lane)
+
+
+async def request_username(session_id: str) -> Optional[str]:
+    """聊天请求所属的用户名（公平调度的分组），优先从缓存取
+
+    请求头中的会话ID未经校验：格式不合法或会话不存在时返回None，不读取会话存储。
+    """
+    if not session_index.is_well_formed(session_id):
+        return None
+    username = session_users.get(session_id)
+    if username is None:
+        if not session_exists(session_id):
+            return None
+        username = await asyncio.get_running_loop().run_in_executor(
+            thread_pool, get_session_username, session_id
+        )
+        session_users.remember(session_id, username)
+    return username
 
-# 创建线程池用于CPU密集型任务
-thread_pool = ThreadPoolExecutor(max_workers=10)
-
-# 信号量控制并发
-request_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
-streaming_semaphore = asyncio.Semaphore(MAX_CONCURRENT_STREAMING)
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """应用生命周期管理"""
     logger.info("🚀 Podcast Server starting up...")
+    # 构建会话存在性索引，之后的会话校验不再访问文件系统
+    loop = asyncio.get_running_loop()
+    known_sessions = await loop.run_in_executor(thread_pool, build_session_index)
+    logger.info(f"📇 会话索引构建完成 | Sessions: {known_sessions}")
+    # 后台回收空闲会话、压缩长会话的聊天历史：多worker时只在一个worker中运行
+    if await loop.run_in_executor(thread_pool, shared_state.try_lead, "session_reaper"):
+        session_reaper.start()
+    if await loop.run_in_executor(thread_pool, shared_state.try_lead, "session_compactor"):
+        session_compactor.start(
+            poll=shared_state.take_compaction_requests if shared_state.shared else None
+        )
+    else:
+        # 压缩请求登记到共享状态，由运行压缩任务的worker领取
+        compaction_listeners.append(shared_state.request_compaction)
+    # 回收预热池中的空闲Agent进程
+    agent_pool.start()
     yield
     logger.info("🛑 Podcast Server shutting down...")
+    await agent_pool.close()
+    session_compactor.stop()
+    if shared_state.request_compaction in compaction_listeners:
+        compaction_listeners.remove(shared_state.request_compaction)
+    session_reaper.stop()
     thread_pool.shutdown(wait=True)
+    # 写回会话缓存中尚未落盘的数据
+    close_session_store()
+    # 释放本worker登记的全局名额、会话租约和后台任务
+    shared_state.close()
 
 app = FastAPI(
     title="Podcast Server",
@@ -121,13 +233,8 @@ app = FastAPI(
 # 自定义JSON响应，强制UTF-8编码
 class UTF8JSONResponse(JSONResponse):
     def render(self, content: Any) -> bytes:
-        return json.dumps(
-            content,
-            ensure_ascii=False,  # 禁用ASCII编码，允许中文
-            allow_nan=False,
-            indent=None,
-            separators=(",", ":"),
-        ).encode("utf-8")
+        # 不转义中文、紧凑输出；安装了orjson时由orjson编码
+        return fast_json.dumps_bytes(content)
 
 
 # 覆盖默认的JSON响应
@@ -148,41 +255,82 @@ async def log_requests(request: Request, call_next):
 
     logger.info(f"📥 请求开始: {method} {url} | IP: {client_ip} | Session: {session_id} | UA: {user_agent}")
 
-    try:
-        # 使用信号量控制并发
-        async with request_semaphore:
-            # 设置请求超时
-            response = await asyncio.wait_for(
-                call_next(request),
-                timeout=REQUEST_TIMEOUT
+    # 在响应开始前决定是否准入：排队已满返回429，排队超时返回503
+    lane = admission.lane_for(method, request.url.path)
+    username = await request_username(session_id) if lane == "chat" else None
+    # 按用户限流（多worker时令牌桶在共享存储中），超出时返回429
+    if lane == "chat" and RATE_LIMIT_PER_MINUTE > 0:
+        retry_after = await shared_state.take_token(
+            f"user:{username or client_ip}", RATE_LIMIT_PER_MINUTE, RATE_LIMIT_BURST
+        )
+        if retry_after:
+            logger.warning(f"🚦 请求频率超限: {method} {url} | 用户: {username or client_ip} | Retry-After: {retry_after:.1f}s | Session: {session_id}")
+            return JSONResponse(
+                status_code=429,
+                content={"detail": f"请求过于频繁（每分钟最多{RATE_LIMIT_PER_MINUTE:g}次），请稍后重试", "lane": lane},
+                headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
             )
+    permit = await admission.lanes[lane].admit(username)
+    if isinstance(permit, AdmissionRejection):
+        logger.warning(f"🚦 拒绝请求: {method} {url} | Lane: {permit.lane} | 状态: {permit.status_code} | Retry-After: {permit.retry_after}s | Session: {session_id}")
+        return JSONResponse(
+            status_code=permit.status_code,
+            content={"detail": permit.detail, "lane": permit.lane},
+            headers={"Retry-After": str(permit.retry_after)},
+        )
+    # 登记请求：准入名额、耗时和发送量统计到响应体发送完为止
+    request_id = str(uuid.uuid4())
+    record = request_tracker.begin(
+        request_id, method, request.url.path, lane, permit, session_id,
+    )
 
-        # 计算处理时间
-        process_time = (datetime.now() - start_time).total_seconds()
-        status_code = response.status_code
-
-        # 记录响应信息
-        logger.info(f"📤 请求完成: {method} {url} | 状态: {status_code} | 耗时: {process_time:.2f}s | Session: {session_id}")
-
-        # 添加响应头
-        response.headers["X-Process-Time"] = str(process_time)
-        response.headers["X-Request-ID"] = str(uuid.uuid4())
-
-        return response
+    def log_finished(record):
+        status_code = record.status_code
+        if record.outcome == "completed":
+            logger.info(f"📤 请求完成: {method} {url} | 状态: {status_code} | 耗时: {record.duration:.2f}s | 发送: {record.bytes_sent}B/{record.chunks}块 | Session: {session_id}")
+        elif record.outcome == "disconnected":
+            logger.info(f"🔌 客户端断开: {method} {url} | 状态: {status_code} | 耗时: {record.duration:.2f}s | 发送: {record.bytes_sent}B/{record.chunks}块 | Session: {session_id}")
+        else:
+            logger.error(f"❌ 响应发送出错: {method} {url} | 状态: {status_code} | 耗时: {record.duration:.2f}s | 发送: {record.bytes_sent}B/{record.chunks}块 | Session: {session_id}")
 
+    try:
+        # 设置请求超时（到响应开始为止）
+        response = await asyncio.wait_for(
+            call_next(request),
+            timeout=REQUEST_TIMEOUT
+        )
     except asyncio.TimeoutError:
+        record.finish("error")
         logger.error(f"⏰ 请求超时: {method} {url} | Session: {session_id} | 超时时间: {REQUEST_TIMEOUT}s")
         return JSONResponse(
             status_code=408,
             content={"detail": "Request timeout"}
         )
     except Exception as e:
+        record.finish("error")
         process_time = (datetime.now() - start_time).total_seconds()
         logger.error(f"❌ 请求错误: {method} {url} | Session: {session_id} | 耗时: {process_time:.2f}s | 错误: {str(e)}")
         return JSONResponse(
             status_code=500,
             content={"detail": "Internal server error"}
         )
+    except BaseException:
+        # 客户端断开等导致的取消：同样释放准入名额
+        record.finish("error")
+        raise
+
+    # 响应头发出前的耗时；流的完整耗时在结束时记录到日志和 /metrics
+    process_time = record.response_started(
+        response.status_code, "content-length" not in response.headers
+    )
+    response.headers["X-Process-Time"] = str(process_time)
+    response.headers["X-Request-ID"] = request_id
+
+    body = track_body(record, response.body_iterator, log_finished)
+    # 客户端在响应体开始前断开时包装的迭代器不会运行，回收时结束请求
+    finalize_on_loop(body, record.finish, "disconnected")
+    response.body_iterator = body
+    return response
 
 # CORS - 修复middleware配置
 app.add_middleware(
@@ -191,7 +339,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
-    expose_headers=[],
+    expose_headers=["X-Session-Turn", "X-Session-Queue-Position", "Retry-After"],
     max_age=3600,
 )
 
@@ -295,6 +443,10 @@ async def create_session(request: CreateSessionRequest):
         )
 
         logger.info(f"📁 创建会话目录: {session_path}")
+        session_users.remember(session_id, username)
+
+        # 在后台预先启动本会话的Agent进程，首轮对话不再等待冷启动
+        claude_agent_sdk_instance.prewarm(session_id)
 
         response = {
             "session_id": session_id,
@@ -310,15 +462,20 @@ async def create_session(request: CreateSessionRequest):
 @app.post("/v1/chat/completions")
 async def chat_completions(
     request: ChatRequest,
+    response: Response,
     session_id: str = Header(..., description="会话ID", alias="session-id"),
+    idempotency_key: Optional[str] = Header(
+        None, description="重试时带上与原请求相同的值，合并到原请求的执行", alias="Idempotency-Key"
+    ),
 ):
     """聊天完成 - 前端通过header传递session_id，支持流式响应"""
+    # 请求到达时刻，用于统计首token延迟
+    started_at = time.perf_counter()
 
     logger.info(f"💬 聊天请求 | Session: {session_id} | Stream: {request.stream} | Messages: {len(request.messages)}")
 
     # 1. 验证session_id存在性
-    session_path = get_session_path(session_id)
-    if not session_path.exists():
+    if not session_exists(session_id):
         logger.warning(f"❌ Session不存在: {session_id}")
         raise HTTPException(status_code=404, detail="Session not found")
 
@@ -337,88 +494,144 @@ async def chat_completions(
 
     logger.debug(f"📝 用户消息内容长度: {len(user_content)} | Session: {session_id}")
 
-    # 3. 在线程池中检查对话历史（避免阻塞事件循环）
+    # 同一会话的请求串行执行：重试和重复提交合并到已有执行，其余排队，队列满时拒绝
+    ticket = session_turns.enter(
+        session_id, request_fingerprint(user_content, bool(request.stream)), idempotency_key
+    )
+    if ticket is None:
+        logger.warning(f"🚫 会话请求排队已满 | Session: {session_id}")
+        raise HTTPException(
+            status_code=429,
+            detail=f"该会话已有请求在处理，排队已满（最多{session_turns.max_queue}个），请稍后重试",
+            headers={"X-Session-Turn": "rejected"},
+        )
+    turn_headers = {
+        "X-Session-Turn": ticket.status,
+        "X-Session-Queue-Position": str(ticket.position),
+    }
+    if ticket.status != "running":
+        logger.info(f"⏳ 会话请求{'合并' if ticket.status == 'coalesced' else '排队'} | Session: {session_id} | 前面还有: {ticket.position}")
+    if ticket.status != "coalesced":
+        # 在响应开始前等到本请求的轮次：排队期间不发出200响应头，排不上时还能返回错误状态码
+        try:
+            await ticket.wait_turn()
+        except RuntimeError as e:
+            ticket.release()
+            logger.warning(f"🔒 会话租约等待超时 | Session: {session_id}")
+            raise HTTPException(
+                status_code=503,
+                detail=str(e),
+                headers={**turn_headers, "Retry-After": "5"},
+            )
+        except BaseException:
+            # 请求超时或客户端断开时让出会话
+            ticket.release()
+            raise
+
+    # 3. 读取会话元数据中维护的确认次数（在线程池中执行，未缓存时需要读存储）
     try:
         loop = asyncio.get_event_loop()
-        context = await loop.run_in_executor(
+        confirm_count = await loop.run_in_executor(
             thread_pool,
-            load_chat_history,
+            get_confirm_generate_count,
             session_id
         )
 
         # 判断是不是要引导用户结束对话
-        confirm_parts = context.split("<confirm_generate>")
-        if confirm_parts and len(confirm_parts) > 10:
-            user_content += f"<notice>用户已经被AI认为{len(confirm_parts)}次可以结束对话，请用<confirm_generate>是否现在生成故事？</confirm_generate>请编导引导用户结束对话开始生成播客</notice>\n"
-            logger.info(f"🎯 引导结束对话 | Session: {session_id} | 确认次数: {len(confirm_parts)}")
+        if confirm_count >= CONFIRM_NUDGE_AFTER:
+            user_content += f"<notice>用户已经被AI认为{confirm_count}次可以结束对话，请用<confirm_generate>是否现在生成故事？</confirm_generate>请编导引导用户结束对话开始生成播客</notice>\n"
+            logger.info(f"🎯 引导结束对话 | Session: {session_id} | 确认次数: {confirm_count}")
     except Exception as e:
-        logger.warning(f"⚠️ 加载对话历史失败 | Session: {session_id} | 错误: {str(e)}")
+        logger.warning(f"⚠️ 读取确认次数失败 | Session: {session_id} | 错误: {str(e)}")
 
     # 4. 根据是否流式处理选择不同的响应方式
     if request.stream:
-        # 流式响应 - 使用额外的信号量控制
-        async def generate_stream():
-            async with streaming_semaphore:
-                try:
-                    logger.info(f"🌊 开始流式响应 | Session: {session_id}")
-
-                    # 在线程池中保存消息
-                    await loop.run_in_executor(
-                        thread_pool,
-                        save_message,
-                        session_id, "user", user_content, sequence_id
-                    )
+        # 流式响应
+        async def run_stream():
+            try:
+                logger.info(f"🌊 开始流式响应 | Session: {session_id}")
 
-                    # 获取流式生成器
-                    stream_generator = await claude_agent_sdk_instance.process_message(
-                        user_content, session_id, stream=True
-                    )
+                # 持会话锁在线程池中保存消息
+                await session_locks.run(
+                    session_id,
+                    save_message,
+                    session_id, "user", user_content, sequence_id
+                )
 
-                    # 流式输出响应
-                    chunk_count = 0
-                    async for chunk in stream_generator:
-                        yield chunk
-                        chunk_count += 1
-
-                    logger.info(f"✅ 流式响应完成 | Session: {session_id} | Chunks: {chunk_count}")
-
-                except Exception as e:
-                    logger.error(f"❌ 流式处理错误 | Session: {session_id} | 错误: {str(e)}", exc_info=True)
-                    # 流式错误处理
-                    error_chunk = {
-                        "id": f"chatcmpl-{int(datetime.now().timestamp())}",
-                        "object": "chat.completion.chunk",
-                        "created": int(datetime.now().timestamp()),
-                        "model": request.model,
-                        "choices": [
-                            {
-                                "index": 0,
-                                "delta": {"content": f"流式处理出错: {str(e)}"},
-                                "finish_reason": None,
-                            }
-                        ],
-                        "session_id": session_id,
-                    }
-                    yield f"data: {json.dumps(error_chunk, ensure_ascii=False)}\n\n"
+                # 获取流式生成器
+                stream_generator = await claude_agent_sdk_instance.process_message(
+                    user_content, session_id, stream=True, started_at=started_at
+                )
+
+                # 流式输出响应：生成器在独立任务中运行，客户端断开时取消Agent执行
+                chunk_count = 0
+                async for chunk in stream_relay.relay(stream_generator, "chat"):
+                    yield chunk
+                    chunk_count += 1
+
+                logger.info(f"✅ 流式响应完成 | Session: {session_id} | Chunks: {chunk_count}")
+
+            except Exception as e:
+                logger.error(f"❌ 流式处理错误 | Session: {session_id} | 错误: {str(e)}", exc_info=True)
+                # 流式错误处理
+                error_chunk = {
+                    "id": f"chatcmpl-{int(datetime.now().timestamp())}",
+                    "object": "chat.completion.chunk",
+                    "created": int(datetime.now().timestamp()),
+                    "model": request.model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "delta": {"content": f"流式处理出错: {str(e)}"},
+                            "finish_reason": None,
+                        }
+                    ],
+                    "session_id": session_id,
+                }
+                yield fast_json.sse_event(error_chunk)
+                yield "data: [DONE]\n\n"
+
+        async def generate_stream():
+            if ticket.status == "coalesced":
+                # 回放同一请求的输出，不再执行
+                async for chunk in ticket.flight.replay():
+                    yield chunk
+                if ticket.flight.error is not None:
+                    yield fast_json.sse_event({"type": "error", "text": ticket.flight.error})
                     yield "data: [DONE]\n\n"
+                return
+            try:
+                async for chunk in run_stream():
+                    ticket.flight.publish(chunk)
+                    yield chunk
+                ticket.flight.finish()
+            finally:
+                ticket.release()
 
+        stream = generate_stream()
+        # 客户端在响应开始前断开时生成器不会运行，回收时也要让出会话
+        finalize_on_loop(stream, ticket.release)
         return StreamingResponse(
-            generate_stream(),
+            stream,
             media_type="text/plain",
             headers={
                 "Cache-Control": "no-cache",
                 "Connection": "keep-alive",
                 "Content-Type": "text/plain; charset=utf-8",
+                **turn_headers,
             },
         )
     else:
         # 非流式响应
+        response.headers.update(turn_headers)
         try:
+            if ticket.status == "coalesced":
+                return await ticket.flight.wait_result()
             logger.info(f"📤 开始非流式响应 | Session: {session_id}")
 
-            # 在线程池中保存消息
-            await loop.run_in_executor(
-                thread_pool,
+            # 持会话锁在线程池中保存消息
+            await session_locks.run(
+                session_id,
                 save_message,
                 session_id, "user", user_content, sequence_id
             )
@@ -428,15 +641,15 @@ async def chat_completions(
                 user_content, session_id, stream=False
             )
 
-            # 在线程池中保存助手回复
-            await loop.run_in_executor(
-                thread_pool,
+            # 持会话锁在线程池中保存助手回复
+            await session_locks.run(
+                session_id,
                 save_message,
                 session_id, "assistant", result["content"], result.get("tool_calls", [])
             )
 
             # 构建响应
-            response = ChatResponse(
+            result_response = ChatResponse(
                 id=f"chatcmpl-{int(datetime.now().timestamp())}",
                 created=int(datetime.now().timestamp()),
                 model=request.model,
@@ -459,37 +672,155 @@ async def chat_completions(
                 session_id=session_id,
             )
 
-            logger.info(f"✅ 非流式响应完成 | Session: {session_id} | Tokens: {response.usage['total_tokens']}")
-            return response
+            logger.info(f"✅ 非流式响应完成 | Session: {session_id} | Tokens: {result_response.usage['total_tokens']}")
+            ticket.flight.finish(result=result_response)
+            return result_response
 
         except Exception as e:
             logger.error(f"❌ 非流式处理错误 | Session: {session_id} | 错误: {str(e)}", exc_info=True)
             raise HTTPException(status_code=500, detail=f"处理消息失败: {str(e)}")
+        finally:
+            ticket.release()
 
 
 @app.get("/v1/sessions/{session_id}")
 async def get_session(session_id: str):
     """获取会话信息"""
-    session_path = get_session_path(session_id)
-    if not session_path.exists():
+    if not session_exists(session_id):
         raise HTTPException(status_code=404, detail="Session not found")
 
-    context_file = session_path / "context.json"
-    if context_file.exists():
-        with open(context_file, "r", encoding="utf-8") as f:
-            context = json.load(f)
+    loop = asyncio.get_event_loop()
+    context = await loop.run_in_executor(thread_pool, load_session, session_id)
+    if context is not None:
         return context
 
     return {"session_id": session_id, "messages": []}
 
 
+@app.get("/v1/sessions")
+async def get_sessions(username: Optional[str] = None, offset: int = 0, limit: int = 50):
+    """列出会话（按最近更新倒序），可按用户名过滤"""
+    limit = max(1, min(limit, 200))
+    loop = asyncio.get_event_loop()
+    sessions = await loop.run_in_executor(
+        thread_pool, list_sessions, username, max(offset, 0), limit
+    )
+    return {"sessions": sessions, "offset": offset, "limit": limit}
+
+
+@app.get("/v1/sessions/{session_id}/messages")
+async def get_session_messages(session_id: str, offset: int = 0, limit: int = 50):
+    """分页读取会话消息"""
+    if not session_exists(session_id):
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    limit = max(1, min(limit, 500))
+    loop = asyncio.get_event_loop()
+    messages = await loop.run_in_executor(
+        thread_pool, load_messages_page, session_id, max(offset, 0), limit
+    )
+    return {
+        "session_id": session_id,
+        "offset": offset,
+        "limit": limit,
+        "messages": messages,
+    }
+
+
+async def iterate_in_thread_pool(iterator):
+    """在线程池中逐块推进同步迭代器，文件IO不阻塞事件循环"""
+    loop = asyncio.get_event_loop()
+    done = object()
+    while True:
+        chunk = await loop.run_in_executor(thread_pool, next, iterator, done)
+        if chunk is done:
+            break
+        yield chunk
+
+
+@app.get("/v1/sessions/{session_id}/export")
+async def export_one_session(session_id: str):
+    """以NDJSON流导出单个会话"""
+    if not session_exists(session_id):
+        raise HTTPException(status_code=404, detail="Session not found")
+
+    logger.info(f"📤 导出会话 | Session: {session_id}")
+    return StreamingResponse(
+        iterate_in_thread_pool(export_session(session_id)),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{session_id}.ndjson"'},
+    )
+
+
+@app.get("/v1/export/sessions")
+async def export_sessions(
+    username: Optional[str] = None,
+    created_after: Optional[str] = None,
+    created_before: Optional[str] = None,
+):
+    """以NDJSON流批量导出会话，可按用户名和创建时间（ISO格式）过滤"""
+    logger.info(
+        f"📤 批量导出会话 | 用户名: {username} | 创建时间: {created_after} ~ {created_before}"
+    )
+    sessions = select_sessions(username, created_after, created_before)
+    return StreamingResponse(
+        iterate_in_thread_pool(iter_export(sessions)),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="sessions.ndjson"'},
+    )
+
+
+@app.post("/v1/import/sessions")
+async def import_sessions(request: Request, on_conflict: str = "skip"):
+    """流式导入NDJSON导出文件：边读请求体边分批写入，on_conflict 为 skip 或 replace"""
+    try:
+        importer = SessionImporter(on_conflict=on_conflict)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    logger.info(f"📥 导入会话开始 | 冲突策略: {on_conflict}")
+    loop = asyncio.get_event_loop()
+    remainder = b""
+    try:
+        async for chunk in request.stream():
+            lines = (remainder + chunk).split(b"\n")
+            remainder = lines.pop()
+            if len(remainder) > IMPORT_MAX_LINE_BYTES:
+                raise HTTPException(status_code=413, detail="导入数据单行过长")
+            if lines:
+                await loop.run_in_executor(thread_pool, importer.feed, lines)
+        if remainder:
+            await loop.run_in_executor(thread_pool, importer.feed, [remainder])
+        result = await loop.run_in_executor(thread_pool, importer.finish)
+    except Exception as e:
+        # 未提交的数据丢弃（待替换的会话保持原样），错误中带上已提交部分的计数
+        if isinstance(e, HTTPException):
+            status_code, message = e.status_code, e.detail
+        elif isinstance(e, ValueError):
+            status_code, message = 400, f"导入失败: {str(e)}"
+        else:
+            logger.error(f"❌ 导入会话错误: {str(e)}", exc_info=True)
+            status_code, message = 500, f"导入失败: {str(e)}"
+        partial = importer.abort()
+        logger.warning(
+            f"⚠️ 导入会话中止 | 已提交会话: {partial['sessions_imported']} | "
+            f"消息: {partial['messages_imported']}"
+        )
+        raise HTTPException(status_code=status_code, detail={"error": message, **partial})
+
+    logger.info(
+        f"✅ 导入会话完成 | 会话: {result['sessions_imported']} | "
+        f"跳过: {result['sessions_skipped']} | 消息: {result['messages_imported']}"
+    )
+    return result
+
+
 @app.post("/v1/sessions/{session_id}/resume")
 async def resume_session(session_id: str, request: Dict[str, Any]):
     """恢复会话 - 支持使用Claude会话ID恢复"""
     try:
         # 验证会话存在
-        session_path = get_session_path(session_id)
-        if not session_path.exists():
+        if not session_exists(session_id):
             raise HTTPException(status_code=404, detail="Session not found")
 
         # 获取Claude会话ID（如果提供）
@@ -497,7 +828,11 @@ async def resume_session(session_id: str, request: Dict[str, Any]):
         if claude_session_id:
             # 保存Claude会话ID
             claude_agent_sdk_instance.claude_session_ids[session_id] = claude_session_id
-            update_claude_session_in_context(session_id, claude_session_id)
+            await session_locks.run(
+                session_id,
+                update_claude_session_in_context,
+                session_id, claude_session_id
+            )
             print(f"🔄 恢复会话: {session_id} 使用Claude会话ID: {claude_session_id}")
 
         return {
@@ -517,8 +852,7 @@ async def get_claude_session_id(session_id: str):
     """获取会话对应的Claude会话ID"""
     try:
         # 验证会话存在
-        session_path = get_session_path(session_id)
-        if not session_path.exists():
+        if not session_exists(session_id):
             raise HTTPException(status_code=404, detail="Session not found")
 
         claude_session_id = load_claude_session_id(session_id)
@@ -549,8 +883,13 @@ async def health():
         "status": "healthy",
         "port": 3001,
         "timestamp": int(datetime.now().timestamp()),
-        "concurrent_requests": MAX_CONCURRENT_REQUESTS - request_semaphore._value,
-        "concurrent_streaming": MAX_CONCURRENT_STREAMING - streaming_semaphore._value,
+        "concurrent_requests": admission.active("control"),
+        "concurrent_streaming": admission.active("chat"),
+        "streaming_limit": admission.lanes["chat"].limit,
+        "concurrent_podcast": admission.active("podcast"),
+        # 正在发送响应体的请求（含未结束的流）
+        "in_flight_requests": request_tracker.in_flight(),
+        "in_flight_streams": request_tracker.in_flight_streams(),
         "thread_pool_active": thread_pool._threads.__len__() if hasattr(thread_pool, '_threads') else 0
     }
 
@@ -563,20 +902,41 @@ async def metrics():
             "version": "1.0.0",
             "port": 3001,
             "uptime": "running",  # 可以添加实际运行时间统计
+            "workers": SERVER_WORKERS,
+            "pid": os.getpid(),
         },
         "concurrency": {
             "max_concurrent_requests": MAX_CONCURRENT_REQUESTS,
-            "current_concurrent_requests": MAX_CONCURRENT_REQUESTS - request_semaphore._value,
-            "max_concurrent_streaming": MAX_CONCURRENT_STREAMING,
-            "current_concurrent_streaming": MAX_CONCURRENT_STREAMING - streaming_semaphore._value,
+            "current_concurrent_requests": admission.active("control"),
+            "max_concurrent_streaming": admission.lanes["chat"].limit,
+            "current_concurrent_streaming": admission.active("chat"),
+            "max_concurrent_podcast": MAX_CONCURRENT_PODCAST,
+            "current_concurrent_podcast": admission.active("podcast"),
+            "in_flight_requests": request_tracker.in_flight(),
+            "in_flight_streams": request_tracker.in_flight_streams(),
         },
+        "admission": {**admission.stats(), "session_users": session_users.stats()},
+        "adaptive_limit": streaming_limiter.stats(),
         "thread_pool": {
             "max_workers": thread_pool._max_workers,
             "active_threads": thread_pool._threads.__len__() if hasattr(thread_pool, '_threads') else 0,
         },
         "requests": {
             "timeout_seconds": REQUEST_TIMEOUT,
-        }
+            **request_tracker.stats(),
+        },
+        "json_backend": fast_json.backend_name(),
+        "streaming": claude_agent_sdk_instance.stream_stats(),
+        "stream_relay": stream_relay.stats(),
+        "greeting_cache": greeting_cache.stats(),
+        "agent_pool": agent_pool.stats(),
+        "session_store": session_store.stats(),
+        "session_index": session_index.stats(),
+        "session_locks": session_locks.stats(),
+        "session_turns": session_turns.stats(),
+        "session_reaper": session_reaper.stats(),
+        "session_compactor": session_compactor.stats(),
+        "shared_state": shared_state.stats(),
     }
 
 
@@ -590,30 +950,29 @@ async def generate_podcast(request: PodcastGenerateRequest):
     async def load_contexts():
         contexts = []
         try:
-            session_path = get_session_path(session_id)
-            if not session_path.exists():
+            if not session_exists(session_id):
                 raise HTTPException(status_code=404, detail="Session not found")
 
-            context_file = session_path / "context.json"
-            if context_file.exists():
-                with open(context_file, "r", encoding="utf-8") as f:
-                    context = json.load(f)
-                    for msg in context.get("messages", []):
-                        if msg["role"] == "user":
-                            contexts.append(
-                                {
-                                    "role": "user",
-                                    "content": msg.get("content", ""),
-                                    "sequence_id": msg.get("sequence_id", ""),
-                                }
-                            )
-                        else:
-                            contexts.append(
-                                {
-                                    "role": "assistant",
-                                    "content": msg.get("content", ""),
-                                }
-                            )
+            loop = asyncio.get_event_loop()
+            messages = await loop.run_in_executor(
+                thread_pool, load_messages, session_id
+            )
+            for msg in messages:
+                if msg["role"] == "user":
+                    contexts.append(
+                        {
+                            "role": "user",
+                            "content": msg.get("content", ""),
+                            "sequence_id": msg.get("sequence_id", ""),
+                        }
+                    )
+                else:
+                    contexts.append(
+                        {
+                            "role": "assistant",
+                            "content": msg.get("content", ""),
+                        }
+                    )
             logger.info(f"📚 加载上下文完成 | Session: {session_id} | Messages: {len(contexts)}")
             return contexts
         except Exception as e:
@@ -622,46 +981,45 @@ async def generate_podcast(request: PodcastGenerateRequest):
 
     # 流式响应
     async def generate_stream():
-        async with streaming_semaphore:
-            try:
-                logger.info(f"🎙️ 开始播客生成 | Session: {session_id}")
+        try:
+            logger.info(f"🎙️ 开始播客生成 | Session: {session_id}")
 
-                # 加载上下文
-                contexts = await load_contexts()
+            # 加载上下文
+            contexts = await load_contexts()
 
-                # 获取流式生成器
-                stream_generator = claude_agent_sdk_instance.process_formated_mp3_data(
-                    session_id,
-                    contexts,
-                )
+            # 获取流式生成器
+            stream_generator = claude_agent_sdk_instance.process_formated_mp3_data(
+                session_id,
+                contexts,
+            )
 
-                # 流式输出响应
-                chunk_count = 0
-                async for chunk in stream_generator:
-                    yield chunk
-                    chunk_count += 1
+            # 流式输出响应：生成器在独立任务中运行，客户端断开时取消Agent执行
+            chunk_count = 0
+            async for chunk in stream_relay.relay(stream_generator, "podcast"):
+                yield chunk
+                chunk_count += 1
 
-                logger.info(f"✅ 播客生成完成 | Session: {session_id} | Chunks: {chunk_count}")
+            logger.info(f"✅ 播客生成完成 | Session: {session_id} | Chunks: {chunk_count}")
 
-            except Exception as e:
-                logger.error(f"❌ 播客生成错误 | Session: {session_id} | 错误: {str(e)}", exc_info=True)
-                # 流式错误处理
-                error_chunk = {
-                    "id": f"chatcmpl-{int(datetime.now().timestamp())}",
-                    "object": "chat.completion.chunk",
-                    "created": int(datetime.now().timestamp()),
-                    "model": "podcast-generator",
-                    "choices": [
-                        {
-                            "index": 0,
-                            "delta": {"content": f"播客生成出错: {str(e)}"},
-                            "finish_reason": None,
-                        }
-                    ],
-                    "session_id": session_id,
-                }
-                yield f"data: {json.dumps(error_chunk, ensure_ascii=False)}\n\n"
-                yield "data: [DONE]\n\n"
+        except Exception as e:
+            logger.error(f"❌ 播客生成错误 | Session: {session_id} | 错误: {str(e)}", exc_info=True)
+            # 流式错误处理
+            error_chunk = {
+                "id": f"chatcmpl-{int(datetime.now().timestamp())}",
+                "object": "chat.completion.chunk",
+                "created": int(datetime.now().timestamp()),
+                "model": "podcast-generator",
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": {"content": f"播客生成出错: {str(e)}"},
+                        "finish_reason": None,
+                    }
+                ],
+                "session_id": session_id,
+            }
+            yield fast_json.sse_event(error_chunk)
+            yield "data: [DONE]\n\n"
 
     return StreamingResponse(
         generate_stream(),
@@ -678,16 +1036,18 @@ if __name__ == "__main__":
     import uvicorn
 
     logger.info("🚀 Starting Podcast Server on port 3001...")
-    logger.info(f"📊 配置信息 - 最大并发: {MAX_CONCURRENT_REQUESTS}, 流式并发: {MAX_CONCURRENT_STREAMING}, 超时: {REQUEST_TIMEOUT}s")
+    logger.info(f"📊 配置信息 - 最大并发: {MAX_CONCURRENT_REQUESTS}, 聊天并发: {admission.lanes['chat'].limit} (自适应: {streaming_limiter.enabled}), 播客并发: {MAX_CONCURRENT_PODCAST}, 超时: {REQUEST_TIMEOUT}s, Workers: {SERVER_WORKERS}")
 
     # 配置uvicorn
     uvicorn_config = {
-        "app": app,
+        # 多worker时uvicorn需要以导入字符串加载应用，每个worker进程各自导入
+        "app": "ultra_simple_server:app" if SERVER_WORKERS > 1 else app,
         "host": "0.0.0.0",
         "port": 3001,
         "log_level": "warning",  # 减少uvicorn自己的日志，使用我们的日志系统
         "access_log": False,     # 禁用访问日志，使用我们的中间件
-        "workers": 1,            # 单进程模式，我们的异步处理已经足够
+        # worker进程数：会话映射、并发名额和限流在 shared_state 中跨进程共享
+        "workers": SERVER_WORKERS,
     }
 
     uvicorn.run(**uvicorn_config)
@@ -1,54 +1,163 @@
 #!/usr/bin/env python3
 """
 播客制作服务器路径管理函数
+
+会话数据通过 SessionStore 缓存，后台线程以组提交方式批量写回，持久化由可配置的存储后端完成：
+    filesystem  每个会话一个目录（meta.json + messages.jsonl），旧版context.json惰性迁移
+    sqlite      WAL模式数据库，适合分页读取历史和按用户查询会话
+无论哪种后端，会话目录都会保留，作为agent的工作目录（含CLAUDE.md）。
 """
 
 import json
+import os
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from session_backends import (
+    FileSystemBackend,
+    SessionBackend,
+    SessionLayout,
+    SQLiteBackend,
+)
+from session_index import SessionIndex
+from session_store import SessionStore
+from shared_state import SERVER_WORKERS
+
+# 多worker部署时其他进程也会读写会话，下面三项默认打开
+_MULTI_WORKER_DEFAULT = "1" if SERVER_WORKERS > 1 else "0"
 
 # 会话管理
-SESSIONS_DIR = Path("/tmp")
+SESSIONS_DIR = Path(os.getenv("PODCAST_SESSIONS_DIR", "/tmp"))
+# 目录布局：sharded 为 sessions/ab/cd/{session_id}；flat 为旧的 {SESSIONS_DIR}/{session_id}
+SESSION_LAYOUT = os.getenv("PODCAST_SESSION_LAYOUT", "sharded").lower()
+# 冷会话归档的压缩格式：gzip 或 zstd（需安装 zstandard）
+SESSION_ARCHIVE_CODEC = os.getenv("PODCAST_SESSION_ARCHIVE_CODEC", "gzip").lower()
+
+# 存储后端：filesystem 或 sqlite
+SESSION_BACKEND = os.getenv("PODCAST_SESSION_BACKEND", "filesystem").lower()
+SESSION_DB_PATH = Path(os.getenv("PODCAST_SESSION_DB", "data/sessions.db"))
+# 消息日志的fsync策略：always 每次追加都落盘；never 交给操作系统刷盘
+SESSION_FSYNC = os.getenv("PODCAST_SESSION_FSYNC", "never").lower()
+# 会话缓存的内存预算（字节）与脏数据写回间隔（秒）
+SESSION_CACHE_BYTES = int(os.getenv("PODCAST_SESSION_CACHE_BYTES", str(64 * 1024 * 1024)))
+SESSION_FLUSH_INTERVAL = float(os.getenv("PODCAST_SESSION_FLUSH_INTERVAL", "1.0"))
+# 组提交：被唤醒后的合并窗口（秒）与触发立即提交的批次大小
+SESSION_GROUP_COMMIT_WINDOW = float(os.getenv("PODCAST_GROUP_COMMIT_WINDOW", "0.005"))
+SESSION_GROUP_COMMIT_MAX_BATCH = int(os.getenv("PODCAST_GROUP_COMMIT_MAX_BATCH", "256"))
+# save_message 默认是否等待本次写入落盘（单次调用可用 durable 参数覆盖）
+SESSION_DURABLE_WRITES = os.getenv("PODCAST_SESSION_DURABLE_WRITES", _MULTI_WORKER_DEFAULT) == "1"
+SESSION_DURABLE_TIMEOUT = float(os.getenv("PODCAST_SESSION_DURABLE_TIMEOUT", "10"))
+# 命中缓存时按文件mtime/size（或数据库行数）校验，有其他进程写同一会话时打开
+SESSION_REVALIDATE = os.getenv("PODCAST_SESSION_REVALIDATE", _MULTI_WORKER_DEFAULT) == "1"
+# 只接受UUID格式的session_id，畸形id不触碰文件系统直接拒绝
+SESSION_ID_STRICT = os.getenv("PODCAST_SESSION_ID_STRICT", "0") == "1"
+# 索引未命中时再查一次存储后端（会话可能由其他进程创建时打开）
+SESSION_INDEX_FALLBACK = os.getenv("PODCAST_SESSION_INDEX_FALLBACK", _MULTI_WORKER_DEFAULT) == "1"
+# 拼进提示词的聊天历史的token预算（摘要 + 最近原文），0表示不限制
+HISTORY_TOKEN_BUDGET = int(os.getenv("PODCAST_HISTORY_TOKEN_BUDGET", "6000"))
+# 压缩时保留原文的最近消息条数
+SUMMARY_KEEP_MESSAGES = int(os.getenv("PODCAST_SUMMARY_KEEP_MESSAGES", "12"))
+# 未压缩的消息超过保留条数这么多条时触发后台压缩
+SUMMARY_MIN_BATCH = int(os.getenv("PODCAST_SUMMARY_MIN_BATCH", "8"))
+
+
+session_layout = SessionLayout(
+    SESSIONS_DIR,
+    sharded=SESSION_LAYOUT == "sharded",
+    archive_codec=SESSION_ARCHIVE_CODEC,
+)
 
 
 def get_session_path(session_id: str) -> Path:
-    return SESSIONS_DIR / f"{session_id}"
+    return session_layout.path_for(session_id)
 
 
-def create_session_context(session_id: str, username: str = "anonymous"):
+def _create_backend() -> SessionBackend:
+    filesystem = FileSystemBackend(session_layout, fsync=SESSION_FSYNC == "always")
+    if SESSION_BACKEND == "sqlite":
+        return SQLiteBackend(
+            SESSION_DB_PATH,
+            session_layout,
+            legacy=filesystem,
+            synchronous="FULL" if SESSION_FSYNC == "always" else "NORMAL",
+        )
+    return filesystem
+
+
+session_store = SessionStore(
+    backend=_create_backend(),
+    max_bytes=SESSION_CACHE_BYTES,
+    flush_interval=SESSION_FLUSH_INTERVAL,
+    revalidate=SESSION_REVALIDATE,
+    group_commit_window=SESSION_GROUP_COMMIT_WINDOW,
+    group_commit_max_batch=SESSION_GROUP_COMMIT_MAX_BATCH,
+    durable_timeout=SESSION_DURABLE_TIMEOUT,
+)
+
+session_index = SessionIndex(
+    strict=SESSION_ID_STRICT,
+    fallback=session_store.backend.exists if SESSION_INDEX_FALLBACK else None,
+)
+session_store.delete_listeners.append(session_index.discard)
+
+# 助手提议生成播客的标记（模型输出中两种拼写都会出现）
+CONFIRM_GENERATE_TAGS = ("<confirm_generate>", "<comfirm_generate>")
+CONFIRM_GENERATE_COUNT_KEY = "confirm_generate_count"
+
+# 聊天历史需要压缩时通知的回调（后台摘要任务在启动时注册）
+compaction_listeners: List[Callable[[str], None]] = []
+
+
+def build_session_index() -> int:
+    """扫描存储后端构建会话索引，返回已知会话数"""
+    session_index.build(session_store.backend.iter_session_ids())
+    return session_index.stats()["known_sessions"]
+
+
+def session_exists(session_id: str) -> bool:
+    """校验会话是否存在：索引就绪后不产生系统调用"""
+    return session_index.exists(session_id, session_layout.exists)
+
+
+def init_session_workspace(session_id: str, session_info: Dict[str, Any]) -> Path:
+    """创建会话工作目录并写入CLAUDE.md（agent的cwd）"""
     session_path = get_session_path(session_id)
-    session_path.mkdir(exist_ok=True)
+    session_path.mkdir(parents=True, exist_ok=True)
+    with open(session_path / "CLAUDE.md", "w", encoding="utf-8") as f:
+        json.dump({**session_info, "messages": []}, f, ensure_ascii=False, indent=2)
+    return session_path
+
 
+def create_session_context(session_id: str, username: str = "anonymous"):
     # 保存会话信息
     session_info = {
         "session_id": session_id,
         "username": username,
         "created_at": datetime.now().isoformat(),
-        "messages": [],
         "claude_session_id": None,
     }
 
-    with open(session_path / "context.json", "w", encoding="utf-8") as f:
-        json.dump(session_info, f, ensure_ascii=False, indent=2)
-    with open(session_path / "CLAUDE.md", "w", encoding="utf-8") as f:
-        json.dump(session_info, f, ensure_ascii=False, indent=2)
+    session_path = init_session_workspace(session_id, session_info)
+    session_store.create(session_id, session_info)
+    session_index.add(session_id)
 
     return session_path
 
 
 def save_message(
-    session_id: str, role: str, content: str, tool_calls=None, sequence_id=None
-):
-    session_path = get_session_path(session_id)
-    context_file = session_path / "context.json"
-
-    if context_file.exists():
-        with open(context_file, "r", encoding="utf-8") as f:
-            context = json.load(f)
-    else:
-        context = {"messages": []}
+    session_id: str,
+    role: str,
+    content: str,
+    tool_calls=None,
+    sequence_id=None,
+    durable: Optional[bool] = None,
+    interrupted: bool = False,
+) -> int:
+    """追加一条消息，返回写入序号；durable=True时等到所在批次提交后返回
 
+    interrupted=True 表示客户端断开、回复没有生成完，content是已经输出的部分。
+    """
     message = {
         "role": role,
         "content": content,
@@ -59,35 +168,51 @@ def save_message(
         message["tool_calls"] = tool_calls
     if sequence_id:
         message["sequence_id"] = sequence_id
+    if interrupted:
+        message["interrupted"] = True
+
+    if durable is None:
+        durable = SESSION_DURABLE_WRITES
+    counters = None
+    if role == "assistant":
+        counters = {CONFIRM_GENERATE_COUNT_KEY: count_confirm_generate_tags(content)}
+    return session_store.append_message(
+        session_id, message, durable=durable, counters=counters
+    )
+
+
+def count_confirm_generate_tags(content: Any) -> int:
+    text = str(content or "")
+    return sum(text.count(tag) for tag in CONFIRM_GENERATE_TAGS)
 
-    context["messages"].append(message)
 
-    with open(context_file, "w", encoding="utf-8") as f:
-        json.dump(context, f, ensure_ascii=False, indent=2)
+def _count_confirm_generate(messages: List[Dict[str, Any]]) -> int:
+    return sum(
+        count_confirm_generate_tags(msg.get("content"))
+        for msg in messages
+        if msg.get("role") == "assistant"
+    )
+
+
+def get_confirm_generate_count(session_id: str) -> int:
+    """助手提议生成播客的累计次数；旧会话第一次访问时从历史回填"""
+    count = session_store.counter_meta(
+        session_id, CONFIRM_GENERATE_COUNT_KEY, _count_confirm_generate
+    )
+    return count or 0
 
 
 def update_claude_session_in_context(our_session_id: str, claude_session_id: str):
     """更新会话上下文中的Claude会话ID"""
     try:
-        session_path = get_session_path(our_session_id)
-        session_path.mkdir(parents=True, exist_ok=True)
-        context_file = session_path / "context.json"
-
-        if context_file.exists():
-            with open(context_file, "r", encoding="utf-8") as f:
-                context = json.load(f)
-        else:
-            context = {
+        session_store.update_meta(
+            our_session_id,
+            {"claude_session_id": claude_session_id},
+            defaults={
                 "session_id": our_session_id,
                 "created_at": datetime.now().isoformat(),
-                "messages": [],
-                "claude_session_id": claude_session_id,
-            }
-
-        context["claude_session_id"] = claude_session_id
-
-        with open(context_file, "w", encoding="utf-8") as f:
-            json.dump(context, f, ensure_ascii=False, indent=2)
+            },
+        )
 
         print(f"📝 更新会话上下文中的Claude会话ID: {claude_session_id}")
         return True
@@ -99,39 +224,176 @@ def update_claude_session_in_context(our_session_id: str, claude_session_id: str
 def load_claude_session_id(our_session_id: str) -> Optional[str]:
     """从持久化存储加载Claude会话ID"""
     try:
-        session_path = get_session_path(our_session_id)
-        session_path.mkdir(parents=True, exist_ok=True)
-        context_file = session_path / "context.json"
-
-        if context_file.exists():
-            with open(context_file, "r", encoding="utf-8") as f:
-                context = json.load(f)
-                if "claude_session_id" in context:
-                    return context["claude_session_id"]
+        meta = session_store.get_meta(our_session_id)
+        if meta:
+            return meta.get("claude_session_id")
         return None
     except Exception as e:
         print(f"❌ 加载Claude会话ID失败: {str(e)}")
         return None
 
 
-def load_chat_history(our_session_id: str) -> Optional[str]:
-    """从持久化存储加载聊天历史"""
-    try:
-        session_path = get_session_path(our_session_id)
-        session_path.mkdir(parents=True, exist_ok=True)
-        context_file = session_path / "context.json"
-
-        context_msgs = []
-        if context_file.exists():
-            with open(context_file, "r", encoding="utf-8") as f:
-                context = json.load(f)
-                if 'username' in context:
-                    context_msgs.append(f'user:叫我[{context.get("username")}]。')
-
-                for msg in context.get("messages", []):
-                    context_msgs.append(f"{msg.get('role')}: {msg.get('content')}")
-                return "\n".join(context_msgs) + "\n"
+def get_session_username(session_id: str) -> Optional[str]:
+    """会话创建时记录的用户名；会话不存在时返回None"""
+    meta = session_store.get_meta(session_id)
+    return meta.get("username") if meta else None
+
+
+def first_turn_username(our_session_id: str) -> Optional[str]:
+    """会话仍在首轮（没有Claude会话、只有本轮的用户消息）时返回用户名，否则返回None"""
+    meta = session_store.get_meta(our_session_id)
+    if not meta or meta.get("claude_session_id"):
         return None
+    if (session_store.message_count(our_session_id) or 0) > 1:
+        return None
+    return meta.get("username")
+
+
+def load_messages(session_id: str) -> List[Dict[str, Any]]:
+    """加载会话的全部消息"""
+    return session_store.get_messages(session_id) or []
+
+
+def load_messages_page(
+    session_id: str, offset: int = 0, limit: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """分页加载会话消息"""
+    return session_store.get_messages_page(session_id, offset, limit)
+
+
+def list_sessions(
+    username: Optional[str] = None, offset: int = 0, limit: int = 50
+) -> List[Dict[str, Any]]:
+    """按最近更新时间列出会话，可按用户名过滤"""
+    return session_store.list_sessions(username, offset, limit)
+
+
+def iter_messages(session_id: str) -> Iterator[Dict[str, Any]]:
+    """按顺序遍历会话消息"""
+    yield from load_messages(session_id)
+
+
+def load_session(session_id: str) -> Optional[Dict[str, Any]]:
+    """加载完整会话（元数据 + 消息），结构与旧版context.json一致"""
+    meta = session_store.get_meta(session_id)
+    if meta is None:
+        return None
+    return {**meta, "messages": load_messages(session_id)}
+
+
+def _render_history_line(msg: Dict[str, Any]) -> str:
+    if msg.get("interrupted"):
+        return f"{msg.get('role')}: {msg.get('content')}（回复被中断）\n"
+    return f"{msg.get('role')}: {msg.get('content')}\n"
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算token数：中文约每字1个token，英文约每3~4字节1个token"""
+    return len(text.encode("utf-8")) // 3
+
+
+def _request_compaction(session_id: str):
+    for listener in compaction_listeners:
+        listener(session_id)
+
+
+def _keep_recent_lines(text: str, max_bytes: int) -> str:
+    """按整行从末尾保留不超过 max_bytes 字节的内容"""
+    kept = []
+    total = 0
+    for line in reversed(text.splitlines(keepends=True)):
+        total += len(line.encode("utf-8"))
+        if total > max_bytes:
+            break
+        kept.append(line)
+    return "".join(reversed(kept))
+
+
+def _compact_history(our_session_id: str, meta: Dict[str, Any]) -> Optional[str]:
+    """滚动摘要 + 最近消息原文，总量不超过 HISTORY_TOKEN_BUDGET"""
+    summary = meta.get("summary") or {}
+    upto = int(summary.get("upto") or 0) if summary.get("text") else 0
+    if upto:
+        since = session_store.get_messages_since(our_session_id, upto)
+        if since is None:
+            return None
+        tail, _ = since
+        unsummarized = len(tail)
+        recent = "".join(_render_history_line(m) for m in tail)
+        summary_text = summary["text"]
+        if HISTORY_TOKEN_BUDGET > 0:
+            # 摘要最多占预算的一半，剩下的留给最近的原文
+            summary_text = _keep_recent_lines(summary_text, HISTORY_TOKEN_BUDGET * 3 // 2)
+        header = f"[之前对话摘要]\n{summary_text}\n[最近对话]\n"
+    else:
+        # 还没有摘要时直接使用缓存的渲染结果
+        rendered = session_store.get_rendered(our_session_id, _render_history_line)
+        if rendered is None:
+            return None
+        _, recent = rendered
+        unsummarized = session_store.message_count(our_session_id) or 0
+        header = ""
+
+    over_budget = (
+        HISTORY_TOKEN_BUDGET > 0
+        and estimate_tokens(header + recent) > HISTORY_TOKEN_BUDGET
+    )
+    if over_budget or unsummarized > SUMMARY_KEEP_MESSAGES + SUMMARY_MIN_BATCH:
+        # 压缩在后台进行，本轮先按预算截断最早的原文
+        _request_compaction(our_session_id)
+    if over_budget:
+        remaining = HISTORY_TOKEN_BUDGET * 3 - len(header.encode("utf-8"))
+        recent = _keep_recent_lines(recent, max(remaining, 0))
+    return header + recent
+
+
+def load_chat_history(
+    our_session_id: str, max_chars: Optional[int] = None, compact: bool = True
+) -> Optional[str]:
+    """从持久化存储加载聊天历史
+
+    compact=True 时使用后台生成的滚动摘要 + 最近消息原文，长度受 HISTORY_TOKEN_BUDGET 约束；
+    compact=False 返回完整原文（渲染结果按会话缓存，只增量渲染新消息）。
+    max_chars 进一步限制长度：只保留最近的整行，用户名前缀始终保留。
+    """
+    try:
+        if compact:
+            meta = session_store.get_meta(our_session_id)
+            if meta is None:
+                return None
+            history = _compact_history(our_session_id, meta)
+            if history is None:
+                return None
+        else:
+            rendered = session_store.get_rendered(our_session_id, _render_history_line)
+            if rendered is None:
+                return None
+            meta, history = rendered
+        if max_chars and len(history) > max_chars:
+            history = history[-max_chars:]
+            # 丢掉被截断的半行
+            newline = history.find("\n")
+            history = history[newline + 1:] if newline >= 0 else history
+
+        if 'username' in meta:
+            return f'user:叫我[{meta.get("username")}]。\n' + history
+        return history or "\n"
     except Exception as e:
         print(f"❌ 加载聊天历史失败: {str(e)}")
-        return None
\ No newline at end of file
+        return None
+
+
+def delete_session(session_id: str) -> Optional[int]:
+    """删除会话数据和工作目录，返回释放的字节数；会话仍有未写回数据时返回None"""
+    return session_store.delete(session_id)
+
+
+def flush_sessions() -> bool:
+    """把缓存中的脏会话作为一批写回磁盘"""
+    return session_store.flush()
+
+
+def close_session_store():
+    """关闭会话缓存：停止写回线程并写回剩余数据"""
+    session_store.close()
+